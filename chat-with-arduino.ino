@@ -1,12 +1,190 @@
 
-uint8_t START_OF_MESSAGE = 0xFE;
-uint8_t END_OF_MESSAGE = 0xFF;
+// Every frame is [seq, command, ...payload, crc_high, crc_low], where the CRC
+// is CRC-16/CCITT-FALSE over everything before it. On the wire each frame is
+// COBS encoded and followed by a single FRAME_DELIMITER. COBS removes every
+// zero byte from the frame, so payloads can hold any value and a corrupted
+// frame can never swallow the next one.
+const uint8_t FRAME_DELIMITER = 0x00;
+
+// Reported in the ACK reply so the host can detect outdated firmware.
+uint8_t PROTOCOL_VERSION = 3;
+
+// Sequence ID, command and CRC.
+const uint8_t FRAME_OVERHEAD = 4;
+
+// The most operations a single BATCH command may carry. Must match
+// MAX_BATCH_OPS on the host.
+const uint8_t MAX_BATCH_OPS = 16;
+
+// The most pins a single analog stream may sample. Must match
+// MAX_STREAM_PINS on the host.
+const uint8_t MAX_STREAM_PINS = 8;
+
+// The longest pin mask DIGITAL_READ_PINS and DIGITAL_WRITE_PINS accept, and
+// the most pins ANALOG_READ_PINS may read. Must match MAX_PIN_MASK_BYTES and
+// MAX_ANALOG_READ_PINS on the host.
+const uint8_t MAX_PIN_MASK_BYTES = 9;
+const uint8_t MAX_ANALOG_READ_PINS = 16;
+
+// The most steps the schedule can hold, and the most one SCHEDULE_LOAD can
+// carry. Must match MAX_SCHEDULE_STEPS and MAX_SCHEDULE_LOAD_STEPS on the
+// host.
+const uint8_t MAX_SCHEDULE_STEPS = 32;
+const uint8_t MAX_SCHEDULE_LOAD_STEPS = 8;
+
+// Bytes per step in a SCHEDULE_LOAD: u32 offset, command, pin, value
+const uint8_t SCHEDULE_STEP_LENGTH = 7;
+
+// The states SCHEDULE_STATUS reports. Must match SCHEDULE_STATES on the host.
+const uint8_t SCHEDULE_IDLE = 0;
+const uint8_t SCHEDULE_RUNNING = 1;
+const uint8_t SCHEDULE_DONE = 2;
+const uint8_t SCHEDULE_STOPPED = 3;
+
+// Waveform playback: the most pins one playback may drive, the bytes of
+// samples buffered between them, and the most sample bytes one PLAYBACK_DATA
+// may carry. Must match MAX_PLAYBACK_PINS, PLAYBACK_BUFFER_BYTES and
+// MAX_PLAYBACK_CHUNK_BYTES on the host.
+const uint8_t MAX_PLAYBACK_PINS = 4;
+const uint16_t PLAYBACK_BUFFER_BYTES = 256;
+const uint8_t MAX_PLAYBACK_CHUNK_BYTES = 48;
+
+// Set in the flags of the PLAYBACK_DATA carrying the final samples
+const uint8_t PLAYBACK_LAST_CHUNK = 0x01;
+
+// The most pins WATCH_PIN can watch at once. Must match MAX_WATCHED_PINS on
+// the host.
+const uint8_t MAX_WATCHED_PINS = 4;
+
+// The edges WATCH_PIN can watch for. Must match PIN_EDGES on the host.
+const uint8_t EDGE_NONE = 0;
+const uint8_t EDGE_RISING = 1;
+const uint8_t EDGE_FALLING = 2;
+const uint8_t EDGE_CHANGE = 3;
+
+// Large enough for the biggest request (a full BATCH of 3 byte operations)
+// plus its COBS overhead.
+const uint8_t RX_BUFFER_LENGTH = 64;
+
+// Large enough for the biggest reply (a full BATCH of MILLIS results).
+const uint8_t TX_BUFFER_LENGTH = FRAME_OVERHEAD + MAX_BATCH_OPS * 4;
+
+// Every connection opens at this rate. Must match DEFAULT_BAUD_RATE on the
+// host.
+const unsigned long DEFAULT_BAUD_RATE = 9600;
+
+// The rates SET_BAUD may switch to. Must match NEGOTIABLE_BAUD_RATES on the
+// host.
+const unsigned long NEGOTIABLE_BAUD_RATES[] = {1000000, 500000, 115200};
+const uint8_t NEGOTIABLE_BAUD_RATE_COUNT = 3;
+
+// After switching rate, go back to the previous rate unless a valid frame
+// arrives within this long. Must match BAUD_CONFIRM_TIMEOUT_S on the host.
+const unsigned long BAUD_CONFIRM_TIMEOUT_MS = 500;
+
+// Frames sent without a request (eg streamed samples) use this sequence ID,
+// which the host never assigns to a command.
+const uint8_t UNSOLICITED_SEQ = 0xFF;
+
+// Bytes of the frame currently being received, still COBS encoded. Set
+// rxOverflow if the frame is too long to fit, so it's rejected once its
+// delimiter arrives.
+uint8_t rxBuffer[RX_BUFFER_LENGTH];
+uint8_t rxLength = 0;
+bool rxOverflow = false;
+
+// The reply being built, before its CRC and COBS encoding.
+uint8_t txBuffer[TX_BUFFER_LENGTH];
+uint8_t txLength = 0;
+
+// The rate the link runs at. While baudUnconfirmed is set the rate was only
+// just switched, and reverts to previousBaudRate at baudSwitchedAtMs +
+// BAUD_CONFIRM_TIMEOUT_MS unless a valid frame arrives first.
+unsigned long baudRate = DEFAULT_BAUD_RATE;
+unsigned long previousBaudRate = DEFAULT_BAUD_RATE;
+unsigned long baudSwitchedAtMs = 0;
+bool baudUnconfirmed = false;
+
+// The sequence ID of the command currently being handled. Every reply echoes
+// it so the host can match replies to pipelined requests.
+uint8_t currentSeq = 0;
+
+// State of the analog stream. No stream is running while streamPinCount is 0.
+uint8_t streamPins[MAX_STREAM_PINS];
+uint8_t streamPinCount = 0;
+unsigned long streamPeriodUs = 0;
+unsigned long streamLastSampleUs = 0;
+uint8_t streamFrameCounter = 0;
+
+// A pin being watched for changes. Pins with an external interrupt are
+// watched by an ISR, others are polled every loop. Either way, edges are
+// counted in pendingEdges until serviceWatches() reports them, so the
+// fields written by the ISR are volatile.
+struct WatchSlot {
+    bool active;
+    bool interruptDriven;
+    uint8_t pin;
+    uint8_t edge;
+    uint8_t lastLevel;
+    volatile uint8_t pendingEdges;
+    volatile uint8_t firstEdge;
+    volatile unsigned long firstEdgeMs;
+};
+WatchSlot watches[MAX_WATCHED_PINS];
+
+// A timeline of pin operations, run against millis() without the host.
+// Each step runs once its offset from the start of the run has passed.
+struct ScheduleStep {
+    uint32_t offsetMs;
+    uint8_t command;
+    uint8_t pin;
+    uint8_t value;
+};
+ScheduleStep scheduleSteps[MAX_SCHEDULE_STEPS];
+uint8_t scheduleLength = 0;
+uint8_t scheduleState = SCHEDULE_IDLE;
+uint8_t scheduleNext = 0;
+uint16_t scheduleRuns = 0;  // 0 repeats until stopped
+uint16_t scheduleRunsDone = 0;
+uint32_t schedulePeriodMs = 0;
+unsigned long scheduleRunStartMs = 0;
+uint16_t scheduleMaxLateMs = 0;
+
+// Waveform playback. Samples are queued in a ring of playbackCapacity
+// samples, each one byte per pin. The host may only send as many samples as
+// it holds credits for, and gets credits back as samples are played.
+uint8_t playbackPins[MAX_PLAYBACK_PINS];
+uint8_t playbackPinCount = 0;
+uint8_t playbackBuffer[PLAYBACK_BUFFER_BYTES];
+uint16_t playbackCapacity = 0;
+uint16_t playbackHead = 0;  // Index of the next sample to play
+uint16_t playbackCount = 0;  // Samples queued
+unsigned long playbackPeriodUs = 0;
+unsigned long playbackLastSampleUs = 0;
+bool playbackActive = false;
+bool playbackPrimed = false;  // Playing starts once the first samples arrive
+bool playbackLastReceived = false;
+uint32_t playbackPlayed = 0;
+uint16_t playbackUnderruns = 0;
+uint16_t playbackFreed = 0;  // Samples played since credit was last granted
 
 enum ErrorCode : uint8_t {
     GENERIC = 0,
-    END_BYTE_INCORRECT = 1,
+    LENGTH_INCORRECT = 1,
     MODE_GREATER_THAN_FOUR = 2,
-    UNKNOWN_COMMAND = 3
+    UNKNOWN_COMMAND = 3,
+    BATCH_TOO_LARGE = 4,
+    TOO_MANY_STREAM_PINS = 5,
+    CRC_MISMATCH = 6,
+    MALFORMED_FRAME = 7,
+    UNSUPPORTED_BAUD_RATE = 8,
+    TOO_MANY_WATCHED_PINS = 9,
+    INVALID_EDGE = 10,
+    SCHEDULE_TOO_LARGE = 11,
+    SCHEDULE_RUNNING = 12,
+    TOO_MANY_PLAYBACK_PINS = 13,
+    PLAYBACK_OVERFLOW = 14,
+    NOT_PLAYING = 15
 };
 
 enum TctlmIds : uint8_t {
@@ -19,270 +197,1009 @@ enum TctlmIds : uint8_t {
     ANALOG_WRITE = 6,
     DELAY = 7,
     MILLIS = 8,
+    BATCH = 9,
+    STREAM_START = 10,
+    STREAM_STOP = 11,
+    STREAM_DATA = 12,
+    SET_BAUD = 13,
+    WATCH_PIN = 14,
+    PIN_EVENT = 15,
+    DIGITAL_READ_PINS = 16,
+    DIGITAL_WRITE_PINS = 17,
+    ANALOG_READ_PINS = 18,
+    SCHEDULE_LOAD = 19,
+    SCHEDULE_START = 20,
+    SCHEDULE_STOP = 21,
+    SCHEDULE_STATUS = 22,
+    SCHEDULE_DONE = 23,
+    PLAYBACK_START = 24,
+    PLAYBACK_DATA = 25,
+    PLAYBACK_STOP = 26,
+    PLAYBACK_CREDIT = 27,
 };
 
 
+// CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF), matching
+// codec.crc16() on the host.
+uint16_t crc16(const uint8_t* data, uint8_t length) {
+    uint16_t crc = 0xFFFF;
+    for (uint8_t i = 0; i < length; i++) {
+        crc ^= (uint16_t)data[i] << 8;
+        for (uint8_t bit = 0; bit < 8; bit++) {
+            crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+        }
+    }
+    return crc;
+}
+
+// Decode a COBS encoded frame in place. Decoding never makes data longer, so
+// the output can overwrite the input as it goes. Returns the decoded length,
+// or -1 if the data isn't valid COBS.
+int decodeCobs(uint8_t* data, uint8_t length) {
+    uint8_t in = 0;
+    uint8_t out = 0;
+    while (in < length) {
+        uint8_t code = data[in];
+        if (code == 0 || in + code > length) {
+            return -1;
+        }
+        in++;
+        for (uint8_t i = 1; i < code; i++) {
+            data[out++] = data[in++];
+        }
+        if (code != 0xFF && in < length) {
+            data[out++] = 0;
+        }
+    }
+    return out;
+}
+
+// COBS encode `length` bytes of `data` straight onto the serial port.
+void writeCobs(const uint8_t* data, uint8_t length) {
+    uint8_t blockStart = 0;
+    for (uint8_t i = 0; i <= length; i++) {
+        // A block ends at a zero byte, at the end of the data, or once it
+        // holds 254 bytes
+        if (i == length || data[i] == 0 || i - blockStart == 254) {
+            Serial.write((uint8_t)(i - blockStart + 1));
+            Serial.write(data + blockStart, i - blockStart);
+            blockStart = (i < length && data[i] == 0) ? i + 1 : i;
+        }
+    }
+}
+
+uint32_t readU32(const uint8_t* data) {
+    return (
+        ((uint32_t)data[0] << 24)
+        | ((uint32_t)data[1] << 16)
+        | ((uint32_t)data[2] << 8)
+        | (uint32_t)data[3]
+    );
+}
+
+void beginFrame(uint8_t seq, TctlmIds tctlmId) {
+    txBuffer[0] = seq;
+    txBuffer[1] = tctlmId;
+    txLength = 2;
+}
+
+void beginReply(TctlmIds tctlmId) {
+    beginFrame(currentSeq, tctlmId);
+}
+
+void appendByte(uint8_t value) {
+    txBuffer[txLength++] = value;
+}
+
+void appendU16(uint16_t value) {
+    appendByte((uint8_t)(value >> 8));
+    appendByte((uint8_t)(value & 0xFF));
+}
+
+void appendU32(uint32_t value) {
+    appendU16((uint16_t)(value >> 16));
+    appendU16((uint16_t)(value & 0xFFFF));
+}
+
+// Add the CRC to the frame in txBuffer and send it.
+void sendFrame() {
+    uint16_t crc = crc16(txBuffer, txLength);
+    appendU16(crc);
+    writeCobs(txBuffer, txLength);
+    Serial.write(FRAME_DELIMITER);
+}
+
 void sendTctlmId(TctlmIds tctlmId) {
-    Serial.write(START_OF_MESSAGE);
-    Serial.write(tctlmId);
-    Serial.write(END_OF_MESSAGE);
+    beginReply(tctlmId);
+    sendFrame();
 }
 
 void sendError(ErrorCode err) {
-    Serial.write(START_OF_MESSAGE);
-    Serial.write(TctlmIds::ERR);
-    Serial.write(err);
-    Serial.write(END_OF_MESSAGE);
+    beginReply(TctlmIds::ERR);
+    appendByte(err);
+    sendFrame();
 }
 
-void handleAck() {
-    // Read the end of message byte
-    uint8_t endByte = Serial.read();
-
-    // Ensure the end byte is correct
-    if (endByte != END_OF_MESSAGE) {
-        sendError(ErrorCode::END_BYTE_INCORRECT);
+void handleAck(const uint8_t* payload, uint8_t length) {
+    if (length != 0) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
         return;
     }
 
-    // Send a reply back indicating that the ACK was received successfully
-    sendTctlmId(TctlmIds::ACK);
+    // Send a reply back indicating that the ACK was received successfully,
+    // along with the protocol version this firmware speaks
+    beginReply(TctlmIds::ACK);
+    appendByte(PROTOCOL_VERSION);
+    sendFrame();
 }
 
-void handleDigitalRead() {
-    // Read the pin number (should be the second byte)
-    uint8_t pin = Serial.read();
-
-    // Read the end of message byte
-    uint8_t endByte = Serial.read();
-
-    // Ensure the end byte is correct
-    if (endByte != END_OF_MESSAGE) {
-        sendError(ErrorCode::END_BYTE_INCORRECT);
+void handleDigitalRead(const uint8_t* payload, uint8_t length) {
+    if (length != 1) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
         return;
     }
 
     // Get the digital pin value using the digitalRead function
-    uint8_t pinState = digitalRead(pin);
+    uint8_t pinState = digitalRead(payload[0]);
 
     // Send the response back with the pin value
-    Serial.write(START_OF_MESSAGE);
-    Serial.write(TctlmIds::DIGITAL_READ);
-    Serial.write(pinState);  // 0 or 1
-    Serial.write(END_OF_MESSAGE);
+    beginReply(TctlmIds::DIGITAL_READ);
+    appendByte(pinState);  // 0 or 1
+    sendFrame();
 }
 
-void handleDigitalWrite() {
-    // Read the pin number (should be the second byte)
-    uint8_t pin = Serial.read();
-
-    // Read the state (should be the third byte, 0 or 1)
-    uint8_t state = Serial.read();
-
-    // Read the end of message byte
-    uint8_t endByte = Serial.read();
-
-    // Ensure the end byte is correct
-    if (endByte != END_OF_MESSAGE) {
-        sendError(ErrorCode::END_BYTE_INCORRECT);
+void handleDigitalWrite(const uint8_t* payload, uint8_t length) {
+    if (length != 2) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
         return;
     }
 
     // Set the digital pin state using the digitalWrite function
-    digitalWrite(pin, state);
+    digitalWrite(payload[0], payload[1]);
 
     // Send the response back indicating that the digitalWrite was executed
     sendTctlmId(TctlmIds::DIGITAL_WRITE);
 }
 
-void handlePinMode() {
-    // Read the pin number (should be the second byte)
-    uint8_t pin = Serial.read();
-
-    // Read the mode (should be the third byte)
-    uint8_t mode = Serial.read();
-
-    // Read the end of message byte
-    uint8_t endByte = Serial.read();
-
-    // Ensure the end byte is correct
-    if (endByte != END_OF_MESSAGE) {
-        sendError(ErrorCode::END_BYTE_INCORRECT);
+void handlePinMode(const uint8_t* payload, uint8_t length) {
+    if (length != 2) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
         return;
     }
 
     // Check if mode is valid
-    if (mode > 4) {
+    if (payload[1] > 4) {
         sendError(ErrorCode::MODE_GREATER_THAN_FOUR);
         return;
     }
 
     // Set the pin mode using pinMode function
-    pinMode(pin, mode);
+    pinMode(payload[0], payload[1]);
 
     // Send the response back indicating that the pinMode was executed
     sendTctlmId(TctlmIds::PIN_MODE);
 }
 
-void handleAnalogRead() {
-    // Read the pin number (should be the second byte)
-    uint8_t pin = Serial.read();
-
-    // Read the end of message byte
-    uint8_t endByte = Serial.read();
-
-    // Ensure the end byte is correct
-    if (endByte != END_OF_MESSAGE) {
-        sendError(ErrorCode::END_BYTE_INCORRECT);
+void handleAnalogRead(const uint8_t* payload, uint8_t length) {
+    if (length != 1) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
         return;
     }
 
     // Read the analog value using analogRead function
-    int value = analogRead(pin);
+    int value = analogRead(payload[0]);
 
     // Send the response back with the analog value
-    Serial.write(START_OF_MESSAGE);
-    Serial.write(TctlmIds::ANALOG_READ);
-    Serial.write((uint8_t)(value >> 8)); // Send high byte
-    Serial.write((uint8_t)(value & 0xFF)); // Send low byte
-    Serial.write(END_OF_MESSAGE);
+    beginReply(TctlmIds::ANALOG_READ);
+    appendU16(value);
+    sendFrame();
 }
 
-void handleAnalogWrite() {
-    // Read the pin number (should be the second byte)
-    uint8_t pin = Serial.read();
-
-    // Read the value to write (should be the third byte)
-    uint8_t value = Serial.read();
-
-    // Read the end of message byte
-    uint8_t endByte = Serial.read();
-
-    // Ensure the end byte is correct
-    if (endByte != END_OF_MESSAGE) {
-        sendError(ErrorCode::END_BYTE_INCORRECT);
+void handleAnalogWrite(const uint8_t* payload, uint8_t length) {
+    if (length != 2) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
         return;
     }
 
     // Write the value using analogWrite function
-    analogWrite(pin, value);
+    analogWrite(payload[0], payload[1]);
 
     // Send the response back indicating that the analogWrite was executed
     sendTctlmId(TctlmIds::ANALOG_WRITE);
 }
 
-void handleDelay() {
+void handleDelay(const uint8_t* payload, uint8_t length) {
+    if (length != 4) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
 
-    // Read the delay duration
-    uint8_t duration0 = Serial.read();
-    uint8_t duration1 = Serial.read();
-    uint8_t duration2 = Serial.read();
-    uint8_t duration3 = Serial.read();
+    // Perform the delay
+    delay(readU32(payload));
 
-    // Read the end of message byte
-    uint8_t endByte = Serial.read();
+    // Send the response back indicating the delay was executed
+    sendTctlmId(TctlmIds::DELAY);
+}
 
-    // Ensure the end byte is correct
-    if (endByte != END_OF_MESSAGE) {
-        sendError(ErrorCode::END_BYTE_INCORRECT);
+void handleMillis(const uint8_t* payload, uint8_t length) {
+    if (length != 0) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
         return;
     }
 
-    // Combine duration bytes into a full value
-    long duration = (
-        (duration0 << 24)
-        | (duration1 << 16)
-        | (duration2 << 8)
-        | duration3
-    );
+    // Send the response back with the current millis value
+    beginReply(TctlmIds::MILLIS);
+    appendU32(millis());
+    sendFrame();
+}
 
-    // Perform the delay
-    delay(duration);
+void handleBatch(const uint8_t* payload, uint8_t length) {
+    if (length < 1) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    // Read the number of operations in the batch
+    uint8_t count = payload[0];
+    if (count > MAX_BATCH_OPS) {
+        sendError(ErrorCode::BATCH_TOO_LARGE);
+        return;
+    }
 
-    // Send the response back indicating the delay was executed
-    sendTctlmId(TctlmIds::DELAY);
+    // Check every operation before running any of them, so that a malformed
+    // batch has no side effects and the operations run back to back
+    uint8_t offset = 1;
+    for (uint8_t i = 0; i < count; i++) {
+        if (offset >= length) {
+            sendError(ErrorCode::LENGTH_INCORRECT);
+            return;
+        }
+        uint8_t argLength;
+        switch (payload[offset]) {
+            case TctlmIds::PIN_MODE:
+                argLength = 2;
+                if (offset + 2 < length && payload[offset + 2] > 4) {
+                    sendError(ErrorCode::MODE_GREATER_THAN_FOUR);
+                    return;
+                }
+                break;
+
+            case TctlmIds::DIGITAL_WRITE:
+            case TctlmIds::ANALOG_WRITE:
+                argLength = 2;
+                break;
+
+            case TctlmIds::DIGITAL_READ:
+            case TctlmIds::ANALOG_READ:
+                argLength = 1;
+                break;
+
+            case TctlmIds::MILLIS:
+                argLength = 0;
+                break;
+
+            default:
+                sendError(ErrorCode::UNKNOWN_COMMAND);
+                return;
+        }
+        offset += 1 + argLength;
+    }
+    if (offset != length) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+
+    // Run the operations, appending their results straight to the reply so
+    // that writing it doesn't add serial latency between operations
+    beginReply(TctlmIds::BATCH);
+    offset = 1;
+    for (uint8_t i = 0; i < count; i++) {
+        const uint8_t* args = payload + offset + 1;
+        switch (payload[offset]) {
+            case TctlmIds::PIN_MODE:
+                pinMode(args[0], args[1]);
+                offset += 3;
+                break;
+
+            case TctlmIds::DIGITAL_WRITE:
+                digitalWrite(args[0], args[1]);
+                offset += 3;
+                break;
+
+            case TctlmIds::ANALOG_WRITE:
+                analogWrite(args[0], args[1]);
+                offset += 3;
+                break;
+
+            case TctlmIds::DIGITAL_READ:
+                appendByte(digitalRead(args[0]));
+                offset += 2;
+                break;
+
+            case TctlmIds::ANALOG_READ:
+                appendU16(analogRead(args[0]));
+                offset += 2;
+                break;
+
+            case TctlmIds::MILLIS:
+                appendU32(millis());
+                offset += 1;
+                break;
+        }
+    }
+
+    // Send the response back with every operation's result, in order
+    sendFrame();
 }
 
-void handleMillis() {
-    // Read the end of message byte
-    uint8_t endByte = Serial.read();
+void handleStreamStart(const uint8_t* payload, uint8_t length) {
+    // The sampling period in microseconds, then the pins to sample
+    if (length < 5) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    uint8_t count = payload[4];
+    if (count == 0 || count > MAX_STREAM_PINS) {
+        sendError(ErrorCode::TOO_MANY_STREAM_PINS);
+        return;
+    }
+    if (length != 5 + count) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
 
-    // Ensure the end byte is correct
-    if (endByte != END_OF_MESSAGE) {
-        sendError(ErrorCode::END_BYTE_INCORRECT);
+    // Replace any running stream
+    streamPeriodUs = readU32(payload);
+    for (uint8_t i = 0; i < count; i++) {
+        streamPins[i] = payload[5 + i];
+    }
+    streamPinCount = count;
+    streamFrameCounter = 0;
+    streamLastSampleUs = micros();
+
+    // Send the response back indicating that the stream has started
+    sendTctlmId(TctlmIds::STREAM_START);
+}
+
+void handleStreamStop(const uint8_t* payload, uint8_t length) {
+    if (length != 0) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
         return;
     }
 
-    // Get the current millis value
-    long millisValue = millis();
+    streamPinCount = 0;
 
-    // Send the response back with the millis value
-    Serial.write(START_OF_MESSAGE);
-    Serial.write(TctlmIds::MILLIS);
-    Serial.write((uint8_t)(millisValue >> 24)); // Send high byte
-    Serial.write((uint8_t)((millisValue >> 16) & 0xFF)); // Send low byte
-    Serial.write((uint8_t)((millisValue >> 8) & 0xFF)); // Send low byte
-    Serial.write((uint8_t)(millisValue & 0xFF)); // Send low byte
-    Serial.write(END_OF_MESSAGE);
+    // Send the response back indicating that the stream has stopped
+    sendTctlmId(TctlmIds::STREAM_STOP);
 }
 
-void setup() {
-    // Initialize serial communication at 9600 baud rate
-    Serial.begin(9600);
+void switchBaudRate(unsigned long newBaudRate) {
+    // Let the last reply leave at the old rate before switching
+    Serial.flush();
+    Serial.end();
+    Serial.begin(newBaudRate);
+    baudRate = newBaudRate;
+    rxLength = 0;
+    rxOverflow = false;
 }
 
-void loop() {
-    // Check if there are enough bytes in the serial buffer for the message format
-    if (Serial.available() < 3u) {
+void handleSetBaud(const uint8_t* payload, uint8_t length) {
+    if (length != 4) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    unsigned long newBaudRate = readU32(payload);
+
+    bool supported = false;
+    for (uint8_t i = 0; i < NEGOTIABLE_BAUD_RATE_COUNT; i++) {
+        supported = supported || NEGOTIABLE_BAUD_RATES[i] == newBaudRate;
+    }
+    if (!supported) {
+        sendError(ErrorCode::UNSUPPORTED_BAUD_RATE);
+        return;
+    }
+
+    // Reply at the old rate, then switch. The host confirms the new rate by
+    // sending a valid frame at it.
+    sendTctlmId(TctlmIds::SET_BAUD);
+    previousBaudRate = baudRate;
+    switchBaudRate(newBaudRate);
+    baudSwitchedAtMs = millis();
+    baudUnconfirmed = true;
+}
+
+void serviceBaudRate() {
+    if (baudUnconfirmed && millis() - baudSwitchedAtMs > BAUD_CONFIRM_TIMEOUT_MS) {
+        // The host never spoke at the new rate, so go back to the old one
+        baudUnconfirmed = false;
+        switchBaudRate(previousBaudRate);
+    }
+}
+
+// Payload is [first pin, mask...]. Bit b of mask byte i selects pin
+// first + 8*i + b. The reply has the same layout, with a bit set for each
+// selected pin that reads HIGH.
+void handleDigitalReadPins(const uint8_t* payload, uint8_t length) {
+    uint8_t maskBytes = length - 1;
+    if (length < 2 || maskBytes > MAX_PIN_MASK_BYTES) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    uint8_t firstPin = payload[0];
+    const uint8_t* mask = payload + 1;
+
+    beginReply(TctlmIds::DIGITAL_READ_PINS);
+    for (uint8_t i = 0; i < maskBytes; i++) {
+        uint8_t levels = 0;
+        for (uint8_t bit = 0; bit < 8; bit++) {
+            if ((mask[i] & (1 << bit)) && digitalRead(firstPin + i * 8 + bit)) {
+                levels |= 1 << bit;
+            }
+        }
+        appendByte(levels);
+    }
+    sendFrame();
+}
+
+// Payload is [first pin, mask length, mask..., levels...], with masks laid
+// out as for DIGITAL_READ_PINS. Each selected pin is set to its level bit.
+void handleDigitalWritePins(const uint8_t* payload, uint8_t length) {
+    uint8_t maskBytes = length >= 2 ? payload[1] : 0;
+    if (maskBytes == 0 || maskBytes > MAX_PIN_MASK_BYTES || length != 2 + 2 * maskBytes) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    uint8_t firstPin = payload[0];
+    const uint8_t* mask = payload + 2;
+    const uint8_t* levels = mask + maskBytes;
+
+    for (uint8_t i = 0; i < maskBytes; i++) {
+        for (uint8_t bit = 0; bit < 8; bit++) {
+            if (mask[i] & (1 << bit)) {
+                digitalWrite(firstPin + i * 8 + bit, (levels[i] & (1 << bit)) ? HIGH : LOW);
+            }
+        }
+    }
+    sendTctlmId(TctlmIds::DIGITAL_WRITE_PINS);
+}
+
+// Payload is the pins to read. The reply has a u16 reading for each.
+void handleAnalogReadPins(const uint8_t* payload, uint8_t length) {
+    if (length == 0 || length > MAX_ANALOG_READ_PINS) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    beginReply(TctlmIds::ANALOG_READ_PINS);
+    for (uint8_t i = 0; i < length; i++) {
+        appendU16(analogRead(payload[i]));
+    }
+    sendFrame();
+}
+
+// Payload is [index of the first step, steps...]
+void handleScheduleLoad(const uint8_t* payload, uint8_t length) {
+    // Changing steps under a running schedule would garble it
+    if (scheduleState == SCHEDULE_RUNNING) {
+        sendError(ErrorCode::SCHEDULE_RUNNING);
+        return;
+    }
+    if (length < 1 || (length - 1) % SCHEDULE_STEP_LENGTH != 0) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    uint8_t first = payload[0];
+    uint8_t count = (length - 1) / SCHEDULE_STEP_LENGTH;
+    if (count > MAX_SCHEDULE_LOAD_STEPS || first + count > MAX_SCHEDULE_STEPS) {
+        sendError(ErrorCode::SCHEDULE_TOO_LARGE);
+        return;
+    }
+
+    // Check every step before storing any of them
+    for (uint8_t i = 0; i < count; i++) {
+        const uint8_t* step = payload + 1 + i * SCHEDULE_STEP_LENGTH;
+        uint8_t command = step[4];
+        if (command != TctlmIds::PIN_MODE && command != TctlmIds::DIGITAL_WRITE && command != TctlmIds::ANALOG_WRITE) {
+            sendError(ErrorCode::UNKNOWN_COMMAND);
+            return;
+        }
+        if (command == TctlmIds::PIN_MODE && step[6] > 4) {
+            sendError(ErrorCode::MODE_GREATER_THAN_FOUR);
+            return;
+        }
+    }
+    for (uint8_t i = 0; i < count; i++) {
+        const uint8_t* step = payload + 1 + i * SCHEDULE_STEP_LENGTH;
+        scheduleSteps[first + i].offsetMs = readU32(step);
+        scheduleSteps[first + i].command = step[4];
+        scheduleSteps[first + i].pin = step[5];
+        scheduleSteps[first + i].value = step[6];
+    }
+    sendTctlmId(TctlmIds::SCHEDULE_LOAD);
+}
+
+// Payload is [steps, runs (u16), period in ms (u32)]
+void handleScheduleStart(const uint8_t* payload, uint8_t length) {
+    if (length != 7) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    if (payload[0] > MAX_SCHEDULE_STEPS) {
+        sendError(ErrorCode::SCHEDULE_TOO_LARGE);
+        return;
+    }
+    scheduleLength = payload[0];
+    scheduleRuns = ((uint16_t)payload[1] << 8) | payload[2];
+    schedulePeriodMs = readU32(payload + 3);
+    scheduleNext = 0;
+    scheduleRunsDone = 0;
+    scheduleMaxLateMs = 0;
+    scheduleRunStartMs = millis();
+    scheduleState = SCHEDULE_RUNNING;
+    sendTctlmId(TctlmIds::SCHEDULE_START);
+}
+
+void handleScheduleStop(const uint8_t* payload, uint8_t length) {
+    if (length != 0) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    if (scheduleState == SCHEDULE_RUNNING) {
+        scheduleState = SCHEDULE_STOPPED;
+    }
+    sendTctlmId(TctlmIds::SCHEDULE_STOP);
+}
+
+void handleScheduleStatus(const uint8_t* payload, uint8_t length) {
+    if (length != 0) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    beginReply(TctlmIds::SCHEDULE_STATUS);
+    appendByte(scheduleState);
+    appendByte(scheduleNext);
+    appendU16(scheduleRunsDone);
+    appendU16(scheduleMaxLateMs);
+    sendFrame();
+}
+
+// Run every step that's due. Called every loop, so steps are late by at most
+// one loop plus however long the frame being handled takes.
+void serviceSchedule() {
+    while (scheduleState == SCHEDULE_RUNNING) {
+        // Signed, since the next run may not have started yet
+        long elapsedMs = (long)(millis() - scheduleRunStartMs);
+
+        if (scheduleNext == scheduleLength) {
+            scheduleRunsDone++;
+            if (scheduleRuns != 0 && scheduleRunsDone >= scheduleRuns) {
+                scheduleState = SCHEDULE_DONE;
+                beginFrame(UNSOLICITED_SEQ, TctlmIds::SCHEDULE_DONE);
+                appendU16(scheduleRunsDone);
+                appendU16(scheduleMaxLateMs);
+                appendU32(millis());
+                sendFrame();
+                return;
+            }
+            // Start the next run a period after this one, not after now, so
+            // lateness doesn't accumulate
+            scheduleRunStartMs += schedulePeriodMs;
+            scheduleNext = 0;
+            continue;
+        }
+
+        ScheduleStep& step = scheduleSteps[scheduleNext];
+        if (elapsedMs < (long)step.offsetMs) {
+            return;
+        }
+        switch (step.command) {
+            case TctlmIds::PIN_MODE:
+                pinMode(step.pin, step.value);
+                break;
+            case TctlmIds::DIGITAL_WRITE:
+                digitalWrite(step.pin, step.value);
+                break;
+            case TctlmIds::ANALOG_WRITE:
+                analogWrite(step.pin, step.value);
+                break;
+        }
+        unsigned long lateMs = elapsedMs - step.offsetMs;
+        if (lateMs > scheduleMaxLateMs) {
+            scheduleMaxLateMs = lateMs > 0xFFFF ? 0xFFFF : lateMs;
+        }
+        scheduleNext++;
+    }
+}
+
+// Payload is [period in us (u32), pin count, pins...]. The reply has the
+// buffer's capacity in samples, which is the host's initial credit.
+void handlePlaybackStart(const uint8_t* payload, uint8_t length) {
+    if (length < 5) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    uint8_t count = payload[4];
+    if (count == 0 || count > MAX_PLAYBACK_PINS) {
+        sendError(ErrorCode::TOO_MANY_PLAYBACK_PINS);
+        return;
+    }
+    if (length != 5 + count) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+
+    playbackPeriodUs = readU32(payload);
+    playbackPinCount = count;
+    for (uint8_t i = 0; i < count; i++) {
+        playbackPins[i] = payload[5 + i];
+    }
+    playbackCapacity = PLAYBACK_BUFFER_BYTES / count;
+    playbackHead = 0;
+    playbackCount = 0;
+    playbackPlayed = 0;
+    playbackUnderruns = 0;
+    playbackFreed = 0;
+    playbackPrimed = false;
+    playbackLastReceived = false;
+    playbackActive = true;
+
+    beginReply(TctlmIds::PLAYBACK_START);
+    appendU16(playbackCapacity);
+    sendFrame();
+}
+
+// Payload is [flags, samples...], each sample one byte per pin
+void handlePlaybackData(const uint8_t* payload, uint8_t length) {
+    if (!playbackActive) {
+        sendError(ErrorCode::NOT_PLAYING);
+        return;
+    }
+    if (length < 1 || length - 1 > MAX_PLAYBACK_CHUNK_BYTES || (length - 1) % playbackPinCount != 0) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    uint8_t count = (length - 1) / playbackPinCount;
+    if (playbackCount + count > playbackCapacity) {
+        // The host sent more than it had credit for
+        sendError(ErrorCode::PLAYBACK_OVERFLOW);
+        return;
+    }
+
+    const uint8_t* samples = payload + 1;
+    for (uint8_t i = 0; i < count; i++) {
+        uint16_t slot = (playbackHead + playbackCount) % playbackCapacity;
+        memcpy(playbackBuffer + slot * playbackPinCount, samples + i * playbackPinCount, playbackPinCount);
+        playbackCount++;
+    }
+    if (payload[0] & PLAYBACK_LAST_CHUNK) {
+        playbackLastReceived = true;
+    }
+    if (!playbackPrimed) {
+        playbackPrimed = true;
+        playbackLastSampleUs = micros() - playbackPeriodUs;
+    }
+    sendTctlmId(TctlmIds::PLAYBACK_DATA);
+}
+
+void handlePlaybackStop(const uint8_t* payload, uint8_t length) {
+    if (length != 0) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    playbackActive = false;
+    beginReply(TctlmIds::PLAYBACK_STOP);
+    appendU32(playbackPlayed);
+    appendU16(playbackUnderruns);
+    sendFrame();
+}
+
+void servicePlayback() {
+    if (!playbackActive || !playbackPrimed) {
+        return;
+    }
+    unsigned long now = micros();
+    if (now - playbackLastSampleUs < playbackPeriodUs) {
+        return;
+    }
+    playbackLastSampleUs += playbackPeriodUs;
+
+    bool finished = false;
+    if (playbackCount > 0) {
+        const uint8_t* sample = playbackBuffer + playbackHead * playbackPinCount;
+        for (uint8_t i = 0; i < playbackPinCount; i++) {
+            analogWrite(playbackPins[i], sample[i]);
+        }
+        playbackHead = (playbackHead + 1) % playbackCapacity;
+        playbackCount--;
+        playbackPlayed++;
+        playbackFreed++;
+    } else if (playbackLastReceived) {
+        playbackActive = false;
+        finished = true;
+    } else if (playbackUnderruns < 0xFFFF) {
+        // Hold the last sample until more arrive
+        playbackUnderruns++;
+    }
+
+    // Grant credit a chunk at a time, so the host can send full frames, and
+    // whenever the buffer runs dry so it learns how far playback got
+    uint8_t chunkSamples = MAX_PLAYBACK_CHUNK_BYTES / playbackPinCount;
+    if (finished || playbackFreed >= chunkSamples || (playbackCount == 0 && playbackFreed > 0)) {
+        beginFrame(UNSOLICITED_SEQ, TctlmIds::PLAYBACK_CREDIT);
+        appendU16(playbackFreed);
+        appendU32(playbackPlayed);
+        appendU16(playbackUnderruns);
+        appendByte(finished ? 1 : 0);
+        sendFrame();
+        playbackFreed = 0;
+    }
+}
+
+// Record an edge on a watched pin. Runs inside an ISR for interrupt driven
+// pins, so it must stay short.
+void recordEdge(WatchSlot& watch, uint8_t edge) {
+    if (watch.pendingEdges == 0) {
+        watch.firstEdge = edge;
+        watch.firstEdgeMs = millis();
+    }
+    if (watch.pendingEdges < 255) {
+        watch.pendingEdges++;
+    }
+}
+
+void onWatchInterrupt(uint8_t slot) {
+    WatchSlot& watch = watches[slot];
+    uint8_t edge = watch.edge;
+    if (edge == EDGE_CHANGE) {
+        // The level just after the change tells which way it went
+        edge = digitalRead(watch.pin) ? EDGE_RISING : EDGE_FALLING;
+    }
+    recordEdge(watch, edge);
+}
+
+// attachInterrupt takes a plain function, so each slot gets its own ISR
+void watchIsr0() { onWatchInterrupt(0); }
+void watchIsr1() { onWatchInterrupt(1); }
+void watchIsr2() { onWatchInterrupt(2); }
+void watchIsr3() { onWatchInterrupt(3); }
+void (*const WATCH_ISRS[MAX_WATCHED_PINS])() = {watchIsr0, watchIsr1, watchIsr2, watchIsr3};
+
+void handleWatchPin(const uint8_t* payload, uint8_t length) {
+    if (length != 2) {
+        sendError(ErrorCode::LENGTH_INCORRECT);
+        return;
+    }
+    uint8_t pin = payload[0];
+    uint8_t edge = payload[1];
+    if (edge > EDGE_CHANGE) {
+        sendError(ErrorCode::INVALID_EDGE);
+        return;
+    }
+
+    // Reuse the pin's slot if it's already watched, otherwise find a free one
+    int8_t slot = -1;
+    for (uint8_t i = 0; i < MAX_WATCHED_PINS; i++) {
+        if (watches[i].active && watches[i].pin == pin) {
+            slot = i;
+            break;
+        }
+        if (!watches[i].active && slot == -1) {
+            slot = i;
+        }
+    }
+
+    if (slot != -1 && watches[slot].active && watches[slot].interruptDriven) {
+        detachInterrupt(digitalPinToInterrupt(pin));
+    }
+    if (edge == EDGE_NONE) {
+        if (slot != -1 && watches[slot].pin == pin) {
+            watches[slot].active = false;
+        }
+        beginReply(TctlmIds::WATCH_PIN);
+        appendByte(0);
+        sendFrame();
+        return;
+    }
+    if (slot == -1) {
+        sendError(ErrorCode::TOO_MANY_WATCHED_PINS);
         return;
     }
-    // Read the start of message byte
-    uint8_t startByte = Serial.read();
 
-    // Ensure the start byte is correct
-    if (startByte != START_OF_MESSAGE) {
-        // If it's not the expected start byte, skip the rest and wait for the next message
-        while (Serial.available()) {
-            Serial.read();
+    WatchSlot& watch = watches[slot];
+    watch.active = true;
+    watch.pin = pin;
+    watch.edge = edge;
+    watch.lastLevel = digitalRead(pin);
+    watch.pendingEdges = 0;
+    uint8_t interrupt = digitalPinToInterrupt(pin);
+    watch.interruptDriven = interrupt != NOT_AN_INTERRUPT;
+    if (watch.interruptDriven) {
+        int mode = edge == EDGE_RISING ? RISING : edge == EDGE_FALLING ? FALLING : CHANGE;
+        attachInterrupt(interrupt, WATCH_ISRS[slot], mode);
+    }
+
+    // Send the response back saying whether the pin is interrupt driven
+    beginReply(TctlmIds::WATCH_PIN);
+    appendByte(watch.interruptDriven ? 1 : 0);
+    sendFrame();
+}
+
+void serviceWatches() {
+    for (uint8_t i = 0; i < MAX_WATCHED_PINS; i++) {
+        WatchSlot& watch = watches[i];
+        if (!watch.active) {
+            continue;
+        }
+
+        if (!watch.interruptDriven) {
+            uint8_t level = digitalRead(watch.pin);
+            if (level != watch.lastLevel) {
+                watch.lastLevel = level;
+                uint8_t edge = level ? EDGE_RISING : EDGE_FALLING;
+                if (watch.edge == EDGE_CHANGE || watch.edge == edge) {
+                    recordEdge(watch, edge);
+                }
+            }
+        }
+
+        // Take the pending edges atomically, since the ISR may add to them
+        noInterrupts();
+        uint8_t edges = watch.pendingEdges;
+        uint8_t firstEdge = watch.firstEdge;
+        unsigned long firstEdgeMs = watch.firstEdgeMs;
+        watch.pendingEdges = 0;
+        interrupts();
+
+        if (edges > 0) {
+            // Push an event frame without waiting to be asked
+            beginFrame(UNSOLICITED_SEQ, TctlmIds::PIN_EVENT);
+            appendByte(watch.pin);
+            appendByte(firstEdge);
+            appendByte(edges);
+            appendU32(firstEdgeMs);
+            sendFrame();
         }
+    }
+}
+
+void serviceStream() {
+    if (streamPinCount == 0 || micros() - streamLastSampleUs < streamPeriodUs) {
+        return;
+    }
+    // Advance by exactly one period so the sample rate doesn't drift
+    streamLastSampleUs += streamPeriodUs;
+
+    // Push a frame with an 8-bit frame counter (so the host can count dropped
+    // frames) followed by one 16-bit sample per pin
+    beginFrame(UNSOLICITED_SEQ, TctlmIds::STREAM_DATA);
+    appendByte(streamFrameCounter++);
+    for (uint8_t i = 0; i < streamPinCount; i++) {
+        appendU16(analogRead(streamPins[i]));
+    }
+    sendFrame();
+}
+
+// Decode, check and run the frame in rxBuffer.
+void handleFrame() {
+    int length = decodeCobs(rxBuffer, rxLength);
+    if (length < FRAME_OVERHEAD) {
+        // Without a valid header there's no sequence ID to reply to, so the
+        // host will time the command out
+        currentSeq = UNSOLICITED_SEQ;
+        sendError(ErrorCode::MALFORMED_FRAME);
         return;
     }
 
+    uint16_t expectedCrc = ((uint16_t)rxBuffer[length - 2] << 8) | rxBuffer[length - 1];
+    if (crc16(rxBuffer, length - 2) != expectedCrc) {
+        // The sequence ID may be the corrupted byte, and replying to it could
+        // fail some other pending command, so the host times this one out
+        currentSeq = UNSOLICITED_SEQ;
+        sendError(ErrorCode::CRC_MISMATCH);
+        return;
+    }
+
+    // Read the sequence ID, which is echoed back in the reply
+    currentSeq = rxBuffer[0];
+
+    // A valid frame proves the host is speaking at the current rate
+    baudUnconfirmed = false;
+
     // Read the command byte (the TctlmId)
-    uint8_t command = Serial.read();
+    uint8_t command = rxBuffer[1];
+    const uint8_t* payload = rxBuffer + 2;
+    uint8_t payloadLength = length - FRAME_OVERHEAD;
 
     // Handle the command based on the TctlmId
     switch (command) {
         case TctlmIds::ACK:
-            handleAck();
+            handleAck(payload, payloadLength);
             break;
 
         case TctlmIds::DIGITAL_READ:
-            handleDigitalRead();
+            handleDigitalRead(payload, payloadLength);
             break;
 
         case TctlmIds::DIGITAL_WRITE:
-            handleDigitalWrite();
+            handleDigitalWrite(payload, payloadLength);
             break;
 
         case TctlmIds::PIN_MODE:
-            handlePinMode();
+            handlePinMode(payload, payloadLength);
             break;
 
         case TctlmIds::ANALOG_READ:
-            handleAnalogRead();
+            handleAnalogRead(payload, payloadLength);
             break;
 
         case TctlmIds::ANALOG_WRITE:
-            handleAnalogWrite();
+            handleAnalogWrite(payload, payloadLength);
             break;
 
         case TctlmIds::DELAY:
-            handleDelay();
+            handleDelay(payload, payloadLength);
             break;
 
         case TctlmIds::MILLIS:
-            handleMillis();
+            handleMillis(payload, payloadLength);
+            break;
+
+        case TctlmIds::BATCH:
+            handleBatch(payload, payloadLength);
+            break;
+
+        case TctlmIds::STREAM_START:
+            handleStreamStart(payload, payloadLength);
+            break;
+
+        case TctlmIds::STREAM_STOP:
+            handleStreamStop(payload, payloadLength);
+            break;
+
+        case TctlmIds::SET_BAUD:
+            handleSetBaud(payload, payloadLength);
+            break;
+
+        case TctlmIds::WATCH_PIN:
+            handleWatchPin(payload, payloadLength);
+            break;
+
+        case TctlmIds::DIGITAL_READ_PINS:
+            handleDigitalReadPins(payload, payloadLength);
+            break;
+
+        case TctlmIds::DIGITAL_WRITE_PINS:
+            handleDigitalWritePins(payload, payloadLength);
+            break;
+
+        case TctlmIds::ANALOG_READ_PINS:
+            handleAnalogReadPins(payload, payloadLength);
+            break;
+
+        case TctlmIds::SCHEDULE_LOAD:
+            handleScheduleLoad(payload, payloadLength);
+            break;
+
+        case TctlmIds::SCHEDULE_START:
+            handleScheduleStart(payload, payloadLength);
+            break;
+
+        case TctlmIds::SCHEDULE_STOP:
+            handleScheduleStop(payload, payloadLength);
+            break;
+
+        case TctlmIds::SCHEDULE_STATUS:
+            handleScheduleStatus(payload, payloadLength);
+            break;
+
+        case TctlmIds::PLAYBACK_START:
+            handlePlaybackStart(payload, payloadLength);
+            break;
+
+        case TctlmIds::PLAYBACK_DATA:
+            handlePlaybackData(payload, payloadLength);
+            break;
+
+        case TctlmIds::PLAYBACK_STOP:
+            handlePlaybackStop(payload, payloadLength);
             break;
 
         default:
@@ -293,3 +1210,49 @@ void loop() {
     }
 }
 
+void setup() {
+    // Initialize serial communication at the default rate. The host may
+    // negotiate a faster one with SET_BAUD.
+    Serial.begin(DEFAULT_BAUD_RATE);
+}
+
+void loop() {
+    // Fall back to the previous baud rate if the host never confirmed a switch
+    serviceBaudRate();
+
+    // Run any scheduled steps and waveform samples that are due first, since
+    // they're the most timing sensitive
+    serviceSchedule();
+    servicePlayback();
+
+    // Report any watched pin changes, then push any analog samples that are
+    // due, before handling commands
+    serviceWatches();
+    serviceStream();
+
+    // Accumulate bytes until a delimiter ends the frame. Only the bytes
+    // already received are read, so streaming never waits on the host.
+    while (Serial.available()) {
+        uint8_t b = Serial.read();
+        if (b != FRAME_DELIMITER) {
+            if (rxLength < RX_BUFFER_LENGTH) {
+                rxBuffer[rxLength++] = b;
+            } else {
+                rxOverflow = true;
+            }
+            continue;
+        }
+
+        if (rxOverflow) {
+            currentSeq = UNSOLICITED_SEQ;
+            sendError(ErrorCode::LENGTH_INCORRECT);
+        } else if (rxLength > 0) {
+            handleFrame();
+        }
+        rxLength = 0;
+        rxOverflow = false;
+
+        // Handle one frame per loop so streaming stays on schedule
+        return;
+    }
+}
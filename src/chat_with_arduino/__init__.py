@@ -1,6 +1,7 @@
-from . import server
-
 def main():
+    # Imported here so that importing the package (eg for the simulator)
+    # doesn't load the MCP SDK
+    from . import server
     server.main()
 
 if __name__ == "__main__":
@@ -0,0 +1,393 @@
+"""Benchmarks the server's tools against a simulated arduino.
+
+    python -m chat_with_arduino.bench
+    python -m chat_with_arduino.bench --save-baseline bench.json
+    python -m chat_with_arduino.bench --baseline bench.json
+    python -m chat_with_arduino.bench --baseline tests/bench_baseline.json --tolerance 1
+
+Reports p50/p99 round-trip latency and commands per second for each tool,
+and how long a freshly launched server takes to answer the MCP initialize
+handshake and list its tools, next to how long importing the MCP SDK alone
+takes. `--importtime 20` also lists the slowest
+imports at startup. With --baseline the run fails (exit code 1) if any tool got
+slower than the baseline by more than --tolerance.
+
+Latencies are also given in ACK round trips, which unlike milliseconds are
+much the same on any machine. `--save-baseline --relative` saves just those,
+as in the baseline committed in tests/, which the test suite checks against.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from . import server
+from .simulator import SimulatedArduino
+
+FQBN = 'arduino:avr:uno'
+
+# How the console script starts the server
+SERVER_COMMAND = [sys.executable, '-c', 'import chat_with_arduino; chat_with_arduino.main()']
+
+INITIALIZE = {
+    'jsonrpc': '2.0',
+    'id': 1,
+    'method': 'initialize',
+    'params': {
+        'protocolVersion': '2024-11-05',
+        'capabilities': {},
+        'clientInfo': {'name': 'chat-with-arduino-bench', 'version': '0'},
+    },
+}
+INITIALIZED = {'jsonrpc': '2.0', 'method': 'notifications/initialized'}
+LIST_TOOLS = {'jsonrpc': '2.0', 'id': 2, 'method': 'tools/list'}
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Case(NamedTuple):
+    # Calls the tool, given the iteration number
+    call: Callable[[int], Awaitable]
+    # Run untimed before each call, eg to start what the call stops
+    setup: Optional[Callable[[int], Awaitable]] = None
+    # Whether the case only takes round trips to the board and work on the
+    # host, so its latency in ACK round trips barely depends on the machine.
+    # Cases that wait on timers or external programs are run but not
+    # compared against a relative baseline.
+    relative: bool = True
+
+
+# Extra ACK round trips allowed over a relative baseline
+ACK_SLACK = 0.5
+
+# Tools that need arduino-cli or real boards, so can't run against the simulator
+UNBENCHMARKED = {
+    'list_arduino_boards',
+    'attach_arduino_boards',
+    'upload_chat_with_arduino_firmware',
+    'flash_boards',
+    'compile_and_upload_arduino_program',
+}
+
+SCHEDULE = [
+    {'at_ms': 0, 'op': 'digital_write', 'pin': 13, 'state': 1},
+    {'at_ms': 1, 'op': 'digital_write', 'pin': 13, 'state': 0},
+]
+
+
+def cases(simulator: SimulatedArduino) -> Dict[str, Case]:
+    """One call of each tool per benchmark, keyed by name. Each takes the
+    iteration number, which alternates written values so that the pin cache
+    can't skip the round trip."""
+
+    async def toggled_pin_change(i: int):
+        # Flip the watched pin once the watch has had time to be armed
+        asyncio.get_running_loop().call_later(0.02, simulator.set_input, 2, (i + 1) % 2)
+        return finished(await server.wait_for_pin_change(2, timeout_s=2))
+
+    async def finished_schedule(i: int):
+        return finished(await server.wait_for_schedule(timeout_s=2))
+
+    start_stream = lambda i: server.start_stream([0, 1], 100)
+    start_schedule = lambda i: server.start_schedule(SCHEDULE)
+    repeat_schedule = lambda i: server.start_schedule(SCHEDULE, runs=0, period_ms=100)
+    play_waveform = lambda i: server.play_waveform([9], 100, shape='sine', duration_s=10)
+
+    return {
+        'ack': Case(lambda i: server.ack()),
+        'millis': Case(lambda i: server.millis()),
+        'board_time': Case(lambda i: server.board_time(1000)),
+        'digital_read': Case(lambda i: server.digital_read(2)),
+        'digital_write': Case(lambda i: server.digital_write(13, i % 2)),
+        'pin_mode': Case(lambda i: server.pin_mode(12, False, ('INPUT', 'OUTPUT')[i % 2])),
+        'analog_read': Case(lambda i: server.analog_read(0)),
+        'analog_write': Case(lambda i: server.analog_write(9, i % 256)),
+        'delay': Case(lambda i: server.delay(0)),
+        'run_batch': Case(lambda i: server.run_batch([
+            {'op': 'digital_write', 'pin': 13, 'state': i % 2},
+            {'op': 'digital_read', 'pin': 2},
+            {'op': 'analog_read', 'pin': 0},
+            {'op': 'millis'},
+        ])),
+        'digital_read_pins': Case(lambda i: server.digital_read_pins()),
+        'digital_write_pins': Case(lambda i: server.digital_write_pins({8: i % 2, 13: i % 2})),
+        'analog_read_pins': Case(lambda i: server.analog_read_pins()),
+        'digital_write_cached': Case(lambda i: server.digital_write(8, 1)),
+        'wait_for_pin_change': Case(toggled_pin_change, relative=False),
+        'unwatch_pin': Case(lambda i: server.unwatch_pin(2), setup=lambda i: server.wait_for_pin_change(2, timeout_s=0.001)),
+        'start_stream': Case(start_stream),
+        'stream_stats': Case(lambda i: server.stream_stats()),
+        'stop_stream': Case(lambda i: server.stop_stream(), setup=start_stream),
+        'list_logs': Case(lambda i: server.list_logs()),
+        'query_log': Case(lambda i: server.query_log(0, True)),
+        'start_schedule': Case(start_schedule),
+        'schedule_status': Case(lambda i: server.schedule_status()),
+        'wait_for_schedule': Case(finished_schedule, setup=start_schedule, relative=False),
+        'stop_schedule': Case(lambda i: server.stop_schedule(), setup=repeat_schedule),
+        'play_waveform': Case(play_waveform),
+        'playback_status': Case(lambda i: server.playback_status()),
+        'stop_playback': Case(lambda i: server.stop_playback(), setup=play_waveform),
+        'list_connections': Case(lambda i: server.list_connections()),
+        'pin_cache_stats': Case(lambda i: server.pin_cache_stats()),
+        'get_metrics': Case(lambda i: server.get_metrics()),
+        'list_devices': Case(lambda i: server.list_devices(), relative=False),
+        'check_arduino_cli': Case(lambda i: server.check_arduino_cli(), relative=False),
+    }
+
+
+async def run_case(case: Case, iterations: int) -> dict:
+    latencies = []
+    for i in range(iterations):
+        if case.setup is not None:
+            failed(await case.setup(i))
+        t = time.perf_counter()
+        result = await case.call(i)
+        latencies.append(time.perf_counter() - t)
+        failed(result)
+    return {
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'commands_per_s': round(iterations / sum(latencies), 1),
+    }
+
+
+def failed(result) -> None:
+    """Raise if a tool call failed, which tools report by returning the error
+    as a string."""
+    if isinstance(result, str):
+        raise RuntimeError(f"Tool failed: {result}")
+
+
+def finished(result):
+    """The result of a wait, which returns None if it timed out."""
+    if result is None:
+        raise RuntimeError("Timed out")
+    return result
+
+
+async def run_pipelined(iterations: int) -> dict:
+    """Throughput with many millis calls in flight at once."""
+    start = time.perf_counter()
+    results = await asyncio.gather(*(server.millis() for _ in range(iterations)))
+    elapsed = time.perf_counter() - start
+    for result in results:
+        failed(result)
+    return {'commands_per_s': round(iterations / elapsed, 1)}
+
+
+def server_env() -> dict:
+    """The environment to launch the server in, importing this copy of the
+    package."""
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    path = os.pathsep.join(p for p in (package_parent, os.environ.get('PYTHONPATH')) if p)
+    return {**os.environ, 'PYTHONPATH': path}
+
+
+def time_startup() -> Tuple[float, float]:
+    """Launch the server and time how long until it answers the initialize
+    handshake, and until it lists its tools."""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        SERVER_COMMAND,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=server_env(),
+    )
+    try:
+        process.stdin.write(json.dumps(INITIALIZE).encode() + b'\n')
+        process.stdin.flush()
+        if not process.stdout.readline():
+            raise RuntimeError("The server exited before answering the handshake")
+        handshake = time.perf_counter() - start
+        process.stdin.write(json.dumps(INITIALIZED).encode() + b'\n' + json.dumps(LIST_TOOLS).encode() + b'\n')
+        process.stdin.flush()
+        if not process.stdout.readline():
+            raise RuntimeError("The server exited before listing its tools")
+        return handshake, time.perf_counter() - start
+    finally:
+        process.kill()
+        process.wait()
+
+
+def time_mcp_import() -> float:
+    """Time launching Python and importing the MCP SDK alone, the least a
+    server built on it can start up in. Like `time_startup`, this stops timing
+    at the first line of output rather than waiting for the interpreter to
+    shut down."""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-c', 'import mcp.server.fastmcp; print(flush=True)'],
+        stdout=subprocess.PIPE,
+        env=server_env(),
+    )
+    try:
+        if not process.stdout.readline():
+            raise RuntimeError("Couldn't import the MCP SDK")
+        return time.perf_counter() - start
+    finally:
+        process.kill()
+        process.wait()
+
+
+def run_startup(runs: int) -> Dict[str, dict]:
+    # Interleaved, so that the machine getting busier doesn't skew the comparison
+    handshakes, listings, mcp_imports = zip(*((*time_startup(), time_mcp_import()) for _ in range(runs)))
+    return {
+        name: {
+            'p50_ms': round(percentile(samples, 0.5) * 1000, 1),
+            'p99_ms': round(percentile(samples, 0.99) * 1000, 1),
+        }
+        for name, samples in (
+            ('startup_handshake', handshakes),
+            ('startup_tools_listed', listings),
+            ('startup_mcp_import', mcp_imports),
+        )
+    }
+
+
+def slowest_imports(count: int) -> List[Tuple[str, float]]:
+    """The modules that take longest to import (including their own imports)
+    when the server starts, as reported by `python -X importtime`."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import chat_with_arduino.server'],
+        capture_output=True,
+        text=True,
+        env=server_env(),
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((fields[2].rstrip(), int(fields[1]) / 1000))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:count]
+
+
+async def run(iterations: int, negotiate_baud: bool, byte_latency_s: float) -> Dict[str, dict]:
+    simulator = SimulatedArduino(byte_latency_s=byte_latency_s, seed=0)
+    port = simulator.start()
+    try:
+        start = time.perf_counter()
+        connected = await server.connect_to_arduino(port, fqbn=FQBN, negotiate_baud=negotiate_baud)
+        if connected is False:
+            raise RuntimeError(f"Couldn't connect to the simulator on {port}")
+        results = {
+            'baud_rate': {'value': connected['baud_rate']},
+            'connect_to_arduino': {'p50_ms': round((time.perf_counter() - start) * 1000, 3)},
+        }
+
+        all_cases = cases(simulator)
+        for name, case in all_cases.items():
+            results[name] = await run_case(case, iterations)
+        results['pipelined_millis'] = await run_pipelined(iterations)
+
+        # Latency in ACK round trips, which is much the same from one machine
+        # to the next, unlike latency in milliseconds
+        ack_ms = results['ack']['p50_ms']
+        for name, case in all_cases.items():
+            if case.relative:
+                results[name]['p50_acks'] = round(results[name]['p50_ms'] / ack_ms, 2)
+        results['pipelined_millis']['acks_per_command'] = round(
+            1000 / results['pipelined_millis']['commands_per_s'] / ack_ms, 2
+        )
+
+        start = time.perf_counter()
+        await server.disconnect_from_arduino()
+        results['disconnect_from_arduino'] = {'p50_ms': round((time.perf_counter() - start) * 1000, 3)}
+        return results
+    finally:
+        await server.disconnect_from_arduino()
+        simulator.close()
+
+
+def relative_baseline(results: Dict[str, dict]) -> Dict[str, dict]:
+    """Just the metrics of `results` measured in ACK round trips, to compare
+    runs on different machines."""
+    return {
+        name: {metric: value for metric, value in metrics.items() if metric.endswith('_acks')}
+        for name, metrics in results.items()
+        if any(metric.endswith('_acks') for metric in metrics)
+    }
+
+
+def regressions(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """Describe every metric that's worse than the baseline by more than
+    `tolerance` (a fraction). Metrics in ACK round trips are also allowed
+    ACK_SLACK more round trips, since those measuring work on the host rather
+    than on the board are a small fraction of a round trip, and that fraction
+    varies with the machine."""
+    found = []
+    for name, metrics in baseline.items():
+        for metric, expected in metrics.items():
+            actual = results.get(name, {}).get(metric)
+            if actual is None or metric == 'value':
+                continue
+            if metric.endswith('_ms') and actual > expected * (1 + tolerance):
+                found.append(f"{name} {metric}: {actual} ms, baseline {expected} ms")
+            elif metric.endswith('_acks') and actual > expected * (1 + tolerance) + ACK_SLACK:
+                found.append(f"{name} {metric}: {actual} ACK round trips, baseline {expected}")
+            elif metric == 'commands_per_s' and actual < expected / (1 + tolerance):
+                found.append(f"{name} {metric}: {actual}, baseline {expected}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat-with-arduino tools against a simulated arduino")
+    parser.add_argument('--iterations', type=int, default=200, help="Calls per tool (default: 200)")
+    parser.add_argument('--no-negotiate', action='store_true', help="Stay at 9600 baud")
+    parser.add_argument('--byte-latency-us', type=float, default=0.0, help="Extra simulated latency per byte")
+    parser.add_argument('--baseline', help="Fail if the results regress against this JSON file")
+    parser.add_argument('--save-baseline', help="Write the results to this JSON file")
+    parser.add_argument(
+        '--relative',
+        action='store_true',
+        help="Save only latencies in ACK round trips, to compare against on other machines",
+    )
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed regression as a fraction (default: 0.25)")
+    parser.add_argument('--startup-runs', type=int, default=5, help="Server launches to time, 0 to skip (default: 5)")
+    parser.add_argument('--importtime', type=int, default=0, metavar='N', help="List the N slowest imports at startup")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.iterations, not args.no_negotiate, args.byte_latency_us / 1_000_000))
+    if args.startup_runs > 0:
+        results.update(run_startup(args.startup_runs))
+
+    print(f"{'benchmark':<24}{'p50 ms':>10}{'p99 ms':>10}{'cmds/s':>10}{'p50 acks':>10}")
+    for name, metrics in results.items():
+        if 'value' in metrics:
+            print(f"{name:<24}{metrics['value']:>30}")
+            continue
+        print(
+            f"{name:<24}{metrics.get('p50_ms', ''):>10}{metrics.get('p99_ms', ''):>10}"
+            f"{metrics.get('commands_per_s', ''):>10}"
+            f"{metrics.get('p50_acks', metrics.get('acks_per_command', '')):>10}"
+        )
+
+    if args.importtime:
+        print(f"\n{'import':<60}{'cumulative ms':>14}")
+        for module, cumulative_ms in slowest_imports(args.importtime):
+            print(f"{module:<60}{cumulative_ms:>14.1f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(relative_baseline(results) if args.relative else results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.tolerance)
+        if found:
+            print("\nRegressions against the baseline:", *found, sep='\n  ')
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Pin maps for the boards the server knows about.
+
+The maps are read once from the bundled boards.json and indexed, so that
+resolving or validating a pin is a dict or set lookup. Supporting a new board
+only needs a new entry in boards.json.
+"""
+import json
+import os
+from functools import lru_cache
+from typing import Dict, FrozenSet, Optional, Tuple
+
+BOARDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'boards.json')
+
+
+class Board:
+    """The pins of one board, as laid out in its core's pins_arduino.h."""
+
+    def __init__(self, fqbn: str, variant: dict):
+        self.fqbn = fqbn
+        self.digital_pins: int = variant['digital_pins']
+        # Maps an analog channel (eg 0 for 'A0') to its pin number
+        self.analog_pins: Tuple[int, ...] = tuple(variant['analog_pins'])
+        # Pins that can only be used with analogRead
+        self.analog_only_pins: FrozenSet[int] = frozenset(variant['analog_only_pins'])
+        self.pwm_pins: FrozenSet[int] = frozenset(variant['pwm_pins'])
+        # Maps each port to the pin on each of its bits, None where the bit
+        # isn't broken out
+        self.ports: Dict[str, Tuple[Optional[int], ...]] = {
+            port: tuple(pins) for port, pins in variant['ports'].items()
+        }
+        # The inverse, mapping each pin to its (port, bit)
+        self.pin_ports: Dict[int, Tuple[str, int]] = {
+            pin: (port, bit)
+            for port, pins in self.ports.items()
+            for bit, pin in enumerate(pins)
+            if pin is not None
+        }
+
+    def resolve_pin(self, pin: int, is_analog: bool) -> int:
+        """Convert a pin as a user names it into the pin number the firmware
+        expects. Analog pins are named by channel, so pin 0 with `is_analog`
+        is 'A0'.
+
+        Raises ValueError if the board has no such pin.
+        """
+        if is_analog:
+            if not 0 <= pin < len(self.analog_pins):
+                raise ValueError(
+                    f"Don't know analog pin {pin} for board {self.fqbn}, it has "
+                    f"analog pins 0-{len(self.analog_pins) - 1}"
+                )
+            return self.analog_pins[pin]
+        if not 0 <= pin < self.digital_pins:
+            raise ValueError(
+                f"Don't know digital pin {pin} for board {self.fqbn}, it has "
+                f"digital pins 0-{self.digital_pins - 1}"
+            )
+        return pin
+
+    def check_digital(self, pin: int) -> None:
+        """Raise ValueError unless the (resolved) pin supports digital I/O."""
+        if pin in self.analog_only_pins:
+            raise ValueError(f"Pin {pin} of board {self.fqbn} can only be used with analog_read")
+
+    def check_pwm(self, pin: int) -> None:
+        """Raise ValueError unless the (resolved) pin supports analogWrite."""
+        if pin not in self.pwm_pins:
+            raise ValueError(
+                f"Pin {pin} of board {self.fqbn} doesn't support PWM. Its PWM "
+                f"pins are {sorted(self.pwm_pins)}"
+            )
+
+
+@lru_cache(maxsize=None)
+def _boards() -> Dict[str, Board]:
+    with open(BOARDS_FILE) as f:
+        data = json.load(f)
+    return {
+        fqbn: Board(fqbn, data['variants'][variant])
+        for fqbn, variant in data['boards'].items()
+    }
+
+
+def find_board(fqbn: Optional[str]) -> Optional[Board]:
+    """Look up a board by FQBN, ignoring any board options (eg
+    'arduino:avr:nano:cpu=atmega328old'). Returns None for unknown boards."""
+    if not fqbn:
+        return None
+    return _boards().get(':'.join(fqbn.split(':')[:3]))
+
+
+def get_board(fqbn: str) -> Board:
+    """Like `find_board`, but raises ValueError for unknown boards."""
+    board = find_board(fqbn)
+    if board is None:
+        raise ValueError(f"Don't know board {fqbn}. Known boards are {sorted(_boards())}")
+    return board
@@ -0,0 +1,234 @@
+"""A content-addressed cache of compiled sketches.
+
+Compiling a sketch takes 10-30 seconds, but uploading an already compiled one
+only takes a few. Builds are keyed by a hash of the sketch's source files, the
+FQBN and the version of the board's core, so resubmitting identical code (or
+re-uploading the bundled firmware) skips straight to `arduino-cli upload`.
+"""
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+CACHE_DIR = Path(
+    os.environ.get('CHAT_WITH_ARDUINO_CACHE_DIR')
+    or Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'chat-with-arduino'
+) / 'builds'
+
+# The cache evicts the least recently used builds once it grows past this.
+MAX_CACHE_BYTES = 200 * 1024 * 1024
+
+# The files that make up a sketch, and so feed into its cache key.
+SKETCH_SUFFIXES = {'.ino', '.pde', '.h', '.hpp', '.c', '.cpp', '.S'}
+
+# The compiler outputs `arduino-cli upload --input-dir` may need. Everything
+# else in the build directory (eg .map files) isn't kept.
+ARTIFACT_SUFFIXES = {'.hex', '.bin', '.elf', '.eep', '.uf2'}
+
+# Builds are compiled into `.building-*` directories in the cache, which
+# eviction removes once they're this old, eg after the server crashed
+# mid-compile. Long enough that no compile still running is touched.
+STALE_BUILDING_S = 3600.0
+
+
+class Build(NamedTuple):
+    returncode: int
+    # Holds the compiler outputs, or None if compiling failed
+    directory: Optional[Path]
+    stdout: str
+    stderr: str
+    # False if `directory` is a temporary one the caller must remove, because
+    # the build couldn't be cached
+    persistent: bool
+    # 0 if the build came from the cache
+    compile_s: float
+
+
+# The installed version of each core, by core id (eg 'arduino:avr'), looked
+# up once per process since `arduino-cli core list` takes a while
+_core_versions: Dict[str, str] = {}
+
+
+def core_version(fqbn: str) -> Optional[str]:
+    """The installed version of the core `fqbn` belongs to, or None if it
+    can't be determined."""
+    core_id = ':'.join(fqbn.split(':')[:2])
+    if core_id not in _core_versions:
+        version = _list_core_version(core_id)
+        if version is None:
+            # Not remembered, in case the core gets installed
+            return None
+        _core_versions[core_id] = version
+    return _core_versions[core_id]
+
+
+def _list_core_version(core_id: str) -> Optional[str]:
+    result = subprocess.run(
+        ['arduino-cli', 'core', 'list', '--format', 'json'],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        return None
+    parsed = json.loads(result.stdout or 'null')
+    # Newer arduino-cli versions wrap the list in {"platforms": [...]} and
+    # rename the keys
+    platforms = parsed.get('platforms', []) if isinstance(parsed, dict) else parsed or []
+    for platform in platforms:
+        if platform.get('id', platform.get('ID')) == core_id:
+            return platform.get('installed_version', platform.get('installed', platform.get('Installed')))
+    return None
+
+
+def sketch_key(sketch_dir: str, fqbn: str, version: str) -> str:
+    """Hash everything that determines the compiled output of a sketch:
+    the files arduino-cli compiles, which are those at the top level of the
+    sketch and those under src/. Other subdirectories (eg the programs in
+    code_written_by_llms/ next to the firmware) don't change the build."""
+    digest = hashlib.sha256()
+    digest.update(f"{fqbn}\0{version}\0".encode())
+    root = Path(sketch_dir)
+    paths = [*root.glob('*'), *(root / 'src').rglob('*')]
+    for path in sorted(paths):
+        if path.is_file() and path.suffix in SKETCH_SUFFIXES:
+            digest.update(f"{path.relative_to(root).as_posix()}\0".encode())
+            digest.update(path.read_bytes())
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class BuildCache:
+    """Compiled sketches on disk, one directory per key. A build's directory
+    mtime records when it was last used, for LRU eviction."""
+
+    def __init__(self, root: Path = CACHE_DIR, max_bytes: int = MAX_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def lookup(self, key: str) -> Optional[Path]:
+        """The directory holding the build for `key`, or None on a miss."""
+        build_dir = self.root / key
+        if not build_dir.is_dir():
+            return None
+        # Mark the build as recently used
+        os.utime(build_dir)
+        return build_dir
+
+    def store(self, key: str, output_dir: Path) -> Path:
+        """Move the compiler outputs in `output_dir` into the cache under
+        `key`, then evict old builds if the cache is over its size limit."""
+        for path in output_dir.iterdir():
+            if path.is_file() and path.suffix not in ARTIFACT_SUFFIXES:
+                path.unlink()
+        build_dir = self.root / key
+        try:
+            # A rename is atomic, so a concurrent lookup never sees a
+            # half-written build
+            output_dir.rename(build_dir)
+        except OSError:
+            if not build_dir.is_dir():
+                raise
+            # Another upload of the same sketch got there first
+            shutil.rmtree(output_dir, ignore_errors=True)
+        os.utime(build_dir)
+        self.evict()
+        return build_dir
+
+    def evict(self) -> None:
+        """Remove the least recently used builds until the cache fits in
+        `max_bytes`, and builds abandoned mid-compile."""
+        builds: List[Tuple[float, int, Path]] = []
+        total = 0
+        now = time.time()
+        for build_dir in self.root.iterdir():
+            if not build_dir.is_dir():
+                continue
+            if build_dir.name.startswith('.building-'):
+                try:
+                    if now - build_dir.stat().st_mtime > STALE_BUILDING_S:
+                        shutil.rmtree(build_dir, ignore_errors=True)
+                except FileNotFoundError:
+                    # Finished (or removed) while being looked at
+                    pass
+                continue
+            if build_dir.name.startswith('.'):
+                continue
+            size = sum(path.stat().st_size for path in build_dir.iterdir() if path.is_file())
+            builds.append((build_dir.stat().st_mtime, size, build_dir))
+            total += size
+        for _, size, build_dir in sorted(builds):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(build_dir, ignore_errors=True)
+            total -= size
+
+    def build(self, sketch_dir: str, fqbn: str) -> Build:
+        """Compile the sketch in `sketch_dir` for `fqbn`, unless there's a
+        cached build of it."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        version = core_version(fqbn)
+        if version is not None:
+            key = sketch_key(sketch_dir, fqbn, version)
+            build_dir = self.lookup(key)
+            if build_dir is not None:
+                return Build(0, build_dir, f"Using cached build {key[:12]}\n", '', True, 0.0)
+
+        output_dir = Path(tempfile.mkdtemp(prefix='.building-', dir=self.root))
+        start = time.monotonic()
+        result = subprocess.run(
+            ['arduino-cli', 'compile', '--fqbn', fqbn, '--output-dir', str(output_dir), sketch_dir],
+            capture_output=True,
+            text=True,
+        )
+        compile_s = time.monotonic() - start
+        if result.returncode != 0:
+            shutil.rmtree(output_dir, ignore_errors=True)
+            return Build(result.returncode, None, result.stdout, result.stderr, False, compile_s)
+        if version is None:
+            # Without the core version a cached build might be stale, so
+            # don't cache it at all
+            return Build(0, output_dir, result.stdout, result.stderr, False, compile_s)
+        try:
+            build_dir = self.store(key, output_dir)
+        except OSError as e:
+            # Eg the cache is on a read-only filesystem. The build still
+            # works, it just isn't cached.
+            return Build(0, output_dir, result.stdout + f"\nCouldn't cache the build: {e}\n", result.stderr, False, compile_s)
+        log = result.stdout + f"\nCached build {key[:12]} (compiled in {compile_s:.1f}s)\n"
+        return Build(0, build_dir, log, result.stderr, True, compile_s)
+
+    def upload(self, build: Build, sketch_dir: str, fqbn: str, port: str) -> Tuple[int, str, str]:
+        """Upload a successful `build` to the board on `port`.
+
+        Returns: The return code, stdout and stderr of arduino-cli.
+        """
+        result = subprocess.run(
+            ['arduino-cli', 'upload', '--fqbn', fqbn, '--port', port, '--input-dir', str(build.directory), sketch_dir],
+            capture_output=True,
+            text=True,
+        )
+        return (result.returncode, result.stdout, result.stderr)
+
+    def compile_and_upload(self, sketch_dir: str, fqbn: str, port: str) -> Tuple[int, str, str]:
+        """Upload the sketch in `sketch_dir` to the board on `port`, compiling
+        it only if there's no cached build of it.
+
+        Returns: The return code, stdout and stderr of arduino-cli.
+        """
+        build = self.build(sketch_dir, fqbn)
+        if build.directory is None:
+            return (build.returncode, build.stdout, build.stderr)
+        try:
+            returncode, stdout, stderr = self.upload(build, sketch_dir, fqbn, port)
+        finally:
+            if not build.persistent:
+                shutil.rmtree(build.directory, ignore_errors=True)
+        return (returncode, build.stdout + stdout, stderr)
+
+
+BUILD_CACHE = BuildCache()
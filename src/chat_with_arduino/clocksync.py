@@ -0,0 +1,210 @@
+"""Synchronisation of a board's millis() clock with the host's monotonic
+clock, so that board timestamps (pin events, schedule reports, logged
+readings) can be placed on the host's timeline, and so aligned across boards.
+
+Every SYNC_INTERVAL_S a burst of MILLIS probes is sent. A board reading was
+taken somewhere between sending its probe and receiving the reply, so it's
+placed at the midpoint, give or take half the round trip. As in NTP, only the
+probe with the shortest round trip of each burst is kept, since it's the
+least disturbed by queueing. The clock's offset is taken from the best recent
+sample, and its drift (ceramic resonators are often out by 0.1-0.5%) from a
+weighted least-squares fit of the samples of the last few minutes.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, NamedTuple, Optional, Tuple
+
+from .protocol import TctlmIds
+from .transport import SerialTransport
+
+logger = logging.getLogger(__name__)
+
+# How often the clocks are compared, and how many probes each comparison sends.
+SYNC_INTERVAL_S = 10.0
+PROBES_PER_SYNC = 4
+
+# Samples kept for estimating drift, and the span they must cover before
+# drift is estimated at all.
+MAX_SAMPLES = 32
+MIN_DRIFT_SPAN_S = 30.0
+
+# The offset comes from the best of this many recent samples.
+OFFSET_SAMPLES = 4
+
+# Assumed until drift has been measured: the worst a ceramic resonator is
+# usually out by.
+UNKNOWN_DRIFT = 0.005
+
+# millis() counts whole milliseconds, and on AVR occasionally skips one.
+MILLIS_RESOLUTION_S = 0.002
+
+# A reading further than this from where the model puts it means the board
+# has reset, so the model starts again.
+RESET_THRESHOLD_S = 1.0
+
+MILLIS_WRAP = 1 << 32
+
+
+class ClockSample(NamedTuple):
+    # Host monotonic time the reading was (most likely) taken at
+    host_s: float
+    # The reading, unwrapped past millis() overflowing, in seconds
+    board_s: float
+    # How far host_s may be out: half the probe's round trip
+    error_s: float
+
+
+class ClockSync:
+    """Estimates one board's clock against the host's, probing it in the
+    background while started."""
+
+    def __init__(
+        self,
+        transport: Callable[[], SerialTransport],
+        on_reset: Optional[Callable[[], None]] = None,
+    ):
+        """
+        Arguments:
+            transport: Returns the board's current transport, which changes
+            when the board is reconnected.
+            on_reset: Called when the board's clock jumps, meaning the board
+            has reset without its port failing.
+        """
+        self._transport = transport
+        self.on_reset = on_reset
+        self.samples: Deque[ClockSample] = deque(maxlen=MAX_SAMPLES)
+        # Board seconds per host second
+        self.rate = 1.0
+        self.rate_error = UNKNOWN_DRIFT
+        self.probes_sent = 0
+        self.resets = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def reset(self) -> None:
+        """Forget everything, eg because the board has reset."""
+        self.samples.clear()
+        self.rate = 1.0
+        self.rate_error = UNKNOWN_DRIFT
+
+    @property
+    def synced(self) -> bool:
+        return bool(self.samples)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                # Eg the board is reconnecting. Try again next time.
+                logger.debug("Clock sync failed: %s", e)
+            await asyncio.sleep(SYNC_INTERVAL_S)
+
+    async def sync(self) -> None:
+        """Probe the board's clock and update the model."""
+        best: Optional[Tuple[float, int, float]] = None
+        for _ in range(PROBES_PER_SYNC):
+            transport = self._transport()
+            sent_s = time.monotonic()
+            (millis,) = await transport.request(TctlmIds.MILLIS)
+            received_s = time.monotonic()
+            self.probes_sent += 1
+            if best is None or received_s - sent_s < best[2] - best[0]:
+                best = (sent_s, millis, received_s)
+        sent_s, millis, received_s = best
+        self.add_sample(millis, (sent_s + received_s) / 2, (received_s - sent_s) / 2)
+
+    def add_sample(self, millis: int, host_s: float, error_s: float) -> None:
+        """Feed in a millis() reading taken at `host_s`, give or take
+        `error_s`."""
+        # Readings are truncated to the millisecond, so the middle of it is
+        # closest on average
+        board_s = self._unwrap(millis) + 0.0005
+        if self.samples and abs(board_s - self._predict_board_s(host_s)) > RESET_THRESHOLD_S:
+            self.resets += 1
+            self.reset()
+            board_s = millis / 1000 + 0.0005
+            if self.on_reset is not None:
+                self.on_reset()
+        self.samples.append(ClockSample(host_s, board_s, error_s))
+        self._fit_rate()
+
+    def _unwrap(self, millis: int) -> float:
+        """`millis` in seconds, past however many overflows put it closest to
+        the latest sample."""
+        if not self.samples:
+            return millis / 1000
+        reference_ms = self.samples[-1].board_s * 1000
+        wraps = round((reference_ms - millis) / MILLIS_WRAP)
+        return (millis + wraps * MILLIS_WRAP) / 1000
+
+    def _anchor(self) -> ClockSample:
+        """The recent sample with the shortest round trip."""
+        recent = list(self.samples)[-OFFSET_SAMPLES:]
+        return min(recent, key=lambda sample: sample.error_s)
+
+    def _fit_rate(self) -> None:
+        first, last = self.samples[0], self.samples[-1]
+        span_s = last.host_s - first.host_s
+        if span_s < MIN_DRIFT_SPAN_S:
+            return
+        # Weighted least squares, trusting quick round trips more
+        weights = [1 / (sample.error_s + MILLIS_RESOLUTION_S) ** 2 for sample in self.samples]
+        total = sum(weights)
+        mean_host = sum(w * s.host_s for w, s in zip(weights, self.samples)) / total
+        mean_board = sum(w * s.board_s for w, s in zip(weights, self.samples)) / total
+        covariance = sum(w * (s.host_s - mean_host) * (s.board_s - mean_board) for w, s in zip(weights, self.samples))
+        variance = sum(w * (s.host_s - mean_host) ** 2 for w, s in zip(weights, self.samples))
+        self.rate = covariance / variance
+        # The slope can be out by at most the errors at each end over the span
+        self.rate_error = (first.error_s + last.error_s + 2 * MILLIS_RESOLUTION_S) / span_s
+
+    def _predict_board_s(self, host_s: float) -> float:
+        anchor = self._anchor()
+        return anchor.board_s + (host_s - anchor.host_s) * self.rate
+
+    def board_millis(self, host_s: Optional[float] = None) -> Optional[int]:
+        """The board's millis() at host monotonic time `host_s` (default:
+        now), or None if the clocks haven't been compared yet."""
+        if not self.samples:
+            return None
+        host_s = time.monotonic() if host_s is None else host_s
+        return int(self._predict_board_s(host_s) * 1000) % MILLIS_WRAP
+
+    def to_host(self, millis: int) -> Optional[Tuple[float, float]]:
+        """The host monotonic time the board's millis() read `millis`, and how
+        far out that may be in seconds. None if the clocks haven't been
+        compared yet."""
+        if not self.samples:
+            return None
+        anchor = self._anchor()
+        board_s = self._unwrap(millis) + 0.0005
+        host_s = anchor.host_s + (board_s - anchor.board_s) / self.rate
+        error_s = anchor.error_s + MILLIS_RESOLUTION_S + self.rate_error * abs(host_s - anchor.host_s)
+        return host_s, error_s
+
+    def describe(self) -> dict:
+        if not self.samples:
+            return {'synced': False, 'probes_sent': self.probes_sent}
+        anchor = self._anchor()
+        return {
+            'synced': True,
+            # Board clock minus host monotonic clock at the best sample
+            'offset_ms': round((anchor.board_s - anchor.host_s) * 1000, 3),
+            'drift_ppm': round((self.rate - 1) * 1_000_000, 1),
+            'drift_error_ppm': round(self.rate_error * 1_000_000, 1),
+            'error_ms': round((anchor.error_s + MILLIS_RESOLUTION_S) * 1000, 3),
+            'samples': len(self.samples),
+            'probes_sent': self.probes_sent,
+            'resets': self.resets,
+        }
@@ -0,0 +1,226 @@
+"""Encoding and decoding of the frames exchanged with the firmware.
+
+A frame is [seq, command, ...payload, crc_high, crc_low] where the CRC is
+CRC-16/CCITT-FALSE over everything before it. On the wire each frame is COBS
+encoded and terminated by a single zero byte. COBS guarantees the encoded
+frame contains no zero bytes, so any payload value can be sent and the reader
+can always resynchronise at the next delimiter.
+"""
+import binascii
+import struct
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from .protocol import ErrorCodes, TctlmIds
+
+FRAME_DELIMITER = 0x00
+
+# seq + command + CRC
+FRAME_OVERHEAD = 4
+
+
+class FrameError(ValueError):
+    """Raised for bytes that don't form a valid frame (bad COBS, bad CRC or
+    too short)."""
+
+
+class ProtocolError(Exception):
+    """Raised when a well-formed frame isn't the reply that was expected,
+    including when the arduino replies with an error code."""
+
+
+class Frame(NamedTuple):
+    seq: int
+    command: int
+    payload: memoryview
+
+
+# The payload of each command's request, as packed by `pack_request`.
+REQUEST_LAYOUTS: Dict[TctlmIds, struct.Struct] = {
+    TctlmIds.ACK: struct.Struct('>'),
+    TctlmIds.DIGITAL_READ: struct.Struct('>B'),   # pin
+    TctlmIds.DIGITAL_WRITE: struct.Struct('>BB'), # pin, state
+    TctlmIds.PIN_MODE: struct.Struct('>BB'),      # pin, mode
+    TctlmIds.ANALOG_READ: struct.Struct('>B'),    # pin
+    TctlmIds.ANALOG_WRITE: struct.Struct('>BB'),  # pin, value
+    TctlmIds.DELAY: struct.Struct('>I'),          # milliseconds
+    TctlmIds.MILLIS: struct.Struct('>'),
+    TctlmIds.STREAM_STOP: struct.Struct('>'),
+    TctlmIds.SET_BAUD: struct.Struct('>I'),       # baud rate
+    TctlmIds.WATCH_PIN: struct.Struct('>BB'),     # pin, edge
+    TctlmIds.SCHEDULE_START: struct.Struct('>BHI'), # steps, runs (0 for forever), period in ms
+    TctlmIds.SCHEDULE_STOP: struct.Struct('>'),
+    TctlmIds.SCHEDULE_STATUS: struct.Struct('>'),
+    TctlmIds.PLAYBACK_STOP: struct.Struct('>'),
+}
+
+# One step of a SCHEDULE_LOAD: offset in ms from the start of the run, then
+# a PIN_MODE, DIGITAL_WRITE or ANALOG_WRITE with its two arguments. The
+# payload is the index of the first step followed by up to
+# MAX_SCHEDULE_LOAD_STEPS steps.
+SCHEDULE_STEP = struct.Struct('>IBBB')
+
+# The payload of each command's reply, as unpacked by `unpack_reply`.
+REPLY_LAYOUTS: Dict[TctlmIds, struct.Struct] = {
+    TctlmIds.ERR: struct.Struct('>B'),            # error code
+    TctlmIds.ACK: struct.Struct('>B'),            # protocol version
+    TctlmIds.DIGITAL_READ: struct.Struct('>B'),   # 0 or 1
+    TctlmIds.DIGITAL_WRITE: struct.Struct('>'),
+    TctlmIds.PIN_MODE: struct.Struct('>'),
+    TctlmIds.ANALOG_READ: struct.Struct('>H'),    # 10-bit reading
+    TctlmIds.ANALOG_WRITE: struct.Struct('>'),
+    TctlmIds.DELAY: struct.Struct('>'),
+    TctlmIds.MILLIS: struct.Struct('>I'),         # milliseconds since boot
+    TctlmIds.STREAM_START: struct.Struct('>'),
+    TctlmIds.STREAM_STOP: struct.Struct('>'),
+    TctlmIds.SET_BAUD: struct.Struct('>'),
+    TctlmIds.WATCH_PIN: struct.Struct('>B'),      # 1 if interrupt driven, 0 if polled
+    # Pushed unsolicited: pin, edge, edges seen since the last event, and
+    # millis() at the first of them
+    TctlmIds.PIN_EVENT: struct.Struct('>BBBI'),
+    TctlmIds.DIGITAL_WRITE_PINS: struct.Struct('>'),
+    TctlmIds.SCHEDULE_LOAD: struct.Struct('>'),
+    TctlmIds.SCHEDULE_START: struct.Struct('>'),
+    TctlmIds.SCHEDULE_STOP: struct.Struct('>'),
+    # State, next step, runs completed, and the latest any step ran in ms
+    TctlmIds.SCHEDULE_STATUS: struct.Struct('>BBHH'),
+    # Pushed unsolicited when the last run ends: runs completed, the latest
+    # any step ran in ms, and millis() at the end
+    TctlmIds.SCHEDULE_DONE: struct.Struct('>HHI'),
+    TctlmIds.PLAYBACK_START: struct.Struct('>H'),   # buffer capacity in samples
+    TctlmIds.PLAYBACK_DATA: struct.Struct('>'),
+    TctlmIds.PLAYBACK_STOP: struct.Struct('>IH'),   # samples played, underruns
+    # Pushed unsolicited as samples are played: credits (samples freed since
+    # the last credit), samples played, underruns, and 1 once the last
+    # sample has played
+    TctlmIds.PLAYBACK_CREDIT: struct.Struct('>HIHB'),
+}
+
+# The result each operation contributes to a BATCH reply.
+BATCH_RESULT_FORMATS: Dict[TctlmIds, str] = {
+    TctlmIds.PIN_MODE: '',
+    TctlmIds.DIGITAL_WRITE: '',
+    TctlmIds.ANALOG_WRITE: '',
+    TctlmIds.DIGITAL_READ: 'B',
+    TctlmIds.ANALOG_READ: 'H',
+    TctlmIds.MILLIS: 'I',
+}
+
+
+@lru_cache(maxsize=256)
+def batch_reply_layout(commands: Sequence[TctlmIds]) -> struct.Struct:
+    """The layout of the reply to a batch of `commands` (a tuple)."""
+    return struct.Struct('>' + ''.join(BATCH_RESULT_FORMATS[c] for c in commands))
+
+
+def pack_pin_mask(pins: Iterable[int]) -> Tuple[int, bytes]:
+    """Pack pins as the (first pin, bitmask) the bulk digital commands take.
+    Bit 0 of the first mask byte is the first pin, bit 1 the pin after it,
+    and so on."""
+    pins = sorted(set(pins))
+    first_pin = pins[0]
+    mask = bytearray((pins[-1] - first_pin) // 8 + 1)
+    for pin in pins:
+        offset = pin - first_pin
+        mask[offset // 8] |= 1 << (offset % 8)
+    return first_pin, bytes(mask)
+
+
+def unpack_pin_mask(first_pin: int, mask: Union[bytes, memoryview]) -> List[int]:
+    """Inverse of `pack_pin_mask`: the pins whose bits are set."""
+    return [
+        first_pin + i * 8 + bit
+        for i, byte in enumerate(mask)
+        for bit in range(8)
+        if byte & (1 << bit)
+    ]
+
+
+def crc16(data: Union[bytes, memoryview]) -> int:
+    """CRC-16/CCITT-FALSE, matching `crc16()` in the firmware."""
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def cobs_encode(data: Union[bytes, memoryview]) -> bytes:
+    """Consistent Overhead Byte Stuffing: rewrite `data` so it contains no
+    zero bytes, at a cost of one byte per 254."""
+    out = bytearray()
+    for block in bytes(data).split(b'\x00'):
+        # Runs of 254 non-zero bytes get a code of 0xFF, which implies no zero
+        while len(block) >= 254:
+            out.append(0xFF)
+            out += block[:254]
+            block = block[254:]
+        out.append(len(block) + 1)
+        out += block
+    return bytes(out)
+
+
+def cobs_decode(data: Union[bytes, memoryview]) -> bytes:
+    """Inverse of `cobs_encode`. Raises FrameError if `data` isn't valid
+    COBS."""
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        code = data[i]
+        end = i + code
+        if code == 0 or end > n:
+            raise FrameError(f"Invalid COBS block at byte {i}")
+        out += data[i + 1:end]
+        i = end
+        if code != 0xFF and i < n:
+            out.append(0)
+    return bytes(out)
+
+
+def encode_frame(seq: int, command: int, payload: Union[bytes, memoryview] = b'') -> bytes:
+    """Build the bytes to put on the wire, including the trailing delimiter."""
+    raw = bytes([seq, command]) + bytes(payload)
+    raw += crc16(raw).to_bytes(2, 'big')
+    return cobs_encode(raw) + bytes([FRAME_DELIMITER])
+
+
+def decode_frame(encoded: Union[bytes, memoryview]) -> Frame:
+    """Decode one frame, excluding its delimiter. The payload is a view into
+    the decoded buffer, so unpacking it doesn't copy."""
+    raw = memoryview(cobs_decode(encoded))
+    if len(raw) < FRAME_OVERHEAD:
+        raise FrameError(f"Frame is {len(raw)} bytes, but must be at least {FRAME_OVERHEAD}")
+    expected_crc = int.from_bytes(raw[-2:], 'big')
+    if crc16(raw[:-2]) != expected_crc:
+        raise FrameError("Frame failed its CRC check")
+    return Frame(raw[0], raw[1], raw[2:-2])
+
+
+def pack_request(command: TctlmIds, *args: int) -> bytes:
+    return REQUEST_LAYOUTS[command].pack(*args)
+
+
+def unpack_reply(command: TctlmIds, frame: Frame, layout: Optional[struct.Struct] = None) -> tuple:
+    """Check that `frame` is a successful reply to `command` and unpack its
+    payload, using the command's entry in REPLY_LAYOUTS unless a `layout` is
+    given.
+
+    Raises ProtocolError if the arduino replied with an error or the reply
+    doesn't match the expected layout.
+    """
+    if frame.command == TctlmIds.ERR.value and len(frame.payload) == 1:
+        code = frame.payload[0]
+        try:
+            name = ErrorCodes(code).name
+        except ValueError:
+            name = 'UNKNOWN'
+        raise ProtocolError(f"Received an error code: {code} ({name})")
+    if frame.command != command.value:
+        raise ProtocolError(
+            f"Expected a reply to {command.name} ({command.value}), but got command {frame.command}"
+        )
+    if layout is None:
+        layout = REPLY_LAYOUTS[command]
+    if len(frame.payload) != layout.size:
+        raise ProtocolError(
+            f"Expected the {command.name} reply payload to be {layout.size} bytes, "
+            f"but was {len(frame.payload)}: {bytes(frame.payload)}"
+        )
+    return layout.unpack_from(frame.payload)
@@ -0,0 +1,263 @@
+"""A persistent log of every pin reading, for querying long captures later
+without handing raw samples to the LLM.
+
+Each board gets a directory, and each channel (eg 'A0' or 'D2') a directory
+in that of fixed-size segment files. A segment is a 16 byte header followed
+by fixed-size records of (host time, board millis, value), and is named by
+the host time of its first record, so the segments covering a time window
+are found from their names alone. Records within a segment are appended in
+time order, so a window's edges are found by binary search. Segments are
+memory-mapped: appending is a struct pack into the map, and queries read
+only the records in the window.
+"""
+import mmap
+import os
+import re
+import struct
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+LOG_DIR = Path(
+    os.environ.get('CHAT_WITH_ARDUINO_DATA_DIR')
+    or Path(os.environ.get('XDG_DATA_HOME') or Path.home() / '.local' / 'share') / 'chat-with-arduino'
+) / 'logs'
+
+# host time (seconds since the epoch), board millis, value
+RECORD = struct.Struct('<dIH2x')
+
+# magic, format version, record size, records written
+HEADER = struct.Struct('<4sHHI4x')
+MAGIC = b'CWAL'
+FORMAT_VERSION = 1
+
+# 1 MiB per segment
+SEGMENT_RECORDS = 65536
+SEGMENT_BYTES = HEADER.size + SEGMENT_RECORDS * RECORD.size
+
+# The oldest segments of a channel are deleted past this many.
+MAX_SEGMENTS = 64
+
+# Board millis of readings taken when the board's clock wasn't known.
+UNKNOWN_MILLIS = 0xFFFFFFFF
+
+# Records unpacked at a time while scanning a window.
+SCAN_CHUNK_RECORDS = 4096
+
+
+class Segment:
+    def __init__(self, path: Path, first_time: Optional[float] = None):
+        """Open the segment at `path`, or create it if `first_time` (the host
+        time of its first record) is given."""
+        self.path = path
+        if first_time is not None:
+            with open(path, 'wb') as f:
+                f.truncate(SEGMENT_BYTES)
+                f.write(HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size, 0))
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, version, record_size, self.count = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != FORMAT_VERSION or record_size != RECORD.size:
+            self.close()
+            raise ValueError(f"{path} isn't a version {FORMAT_VERSION} log segment")
+
+    @property
+    def full(self) -> bool:
+        return self.count >= SEGMENT_RECORDS
+
+    def append(self, host_time: float, board_millis: int, value: int) -> None:
+        RECORD.pack_into(self._map, HEADER.size + self.count * RECORD.size, host_time, board_millis, value)
+        self.count += 1
+        HEADER.pack_into(self._map, 0, MAGIC, FORMAT_VERSION, RECORD.size, self.count)
+
+    def time_at(self, index: int) -> float:
+        return struct.unpack_from('<d', self._map, HEADER.size + index * RECORD.size)[0]
+
+    def bisect(self, host_time: float) -> int:
+        """The index of the first record at or after `host_time`."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.time_at(middle) < host_time:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def scan(self, start: float, end: float) -> Iterator[Tuple[float, int, int]]:
+        """The records from `start` to `end` (host times), in order."""
+        first, last = self.bisect(start), self.bisect(end)
+        for chunk in range(first, last, SCAN_CHUNK_RECORDS):
+            stop = min(last, chunk + SCAN_CHUNK_RECORDS)
+            view = self._map[HEADER.size + chunk * RECORD.size:HEADER.size + stop * RECORD.size]
+            yield from RECORD.iter_unpack(view)
+
+    def close(self) -> None:
+        self._map.close()
+        self._file.close()
+
+
+def segment_time(path: Path) -> float:
+    """The host time of a segment's first record, from its name."""
+    return int(path.stem) / 1_000_000
+
+
+class Channel:
+    """The log of one pin of one board."""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        directory.mkdir(parents=True, exist_ok=True)
+        self._tail: Optional[Segment] = None
+
+    def segments(self) -> List[Path]:
+        return sorted(self.directory.glob('*.seg'))
+
+    def append(self, host_time: float, board_millis: int, value: int) -> None:
+        if self._tail is None:
+            paths = self.segments()
+            if paths:
+                self._tail = Segment(paths[-1])
+        if self._tail is None or self._tail.full:
+            if self._tail is not None:
+                self._tail.close()
+            self._tail = Segment(self.directory / f"{int(host_time * 1_000_000):020d}.seg", host_time)
+            self._evict()
+        self._tail.append(host_time, board_millis, value)
+
+    def _evict(self) -> None:
+        for path in self.segments()[:-MAX_SEGMENTS]:
+            path.unlink()
+
+    def scan(self, start: float, end: float) -> Iterator[Tuple[float, int, int]]:
+        """The records from `start` to `end` (host times), in order, opening
+        only the segments that overlap the window."""
+        paths = self.segments()
+        for i, path in enumerate(paths):
+            if segment_time(path) >= end:
+                break
+            if i + 1 < len(paths) and segment_time(paths[i + 1]) <= start:
+                continue
+            if self._tail is not None and path == self._tail.path:
+                yield from self._tail.scan(start, end)
+                continue
+            segment = Segment(path)
+            try:
+                yield from segment.scan(start, end)
+            finally:
+                segment.close()
+
+    def describe(self) -> dict:
+        paths = self.segments()
+        if not paths:
+            return {'records': 0}
+        tail = self._tail if self._tail is not None and self._tail.path == paths[-1] else Segment(paths[-1])
+        try:
+            records = (len(paths) - 1) * SEGMENT_RECORDS + tail.count
+            last = tail.time_at(tail.count - 1) if tail.count else segment_time(paths[-1])
+        finally:
+            if tail is not self._tail:
+                tail.close()
+        return {
+            'records': records,
+            'first_time': segment_time(paths[0]),
+            'last_time': last,
+        }
+
+    def close(self) -> None:
+        if self._tail is not None:
+            self._tail.close()
+            self._tail = None
+
+
+def summarize_window(
+    records: Iterator[Tuple[float, int, int]],
+    start: float,
+    end: float,
+    buckets: int,
+    threshold: Optional[float],
+    max_crossings: int = 20,
+) -> dict:
+    """Reduce the records of a window in a single pass: overall statistics,
+    the mean of each of `buckets` equal slices of the window, and the times
+    the value crossed `threshold`."""
+    count = 0
+    total = 0
+    low = high = None
+    sums = [0] * buckets
+    counts = [0] * buckets
+    crossings = []
+    crossing_count = 0
+    previous = None
+    bucket_s = (end - start) / buckets
+
+    for host_time, board_millis, value in records:
+        count += 1
+        total += value
+        low = value if low is None or value < low else low
+        high = value if high is None or value > high else high
+        bucket = min(buckets - 1, int((host_time - start) / bucket_s))
+        sums[bucket] += value
+        counts[bucket] += 1
+        if threshold is not None and previous is not None and (previous < threshold) != (value < threshold):
+            crossing_count += 1
+            if len(crossings) < max_crossings:
+                crossings.append({
+                    'time': round(host_time, 3),
+                    'board_millis': None if board_millis == UNKNOWN_MILLIS else board_millis,
+                    'direction': 'rising' if value >= threshold else 'falling',
+                })
+        previous = value
+
+    if count == 0:
+        return {'count': 0}
+
+    summary = {
+        'count': count,
+        'min': low,
+        'max': high,
+        'mean': total / count,
+        'bucket_s': round(bucket_s, 3),
+        # None for slices without readings
+        'decimated': [round(s / n, 1) if n else None for s, n in zip(sums, counts)],
+    }
+    if threshold is not None:
+        summary['crossings'] = crossing_count
+        summary['first_crossings'] = crossings
+    return summary
+
+
+class DataLog:
+    """The logs of one board, one channel per pin."""
+
+    def __init__(self, board: str, root: Path = LOG_DIR):
+        # Ports like /dev/ttyACM0 make awkward directory names
+        self.directory = root / (re.sub(r'[^\w.-]+', '_', board).strip('_') or 'board')
+        self._channels: Dict[str, Channel] = {}
+
+    def channel(self, name: str) -> Channel:
+        channel = self._channels.get(name)
+        if channel is None:
+            channel = self._channels[name] = Channel(self.directory / name)
+        return channel
+
+    def record(self, name: str, value: int, board_millis: Optional[int] = None) -> None:
+        """Append a reading of channel `name` (eg 'A0' or 'D2'), taken now."""
+        millis = UNKNOWN_MILLIS if board_millis is None else board_millis & 0xFFFFFFFF
+        self.channel(name).append(time.time(), millis, value)
+
+    def channels(self) -> List[str]:
+        if not self.directory.exists():
+            return []
+        return sorted(path.name for path in self.directory.iterdir() if path.is_dir())
+
+    def close(self) -> None:
+        for channel in self._channels.values():
+            channel.close()
+        self._channels.clear()
+
+
+def channel_name(pin: int, is_analog: bool) -> str:
+    """How a reading's channel is named: by analog pin (eg 'A0') or by
+    digital pin (eg 'D2')."""
+    return f"A{pin}" if is_analog else f"D{pin}"
@@ -0,0 +1,156 @@
+"""A cached inventory of serial ports and the Arduino boards on them.
+
+Enumerating ports takes a few milliseconds, but `arduino-cli board list`
+takes hundreds, so tools answer from the inventory instead of asking every
+time. A background task started by the first lookup re-enumerates the ports
+every PORT_POLL_INTERVAL_S, and re-runs arduino-cli (without blocking the
+event loop) whenever a port appears or disappears, or every
+BOARD_REFRESH_INTERVAL_S otherwise.
+"""
+import asyncio
+import json
+import time
+from typing import Callable, List, Optional, Tuple, Union
+
+# How often the port list is checked for hotplugged boards.
+PORT_POLL_INTERVAL_S = 1.0
+
+# How often arduino-cli is re-run when no port has changed.
+BOARD_REFRESH_INTERVAL_S = 30.0
+
+
+async def run_arduino_cli(*args: str) -> Tuple[int, str, str]:
+    """Run arduino-cli without blocking the event loop. Returns its return
+    code, stdout and stderr. Raises FileNotFoundError if it isn't
+    installed."""
+    process = await asyncio.create_subprocess_exec(
+        'arduino-cli', *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    return process.returncode, stdout.decode(errors='replace'), stderr.decode(errors='replace')
+
+
+def parse_board_list(stdout: str) -> List[dict]:
+    """Pick the boards out of `arduino-cli board list --json`."""
+    boards = []
+    for entry in json.loads(stdout).get("detected_ports", []):
+        for board in entry.get("matching_boards", []):
+            boards.append({
+                "port": entry["port"]["address"],
+                "board_name": board["name"],
+                "fqbn": board["fqbn"],
+            })
+    return boards
+
+
+class Discovery:
+    def __init__(self, on_change: Optional[Callable[[List[str], List[str]], None]] = None):
+        """
+        Arguments:
+            on_change: Called on the event loop with the ports that appeared
+            and disappeared, whenever the port list changes.
+        """
+        self.on_change = on_change
+        # (device, description) of every serial port
+        self.ports: List[Tuple[str, str]] = []
+        # The boards arduino-cli found, or why it couldn't be run
+        self.boards: Union[List[dict], str] = []
+        # (True, `arduino-cli version` output) or (False, the error)
+        self.cli: Tuple[bool, str] = (False, "arduino-cli hasn't been checked yet")
+        self.ports_refreshed_at = 0.0
+        self.boards_refreshed_at = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def start(self) -> None:
+        """Start the background refresh, if it isn't running, and wait for
+        the first inventory."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._ready = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = asyncio.ensure_future(self._run())
+        await self._ready.wait()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._poll()
+            except Exception as e:
+                self.boards = f"Discovery failed: {e}"
+            self._ready.set()
+            await asyncio.sleep(PORT_POLL_INTERVAL_S)
+
+    async def _poll(self) -> None:
+        async with self._lock:
+            changed = await self._refresh_ports()
+            if changed or time.monotonic() - self.boards_refreshed_at > BOARD_REFRESH_INTERVAL_S:
+                await self._refresh_boards()
+
+    async def refresh(self) -> None:
+        """Refresh the whole inventory now, checking arduino-cli again too."""
+        await self.start()
+        async with self._lock:
+            await self._refresh_ports()
+            await self._refresh_boards(check_cli=True)
+
+    async def _refresh_ports(self) -> bool:
+        """Re-enumerate the ports. Returns True if they changed."""
+        # Imported on first use, since nothing else needs it at startup
+        import serial.tools.list_ports
+        found = await asyncio.to_thread(serial.tools.list_ports.comports)
+        ports = [(port.device, port.description) for port in found]
+        self.ports_refreshed_at = time.monotonic()
+        before = {device for device, _ in self.ports}
+        after = {device for device, _ in ports}
+        self.ports = ports
+        if before == after:
+            return False
+        if self.on_change is not None and self.boards_refreshed_at:
+            self.on_change(sorted(after - before), sorted(before - after))
+        return True
+
+    async def _refresh_boards(self, check_cli: bool = False) -> None:
+        """Re-run `arduino-cli board list`. arduino-cli is checked first if
+        `check_cli` or it wasn't found last time."""
+        self.boards_refreshed_at = time.monotonic()
+        if check_cli or not self.cli[0]:
+            self.cli = await self._check_cli()
+            if not self.cli[0]:
+                self.boards = self.cli[1]
+                return
+        try:
+            returncode, stdout, stderr = await run_arduino_cli('board', 'list', '--json')
+            if returncode != 0:
+                self.boards = f"Return code is {returncode}, stderr: {stderr}"
+            else:
+                self.boards = parse_board_list(stdout)
+        except FileNotFoundError as e:
+            # Uninstalled since it was checked
+            self.cli = (False, str(e))
+            self.boards = str(e)
+        except Exception as e:
+            self.boards = str(e)
+
+    async def _check_cli(self) -> Tuple[bool, str]:
+        try:
+            returncode, stdout, stderr = await run_arduino_cli('version')
+            if returncode == 0:
+                return (True, stdout)
+            return (False, f"returncode is {returncode}, stderr: {stderr}")
+        except Exception as e:
+            return (False, str(e))
+
+    def describe(self) -> dict:
+        now = time.monotonic()
+        return {
+            'ports': [{'port': device, 'description': description} for device, description in self.ports],
+            'boards': self.boards,
+            'ports_age_s': round(now - self.ports_refreshed_at, 3) if self.ports_refreshed_at else None,
+            'boards_age_s': round(now - self.boards_refreshed_at, 3) if self.boards_refreshed_at else None,
+        }
@@ -0,0 +1,107 @@
+import asyncio
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from .codec import Frame, ProtocolError, unpack_reply
+from .protocol import PIN_EDGES, TctlmIds
+
+RISING = PIN_EDGES['RISING']
+FALLING = PIN_EDGES['FALLING']
+CHANGE = PIN_EDGES['CHANGE']
+
+EDGE_NAMES = {value: name for name, value in PIN_EDGES.items()}
+
+# How many recent events each board keeps for the events resource.
+EVENT_HISTORY = 100
+
+
+class PinEvent(NamedTuple):
+    pin: int
+    edge: int
+    # Edges seen since the previous event. More than 1 means pulses were
+    # shorter than the firmware's loop and got merged into one event.
+    edges: int
+    board_millis: int
+    received_at: float
+
+    def describe(self) -> dict:
+        return {
+            'pin': self.pin,
+            'edge': EDGE_NAMES.get(self.edge, str(self.edge)),
+            'edges': self.edges,
+            'board_millis': self.board_millis,
+            'received_at': self.received_at,
+        }
+
+
+def matches(edge: int, event: PinEvent) -> bool:
+    """Whether `event` satisfies a wait for `edge`."""
+    # Several merged edges on one pin mean it went both ways
+    return edge == CHANGE or event.edge == edge or event.edges > 1
+
+
+class PinWatcher:
+    """Demultiplexes the PIN_EVENT frames one board pushes, waking whichever
+    `wait_for_pin_change` calls are waiting on that pin.
+
+    Must be created on the event loop. Frames arrive on the transport's reader
+    thread and are handed over to the loop.
+    """
+
+    def __init__(self, on_event: Optional[Callable[[PinEvent], None]] = None):
+        self._loop = asyncio.get_running_loop()
+        self._on_event = on_event
+        self._waiters: Dict[int, List[Tuple[int, asyncio.Future]]] = {}
+        # The edge armed on the firmware for each pin, and whether it's
+        # detected with an interrupt (or by polling)
+        self.armed: Dict[int, int] = {}
+        self.interrupt_driven: Dict[int, bool] = {}
+        self.history: Deque[PinEvent] = deque(maxlen=EVENT_HISTORY)
+        self.malformed_events = 0
+
+    def ingest(self, frame: Frame) -> None:
+        """Called from the transport's reader thread."""
+        try:
+            pin, edge, edges, board_millis = unpack_reply(TctlmIds.PIN_EVENT, frame)
+        except ProtocolError:
+            self.malformed_events += 1
+            return
+        event = PinEvent(pin, edge, edges, board_millis, time.time())
+        self._loop.call_soon_threadsafe(self._deliver, event)
+
+    def _deliver(self, event: PinEvent) -> None:
+        self.history.append(event)
+        waiters = self._waiters.get(event.pin)
+        if waiters:
+            remaining = []
+            for edge, future in waiters:
+                if future.done():
+                    continue
+                if matches(edge, event):
+                    future.set_result(event)
+                else:
+                    remaining.append((edge, future))
+            self._waiters[event.pin] = remaining
+        if self._on_event is not None:
+            self._on_event(event)
+
+    def wait(self, pin: int, edge: int) -> asyncio.Future:
+        """A future resolved with the next event on `pin` matching `edge`.
+        Pass it to `cancel` once done with it."""
+        future = self._loop.create_future()
+        self._waiters.setdefault(pin, []).append((edge, future))
+        return future
+
+    def cancel(self, pin: int, future: asyncio.Future) -> None:
+        future.cancel()
+        self._waiters[pin] = [(e, f) for e, f in self._waiters.get(pin, []) if f is not future]
+
+    def edge_to_arm(self, pin: int, edge: int) -> Optional[int]:
+        """The edge the firmware needs to watch `pin` for so that `edge` is
+        seen, or None if what's armed already covers it."""
+        armed = self.armed.get(pin)
+        if armed == edge or armed == CHANGE:
+            return None
+        # Watching for both edges covers whatever was armed before
+        return edge if armed is None else CHANGE
@@ -0,0 +1,187 @@
+"""Lightweight latency and traffic instrumentation.
+
+Every tool is wrapped with `timed`, which records its latency into a
+histogram, and every transport counts its bytes, timeouts and errors in a
+LinkStats. Recording is a couple of counter increments and a bisect over
+fixed buckets, well under a microsecond per call.
+"""
+import functools
+import json
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple
+
+# Upper bounds of the histogram buckets, in seconds. Spans a fast serial
+# round trip up to a slow compile and upload.
+BUCKET_BOUNDS: Tuple[float, ...] = (
+    0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+PROMETHEUS_PREFIX = 'chat_with_arduino'
+
+
+class Histogram:
+    """Counts of observations in fixed buckets, plus their sum and range."""
+
+    __slots__ = ('counts', 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        # The last bucket counts everything above the largest bound
+        self.counts: List[int] = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction: float) -> float:
+        """Estimate a quantile by interpolating linearly within the bucket
+        it falls in, as Prometheus does. The bucket is narrowed to the range
+        actually observed, so eg a single observation is its own quantile."""
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = max(BUCKET_BOUNDS[i - 1] if i else 0.0, self.min)
+                high = min(BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max, self.max)
+                return low + (high - low) * max(0.0, rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'mean_ms': round(self.sum / self.count * 1000, 3) if self.count else None,
+            'p50_ms': round(self.quantile(0.5) * 1000, 3),
+            'p90_ms': round(self.quantile(0.9) * 1000, 3),
+            'p99_ms': round(self.quantile(0.99) * 1000, 3),
+        }
+
+
+class LinkStats:
+    """Traffic on one serial port. Survives reconnects to the same port."""
+
+    def __init__(self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.timeouts = 0
+        # Replies with the ERR command
+        self.protocol_errors = 0
+        # Frames thrown away because of bad COBS encoding or a bad CRC
+        self.frames_rejected = 0
+        # Round trip time of each command, keyed by command name
+        self.commands: Dict[str, Histogram] = {}
+
+    def command(self, name: str) -> Histogram:
+        histogram = self.commands.get(name)
+        if histogram is None:
+            histogram = self.commands[name] = Histogram()
+        return histogram
+
+    def summary(self) -> dict:
+        return {
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'timeouts': self.timeouts,
+            'protocol_errors': self.protocol_errors,
+            'frames_rejected': self.frames_rejected,
+            'commands': {name: h.summary() for name, h in self.commands.items()},
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.started_at = time.time()
+        self.tools: Dict[str, Histogram] = {}
+        self.links: Dict[str, LinkStats] = {}
+
+    def tool(self, name: str) -> Histogram:
+        histogram = self.tools.get(name)
+        if histogram is None:
+            histogram = self.tools[name] = Histogram()
+        return histogram
+
+    def link(self, port: str) -> LinkStats:
+        stats = self.links.get(port)
+        if stats is None:
+            stats = self.links[port] = LinkStats()
+        return stats
+
+    def summary(self) -> dict:
+        return {
+            'uptime_s': round(time.time() - self.started_at, 1),
+            'tools': {name: h.summary() for name, h in self.tools.items() if h.count},
+            'boards': {port: stats.summary() for port, stats in self.links.items()},
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines: List[str] = []
+
+        def histogram(name: str, help_text: str, series: List[Tuple[str, Histogram]]) -> None:
+            metric = f"{PROMETHEUS_PREFIX}_{name}_seconds"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for labels, h in series:
+                cumulative = 0
+                for bound, count in zip(BUCKET_BOUNDS, h.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {h.count}')
+                lines.append(f"{metric}_sum{{{labels}}} {h.sum}")
+                lines.append(f"{metric}_count{{{labels}}} {h.count}")
+
+        def counter(name: str, help_text: str, attribute: str) -> None:
+            metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for port, stats in self.links.items():
+                lines.append(f'{metric}{{port="{port}"}} {getattr(stats, attribute)}')
+
+        histogram('tool_duration', "Time taken by each MCP tool call.", [
+            (f'tool="{name}"', h) for name, h in self.tools.items()
+        ])
+        histogram('command_duration', "Round trip time of each serial command.", [
+            (f'port="{port}",command="{name}"', h)
+            for port, stats in self.links.items()
+            for name, h in stats.commands.items()
+        ])
+        counter('bytes_sent', "Bytes written to the serial port.", 'bytes_sent')
+        counter('bytes_received', "Bytes read from the serial port.", 'bytes_received')
+        counter('timeouts', "Commands that got no reply in time.", 'timeouts')
+        counter('protocol_errors', "Commands the arduino replied to with an error.", 'protocol_errors')
+        counter('frames_rejected', "Received frames with bad encoding or a bad CRC.", 'frames_rejected')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+def timed(fn: Callable) -> Callable:
+    """Record the latency of every call of the async tool `fn`."""
+    histogram = METRICS.tool(fn.__name__)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    return wrapper
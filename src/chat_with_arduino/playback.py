@@ -0,0 +1,177 @@
+"""Waveform playback: PWM samples streamed to the firmware, which writes them
+out at a fixed rate.
+
+The firmware buffers PLAYBACK_BUFFER_BYTES of samples. Flow control is
+credit based: the START reply grants credits for the whole buffer, every
+sample sent spends one, and the firmware grants more with PLAYBACK_CREDIT
+frames as it plays samples out. The host never sends more than it holds
+credits for, and only ever has one PLAYBACK_DATA frame in flight, which
+always fits the firmware's RX buffer.
+"""
+import asyncio
+import itertools
+import math
+import struct
+import time
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from .codec import Frame, ProtocolError, unpack_reply
+from .protocol import MAX_PLAYBACK_CHUNK_BYTES, PLAYBACK_LAST_CHUNK, TctlmIds
+from .transport import SerialTransport
+
+WAVEFORM_SHAPES = ('sine', 'triangle', 'square', 'sawtooth')
+
+
+def waveform(shape: str, frequency_hz: float, rate_hz: float, low: int, high: int) -> Iterator[int]:
+    """Endless PWM values (low-high) tracing `shape` at `frequency_hz`,
+    sampled at `rate_hz`."""
+    # Checked here rather than in the generator, so it fails straight away
+    assert shape in WAVEFORM_SHAPES, f"Invalid shape '{shape}'. Available shapes are {', '.join(WAVEFORM_SHAPES)}."
+
+    def levels() -> Iterator[float]:
+        step = frequency_hz / rate_hz
+        for i in itertools.count():
+            phase = (i * step) % 1.0
+            if shape == 'sine':
+                yield 0.5 - 0.5 * math.cos(2 * math.pi * phase)
+            elif shape == 'triangle':
+                yield 1 - abs(2 * phase - 1)
+            elif shape == 'square':
+                yield 1.0 if phase < 0.5 else 0.0
+            else:
+                yield phase
+
+    return (int(round(low + (high - low) * level)) for level in levels())
+
+
+def frames_from_samples(samples: List[List[int]], repeat: int) -> Iterator[bytes]:
+    """Frames playing `samples` (one list of values per pin) `repeat` times,
+    or forever if `repeat` is 0."""
+    frames = [bytes(values) for values in zip(*samples)]
+    if repeat == 0:
+        return itertools.cycle(frames)
+    return itertools.chain.from_iterable(itertools.repeat(frames, repeat))
+
+
+class Playback:
+    """One waveform playing on one board, fed from an iterator of frames
+    (one PWM value per pin per sample).
+
+    Must be created on the event loop. PLAYBACK_CREDIT frames arrive on the
+    transport's reader thread and are handed over to the loop.
+    """
+
+    def __init__(self, transport: SerialTransport, pins: Dict[int, int], rate_hz: float):
+        """
+        Arguments:
+            transport: The board's transport.
+            pins: Maps each pin as the user named it to its resolved number.
+            rate_hz: Samples per second.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._transport = transport
+        self.pins = pins
+        self.rate_hz = rate_hz
+        self.started_at = time.time()
+        self.capacity = 0
+        self.credits = 0
+        self.sent = 0
+        self.played = 0
+        self.underruns = 0
+        self.state = 'PLAYING'
+        self.error: Optional[str] = None
+        self._credited = asyncio.Event()
+        self._pump: Optional[asyncio.Task] = None
+        # Resolved with the final status once the last sample has played, or
+        # playback was stopped or failed
+        self.done: asyncio.Future = self._loop.create_future()
+
+    def ingest(self, frame: Frame) -> None:
+        """Called from the transport's reader thread."""
+        try:
+            report = unpack_reply(TctlmIds.PLAYBACK_CREDIT, frame)
+        except ProtocolError:
+            return
+        self._loop.call_soon_threadsafe(self._credit, *report)
+
+    def _credit(self, credits: int, played: int, underruns: int, finished: int) -> None:
+        self.credits += credits
+        self.played = played
+        self.underruns = underruns
+        self._credited.set()
+        if finished:
+            self.finish('DONE')
+
+    def finish(self, state: str) -> None:
+        """Resolve `done` with the final status, unless it already is."""
+        if not self.done.done():
+            self.state = state
+            self.done.set_result(self.status())
+
+    def fail(self, error: str) -> None:
+        """End playback because the board can no longer play it, eg because
+        it reset."""
+        if self._pump is not None:
+            self._pump.cancel()
+        if not self.done.done():
+            self.error = error
+            self.finish('FAILED')
+
+    async def start(self, frames: Iterable[bytes]) -> None:
+        """Start playback and keep the firmware's buffer topped up from
+        `frames` in the background, until they run out."""
+        payload = struct.pack('>IB', int(round(1_000_000 / self.rate_hz)), len(self.pins)) + bytes(self.pins.values())
+        reply = await self._transport.exchange(TctlmIds.PLAYBACK_START.value, payload)
+        (self.capacity,) = unpack_reply(TctlmIds.PLAYBACK_START, reply)
+        self.credits = self.capacity
+        self._pump = asyncio.ensure_future(self._feed(iter(frames)))
+
+    async def _feed(self, frames: Iterator[bytes]) -> None:
+        chunk_samples = MAX_PLAYBACK_CHUNK_BYTES // len(self.pins)
+        try:
+            while True:
+                while self.credits == 0:
+                    self._credited.clear()
+                    await self._credited.wait()
+                chunk = list(itertools.islice(frames, min(self.credits, chunk_samples)))
+                last = len(chunk) < min(self.credits, chunk_samples)
+                payload = bytes([PLAYBACK_LAST_CHUNK if last else 0]) + b''.join(chunk)
+                self.credits -= len(chunk)
+                self.sent += len(chunk)
+                reply = await self._transport.exchange(TctlmIds.PLAYBACK_DATA.value, payload)
+                unpack_reply(TctlmIds.PLAYBACK_DATA, reply)
+                if last:
+                    return
+        except Exception as e:
+            self.error = str(e)
+            self.finish('FAILED')
+            # Don't leave the board waiting for samples that won't come
+            try:
+                await self._transport.request(TctlmIds.PLAYBACK_STOP)
+            except Exception:
+                pass
+
+    async def stop(self) -> dict:
+        """Stop playback, leaving the pins at their last value."""
+        if self._pump is not None:
+            self._pump.cancel()
+        if not self.done.done():
+            self.played, self.underruns = await self._transport.request(TctlmIds.PLAYBACK_STOP)
+            self.finish('STOPPED')
+        return self.status()
+
+    def status(self) -> dict:
+        status = {
+            'state': self.state,
+            'pins': list(self.pins),
+            'rate_hz': self.rate_hz,
+            'samples_sent': self.sent,
+            'samples_played': self.played,
+            'buffered': self.sent - self.played,
+            'underruns': self.underruns,
+            'elapsed_s': round(time.time() - self.started_at, 3),
+        }
+        if self.state == 'FAILED':
+            status['error'] = self.error
+        return status
+
@@ -0,0 +1,132 @@
+from enum import Enum
+
+# Bumped whenever the framing changes. The firmware reports its version in
+# the ACK reply so mismatches can be detected before any pin is touched.
+PROTOCOL_VERSION = 3
+
+# Every frame starts with a sequence ID, which the firmware echoes in its
+# reply. See codec.py for the rest of the frame format.
+MAX_SEQUENCE_ID = 0xFE
+
+# Frames the arduino sends of its own accord (eg streamed samples) use this
+# sequence ID, which is never assigned to a request.
+UNSOLICITED_SEQUENCE_ID = 0xFF
+
+# The most operations a single BATCH frame may carry. Bounded by the
+# firmware's frame buffers.
+MAX_BATCH_OPS = 16
+
+# The most pins a single analog stream may sample.
+MAX_STREAM_PINS = 8
+
+# The longest pin mask DIGITAL_READ_PINS and DIGITAL_WRITE_PINS accept, in
+# bytes. 9 bytes covers every pin of a Mega.
+MAX_PIN_MASK_BYTES = 9
+
+# The most pins a single ANALOG_READ_PINS may read.
+MAX_ANALOG_READ_PINS = 16
+
+# Every connection opens at this rate, which any firmware version speaks.
+DEFAULT_BAUD_RATE = 9600
+
+# The rates SET_BAUD may switch to, fastest first. Must match
+# NEGOTIABLE_BAUD_RATES in the firmware.
+NEGOTIABLE_BAUD_RATES = (1_000_000, 500_000, 115_200)
+
+# After switching rate the firmware goes back to its previous rate unless a
+# valid frame arrives within this long.
+BAUD_CONFIRM_TIMEOUT_S = 0.5
+
+# The most steps the firmware's schedule can hold, and the most a single
+# SCHEDULE_LOAD frame can carry. Bounded by the firmware's RAM and frame
+# buffers.
+MAX_SCHEDULE_STEPS = 32
+MAX_SCHEDULE_LOAD_STEPS = 8
+
+# The states SCHEDULE_STATUS reports.
+SCHEDULE_STATES = {
+    0: 'IDLE',
+    1: 'RUNNING',
+    2: 'DONE',
+    3: 'STOPPED',
+}
+
+# Waveform playback: the most pins one playback may drive, the size of the
+# firmware's sample buffer shared between them, and the most sample bytes
+# one PLAYBACK_DATA frame may carry (so a frame always fits the firmware's
+# 64 byte RX buffer).
+MAX_PLAYBACK_PINS = 4
+PLAYBACK_BUFFER_BYTES = 256
+MAX_PLAYBACK_CHUNK_BYTES = 48
+
+# Set in the flags of the PLAYBACK_DATA carrying the final samples.
+PLAYBACK_LAST_CHUNK = 0x01
+
+# The most pins WATCH_PIN can watch at once.
+MAX_WATCHED_PINS = 4
+
+# The edges WATCH_PIN can watch for. NONE stops watching the pin.
+PIN_EDGES = {
+    'NONE': 0,
+    'RISING': 1,
+    'FALLING': 2,
+    'CHANGE': 3,
+}
+
+PIN_MODES = {
+    'INPUT': 0,
+    'OUTPUT': 1,
+    'INPUT_PULLUP': 2,
+    'INPUT_PULLDOWN': 3,
+    'OUTPUT_OPENDRAIN': 4
+}
+
+
+class TctlmIds(Enum):
+    ERR = 0
+    ACK = 1
+    DIGITAL_READ = 2
+    DIGITAL_WRITE = 3
+    PIN_MODE = 4
+    ANALOG_READ = 5
+    ANALOG_WRITE = 6
+    DELAY = 7
+    MILLIS = 8
+    BATCH = 9
+    STREAM_START = 10
+    STREAM_STOP = 11
+    STREAM_DATA = 12
+    SET_BAUD = 13
+    WATCH_PIN = 14
+    PIN_EVENT = 15
+    DIGITAL_READ_PINS = 16
+    DIGITAL_WRITE_PINS = 17
+    ANALOG_READ_PINS = 18
+    SCHEDULE_LOAD = 19
+    SCHEDULE_START = 20
+    SCHEDULE_STOP = 21
+    SCHEDULE_STATUS = 22
+    SCHEDULE_DONE = 23
+    PLAYBACK_START = 24
+    PLAYBACK_DATA = 25
+    PLAYBACK_STOP = 26
+    PLAYBACK_CREDIT = 27
+
+
+class ErrorCodes(Enum):
+    GENERIC = 0
+    LENGTH_INCORRECT = 1
+    MODE_GREATER_THAN_FOUR = 2
+    UNKNOWN_COMMAND = 3
+    BATCH_TOO_LARGE = 4
+    TOO_MANY_STREAM_PINS = 5
+    CRC_MISMATCH = 6
+    MALFORMED_FRAME = 7
+    UNSUPPORTED_BAUD_RATE = 8
+    TOO_MANY_WATCHED_PINS = 9
+    INVALID_EDGE = 10
+    SCHEDULE_TOO_LARGE = 11
+    SCHEDULE_RUNNING = 12
+    TOO_MANY_PLAYBACK_PINS = 13
+    PLAYBACK_OVERFLOW = 14
+    NOT_PLAYING = 15
@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Iterator, Optional, Tuple
+
+from .protocol import TctlmIds
+
+# Only imported once a board is connected, so that the server can start
+# without them (or pyserial)
+if TYPE_CHECKING:
+    from .events import PinEvent
+    from .playback import Playback
+    from .scheduler import Schedule
+    from .streaming import AnalogStream
+    from .transport import SerialTransport
+
+logger = logging.getLogger(__name__)
+
+# After a board's port fails, reopening it is retried after this long, then
+# twice as long each time up to RECONNECT_MAX_DELAY_S, until
+# RECONNECT_TIMEOUT_S has passed.
+RECONNECT_DELAY_S = 0.1
+RECONNECT_MAX_DELAY_S = 2.0
+RECONNECT_TIMEOUT_S = 60.0
+
+
+class Connection:
+    """Everything the server keeps track of for one connected board."""
+
+    def __init__(
+        self,
+        name: str,
+        transport: 'SerialTransport',
+        fqbn: Optional[str] = None,
+        on_pin_event: Optional[Callable[['PinEvent'], None]] = None,
+        reopen: Optional[Callable[[], Awaitable[Tuple['SerialTransport', Optional[float]]]]] = None,
+        time_to_ready_s: Optional[float] = None,
+    ):
+        """
+        Arguments:
+            name: The alias or port the board is known by.
+            transport: The board's transport.
+            fqbn: The board's fully qualified board name, if known.
+            on_pin_event: Called on the event loop with every pin event.
+            reopen: Opens the board's port again with the same settings,
+            returning the new transport and how long the firmware took to
+            answer (None if it didn't). If given, the board is reconnected
+            automatically when its port fails.
+            time_to_ready_s: How long the firmware took to answer after the
+            port was opened.
+        """
+        from .clocksync import ClockSync
+        from .datalog import DataLog
+        from .events import PinWatcher
+        from .shadow import PinShadow
+
+        self._loop = asyncio.get_running_loop()
+        self.name = name
+        self.transport = transport
+        self.fqbn = fqbn
+        self.time_to_ready_s = time_to_ready_s
+        # CONNECTED, RECONNECTING, or LOST once reconnecting has given up
+        self.state = 'CONNECTED'
+        self.reconnects = 0
+        # Resets noticed while the port stayed open, eg from a brownout
+        self.resets = 0
+        self.lost_error: Optional[str] = None
+        self.reopen = reopen
+        self._reconnecting: Optional[asyncio.Task] = None
+        self.stream: Optional['AnalogStream'] = None
+        self.schedule: Optional['Schedule'] = None
+        self.playback: Optional['Playback'] = None
+        self.pins = PinShadow()
+        self.watcher = PinWatcher(on_pin_event)
+        transport.subscribe(TctlmIds.PIN_EVENT.value, self.watcher.ingest)
+        transport.on_lost = self._on_lost
+        self.log = DataLog(name)
+        self.clock = ClockSync(lambda: self.transport, on_reset=self._on_reset)
+        self.clock.start()
+
+    @property
+    def port(self) -> str:
+        return self.transport.port
+
+    def observe_millis(self, value: int) -> None:
+        """Feed in a `millis` reading from the board."""
+        self.pins.observe_millis(value)
+
+    def board_millis(self) -> Optional[int]:
+        """Estimate the board's millis() now, or None if its clock hasn't
+        been synchronised yet."""
+        return self.clock.board_millis()
+
+    def timestamp(self, board_millis: int) -> dict:
+        """When the board's millis() read `board_millis`, as host time
+        (seconds since the epoch) and how far out that may be. Empty if the
+        board's clock hasn't been synchronised yet."""
+        converted = self.clock.to_host(board_millis)
+        if converted is None:
+            return {}
+        host_s, error_s = converted
+        return {
+            'time': round(host_s + time.time() - time.monotonic(), 6),
+            'time_error_ms': round(error_s * 1000, 3),
+        }
+
+    def describe_event(self, event: 'PinEvent') -> dict:
+        return {**event.describe(), **self.timestamp(event.board_millis)}
+
+    def _forget_board_state(self, state: str, error: str) -> None:
+        """The board has reset (or most likely will have, by the time it's
+        reconnected), so nothing it was doing for the host survives: end the
+        schedule and playback with `state` and `error`. Watches and the stream
+        are restarted by `_resume`."""
+        self.pins.invalidate()
+        if self.schedule is not None:
+            self.schedule.stop(state)
+        if self.playback is not None:
+            self.playback.fail(error)
+
+    def _on_reset(self) -> None:
+        """Called when the clock sync finds the board has reset, eg from a
+        brownout, while its port stayed open."""
+        logger.warning("%s has reset", self.name)
+        self.resets += 1
+        self._forget_board_state('RESET', "The board reset")
+        asyncio.ensure_future(self._resume())
+
+    def _on_lost(self, error: Exception) -> None:
+        """Called from the transport's reader thread."""
+        self._loop.call_soon_threadsafe(self._start_reconnecting, error)
+
+    def _start_reconnecting(self, error: Exception) -> None:
+        self.lost_error = str(error)
+        self.clock.reset()
+        self._forget_board_state('LOST', self.lost_error)
+        if self.reopen is None:
+            self.state = 'LOST'
+            return
+        self.state = 'RECONNECTING'
+        self._reconnecting = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        old = self.transport
+        try:
+            await old.close()
+        except Exception:
+            pass
+        deadline = time.monotonic() + RECONNECT_TIMEOUT_S
+        delay_s = RECONNECT_DELAY_S
+        while time.monotonic() < deadline:
+            await asyncio.sleep(delay_s)
+            delay_s = min(2 * delay_s, RECONNECT_MAX_DELAY_S)
+            try:
+                transport, time_to_ready_s = await self.reopen()
+            except Exception as e:
+                # Most likely the port hasn't come back yet
+                logger.debug("Couldn't reopen %s: %s", old.port, e)
+                continue
+            if time_to_ready_s is None:
+                await transport.close()
+                continue
+            for command, callback in old.subscriptions().items():
+                transport.subscribe(command, callback)
+            transport.on_lost = self._on_lost
+            self.transport = transport
+            self.time_to_ready_s = time_to_ready_s
+            self.reconnects += 1
+            self.state = 'CONNECTED'
+            await self._resume()
+            # Resynchronise now rather than at the next interval
+            self.clock.stop()
+            self.clock.start()
+            return
+        self.state = 'LOST'
+
+    async def _resume(self) -> None:
+        """Restart what the board was doing for the host before it reset: pin
+        watches and the analog stream."""
+        try:
+            for pin, edge in list(self.watcher.armed.items()):
+                (interrupt_driven,) = await self.transport.request(TctlmIds.WATCH_PIN, pin, edge)
+                self.watcher.interrupt_driven[pin] = bool(interrupt_driven)
+            stream = self.stream
+            if stream is not None and stream.running:
+                await self.transport.exchange(TctlmIds.STREAM_START.value, stream.start_payload())
+        except Exception as e:
+            logger.warning("Couldn't resume %s: %s", self.name, e)
+
+    async def close(self) -> None:
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+        self.clock.stop()
+        self.log.close()
+        await self.transport.close()
+
+    def describe(self) -> dict:
+        description = {
+            'board': self.name,
+            'port': self.port,
+            'fqbn': self.fqbn,
+            'baud_rate': self.transport.baud_rate,
+            'state': self.state,
+            'time_to_ready_s': None if self.time_to_ready_s is None else round(self.time_to_ready_s, 3),
+            'reconnects': self.reconnects,
+            'resets': self.resets,
+            'latency': self.transport.envelope.describe() if self.transport.envelope is not None else None,
+            'clock': self.clock.describe(),
+            'streaming': self.stream is not None and self.stream.running,
+            'scheduling': self.schedule is not None and not self.schedule.done.done(),
+            'playing': self.playback is not None and not self.playback.done.done(),
+            'watched_pins': sorted(self.watcher.armed),
+        }
+        if self.state != 'CONNECTED':
+            description['error'] = self.lost_error
+        return description
+
+
+class ConnectionRegistry:
+    """The boards the server is connected to, keyed by alias (or by port if
+    no alias was given). Every board has its own transport, so commands to
+    different boards run concurrently.
+    """
+
+    def __init__(self):
+        self._connections: Dict[str, Connection] = {}
+
+    def __iter__(self) -> Iterator[Connection]:
+        return iter(list(self._connections.values()))
+
+    def __len__(self) -> int:
+        return len(self._connections)
+
+    def find(self, board: str) -> Optional[Connection]:
+        """Look a connection up by its alias or by its port."""
+        if board in self._connections:
+            return self._connections[board]
+        for connection in self._connections.values():
+            if connection.port == board:
+                return connection
+        return None
+
+    def get(self, board: Optional[str] = None) -> Optional[Connection]:
+        """Resolve the board a tool should talk to.
+
+        Arguments:
+            board: The alias or port of the board. May be omitted when exactly
+            one board is connected.
+
+        Returns: The connection, or None if no board is connected at all.
+        Raises ValueError if `board` is unknown or ambiguous.
+        """
+        if not self._connections:
+            return None
+        if board is None:
+            if len(self._connections) == 1:
+                return next(iter(self._connections.values()))
+            raise ValueError(
+                "Several boards are connected, so `board` must be one of "
+                f"{list(self._connections)}"
+            )
+        connection = self.find(board)
+        if connection is None:
+            raise ValueError(
+                f"No board called '{board}' is connected. Connected boards "
+                f"are {list(self._connections)}"
+            )
+        return connection
+
+    def add(self, connection: Connection) -> None:
+        existing = self._connections.get(connection.name)
+        if existing is not None and existing.port != connection.port:
+            raise ValueError(
+                f"The name '{connection.name}' is already used by the board on {existing.port}"
+            )
+        self._connections[connection.name] = connection
+
+    def remove(self, connection: Connection) -> None:
+        self._connections.pop(connection.name, None)
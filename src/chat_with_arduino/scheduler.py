@@ -0,0 +1,65 @@
+import asyncio
+import time
+from typing import FrozenSet, Optional
+
+from .codec import Frame, ProtocolError, unpack_reply
+from .protocol import TctlmIds
+
+
+class Schedule:
+    """A timeline of pin operations running on one board's firmware, which
+    runs every step against its own millis() without the host.
+
+    Must be created on the event loop. The SCHEDULE_DONE frame arrives on the
+    transport's reader thread and is handed over to the loop.
+    """
+
+    def __init__(self, steps: int, runs: int, period_ms: int, last_ms: int, pins: FrozenSet[int]):
+        self._loop = asyncio.get_running_loop()
+        self.steps = steps
+        # 0 runs means repeat until stopped
+        self.runs = runs
+        self.period_ms = period_ms
+        # The offset of the last step, when the final run ends
+        self.last_ms = last_ms
+        # The pins the steps change, which the host can't model while it runs
+        self.pins = pins
+        self.started_at = time.time()
+        # Resolved with the SCHEDULE_DONE report once the last run ends
+        self.done: asyncio.Future = self._loop.create_future()
+
+    def ingest(self, frame: Frame) -> None:
+        """Called from the transport's reader thread."""
+        try:
+            report = unpack_reply(TctlmIds.SCHEDULE_DONE, frame)
+        except ProtocolError as e:
+            report = e
+        self._loop.call_soon_threadsafe(self._finish, report)
+
+    def _finish(self, report) -> None:
+        if self.done.done():
+            return
+        if isinstance(report, Exception):
+            self.done.set_exception(report)
+            return
+        runs_completed, max_late_ms, board_millis = report
+        self.done.set_result({
+            'state': 'DONE',
+            'runs_completed': runs_completed,
+            'max_late_ms': max_late_ms,
+            'board_millis': board_millis,
+            'elapsed_s': round(time.time() - self.started_at, 3),
+        })
+
+    def stop(self, state: str = 'STOPPED') -> None:
+        """Resolve `done` without a SCHEDULE_DONE report, eg because the
+        schedule was stopped or replaced. Does nothing if it's already done."""
+        if not self.done.done():
+            self.done.set_result({
+                'state': state,
+                'elapsed_s': round(time.time() - self.started_at, 3),
+            })
+
+    def duration_ms(self) -> Optional[int]:
+        """How long every run takes in total, or None if it repeats forever."""
+        return (self.runs - 1) * self.period_ms + self.last_ms if self.runs else None
@@ -1,17 +1,69 @@
-from enum import Enum
 from mcp.server.fastmcp import FastMCP
-from typing import Union, Tuple
+from pydantic import AnyUrl
+from typing import TYPE_CHECKING, Optional, Union, Tuple
+from .discovery import Discovery
+from .metrics import METRICS, timed
+from .protocol import DEFAULT_BAUD_RATE, MAX_ANALOG_READ_PINS, MAX_BATCH_OPS, MAX_PIN_MASK_BYTES, MAX_PLAYBACK_CHUNK_BYTES, MAX_PLAYBACK_PINS, MAX_SCHEDULE_LOAD_STEPS, MAX_SCHEDULE_STEPS, MAX_STREAM_PINS, PIN_EDGES, PIN_MODES, PROTOCOL_VERSION, SCHEDULE_STATES, TctlmIds
+from .registry import Connection, ConnectionRegistry
+import asyncio
+import itertools
 import json
+import logging
 import os
-import serial
-import serial.tools.list_ports
-import subprocess
+import shutil
+import struct
+import time
+
+# The rest of the package (and pyserial) is imported by the tools that use
+# it, so that the server answers the initialize handshake without loading it
+if TYPE_CHECKING:
+    from .datalog import DataLog
+    from .events import PinEvent
+    from .transport import SerialTransport
+
+# Messages go to stderr through logging, since stdout carries the stdio
+# transport's JSON-RPC stream
+logger = logging.getLogger(__name__)
+
+class LazyFastMCP(FastMCP):
+    """A FastMCP server that registers its tools when they're first listed or
+    called, rather than when they're defined.
+
+    Registering a tool builds a pydantic model and JSON schema of its
+    arguments, which for every tool here takes about as long as the rest of
+    the server's startup after importing mcp. Deferring it lets the server
+    answer the initialize handshake sooner.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._pending_tools: list = []
+        super().__init__(*args, **kwargs)
+
+    def add_tool(self, *args, **kwargs) -> None:
+        self._pending_tools.append((args, kwargs))
+
+    def _register_pending_tools(self) -> None:
+        pending, self._pending_tools = self._pending_tools, []
+        for args, kwargs in pending:
+            super().add_tool(*args, **kwargs)
+
+    async def list_tools(self, *args, **kwargs):
+        self._register_pending_tools()
+        return await super().list_tools(*args, **kwargs)
+
+    async def call_tool(self, *args, **kwargs):
+        self._register_pending_tools()
+        return await super().call_tool(*args, **kwargs)
+
 
 # Initialize FastMCP server
-my_mcp = FastMCP("chat-with-arduino")
+my_mcp = LazyFastMCP("chat-with-arduino")
+
 
+CONNECTIONS = ConnectionRegistry()
 
-SERIAL_PORT = None
+# Serial ports and Arduino boards, refreshed in the background
+DISCOVERY = Discovery()
 
 SERIAL_PORT_NC_MESSAGE = (
     'Serial Port not connected, use `list_devices()` to view the '
@@ -19,136 +71,163 @@ SERIAL_PORT_NC_MESSAGE = (
     'serial port to an arduino'
 )
 
-START_OF_MESSAGE = 0xFE
-END_OF_MESSAGE = 0xFF
 
-class TctlmIds(Enum):
-    ERR = 0
-    ACK = 1
-    DIGITAL_READ = 2
-    DIGITAL_WRITE = 3
-    PIN_MODE = 4
-    ANALOG_READ = 5
-    ANALOG_WRITE = 6
-    DELAY = 7
-    MILLIS = 8
-
-def resolve_pin(pin: int, is_analog: bool, fqbn: str) -> Union[int, str]:
+def connection_fqbn(connection: Connection, fqbn: Optional[str]) -> str:
+    """Use the FQBN given to a tool, falling back to the one the board was
+    connected with."""
+    fqbn = fqbn or connection.fqbn
+    assert fqbn, (
+        f"The FQBN of board '{connection.name}' is unknown, pass `fqbn` or "
+        "reconnect with `connect_to_arduino(..., fqbn=...)`"
+    )
+    return fqbn
+
+def log_readings(connection: Connection, readings: dict, board_millis: Optional[int] = None) -> None:
+    """Append readings, keyed by channel name (eg 'A0'), to the board's data
+    log. Timestamped with `board_millis` if the board's clock was read along
+    with them, otherwise with the synchronised clock's estimate."""
+    if board_millis is None:
+        board_millis = connection.board_millis()
+    for name, value in readings.items():
+        connection.log.record(name, int(value), board_millis)
+
+def with_timestamp(connection: Connection, result: dict) -> dict:
+    """Add the host time of a result's `board_millis`, if it has one."""
+    if result.get('board_millis') is None:
+        return result
+    return {**result, **connection.timestamp(result['board_millis'])}
+
+def invalidate_pins(port: str) -> None:
+    """Forget the pin state of the board on `port`, eg after uploading to
+    it resets the board."""
+    connection = CONNECTIONS.find(port)
+    if connection is not None:
+        connection.pins.invalidate()
+
+def resolve_pin(pin: int, is_analog: bool, fqbn: Optional[str], pwm: bool = False) -> int:
     """
     Convert a digital/analog ambiguous pin into a pin integer. For example, pin
     0 could be analogue or digital, and the exact pin number will depend on the
     board, but this function will give you a pin integer.
+
+    Pins the board doesn't have (or that can't do what's asked of them, eg PWM
+    if `pwm` is set) are rejected here, before anything is sent to the board.
+    Analog pins need a known board. Digital pins on unknown boards are passed
+    through unchecked.
     """
-    if fqbn == 'arduino:avr:leonardo':
-        # Mappings taken from
-        # https://github.com/arduino/ArduinoCore-avr/blob/c8c514c9a19602542bc32c7033f48fecbbda4401/variants/leonardo/pins_arduino.h#L136
-        if is_analog:
-            if pin == 0:  return 18 # noqa: E701
-            elif pin == 1:  return 19 # noqa: E701
-            elif pin == 2:  return 20 # noqa: E701
-            elif pin == 3:  return 21 # noqa: E701
-            elif pin == 4:  return 22 # noqa: E701
-            elif pin == 5:  return 23 # noqa: E701
-            elif pin == 6:  return 24 # noqa: E701
-            elif pin == 7:  return 25 # noqa: E701
-            elif pin == 8:  return 26 # noqa: E701
-            elif pin == 9:  return 27 # noqa: E701
-            elif pin == 10: return 28 # noqa: E701
-            elif pin == 11: return 29 # noqa: E701
-            else:
-                return f"Don't know analog pin {pin} for board {fqbn}"
-        else:
-            # Digital pins are all the same
-            return pin
-    else:
-        return f"Don't know board {fqbn}"
+    from .boards import find_board, get_board
+
+    board = get_board(fqbn) if is_analog else find_board(fqbn)
+    if board is None:
+        assert 0 <= pin <= 255, f"Pin must be in range 0-255, but was {pin}"
+        return pin
+    resolved = board.resolve_pin(pin, is_analog)
+    if pwm:
+        board.check_pwm(resolved)
+    elif not is_analog:
+        board.check_digital(resolved)
+    return resolved
 
 
 @my_mcp.tool()
-async def ack() -> Union[bool, str]:
+@timed
+async def ack(board: Optional[str] = None) -> Union[bool, str]:
     """Request an acknowledgement from the arduino. Useful for checking that
     it's got power and has the Chat With Arduino firmware loaded.
 
-    Arguments: None
+    Arguments:
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
 
     Returns: (True or False indicating whether the arduino replied correctly
     to the ACK), or a stringified error message if there was an exception or
     something went wrong
     """
-    global SERIAL_PORT
     try:
-        if SERIAL_PORT is None:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
             return SERIAL_PORT_NC_MESSAGE
 
-        SERIAL_PORT.write([START_OF_MESSAGE, TctlmIds.ACK.value, END_OF_MESSAGE])
-        reply = list(SERIAL_PORT.read_until(expected=[END_OF_MESSAGE]))
+        (version,) = await connection.transport.request(TctlmIds.ACK)
 
-        return list(reply) == [START_OF_MESSAGE, TctlmIds.ACK.value, END_OF_MESSAGE]
+        if version != PROTOCOL_VERSION:
+            return (
+                f"The arduino speaks protocol version {version}, but version "
+                f"{PROTOCOL_VERSION} is required. Use "
+                "`upload_chat_with_arduino_firmware` to update the firmware."
+            )
+        return True
 
     except Exception as e:
         return str(e)
 
 
 @my_mcp.tool()
-async def digital_read(pin: int) -> Union[bool, str]:
+@timed
+async def digital_read(pin: int, board: Optional[str] = None) -> Union[bool, str]:
     """Reads the state of a digital pin.
 
     Arguments:
         pin (int): The pin number to read (0-255).
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
 
     Returns:
         (bool) True for HIGH, False for LOW, or a stringified error message if something went wrong.
     """
-    global SERIAL_PORT
-    try:
-        assert 0 <= pin <= 255, f"Pin must be in range 0-255, but was {pin}"
+    from .datalog import channel_name
 
-        if SERIAL_PORT is None:
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
             return SERIAL_PORT_NC_MESSAGE
 
-        SERIAL_PORT.write([START_OF_MESSAGE, TctlmIds.DIGITAL_READ.value, pin, END_OF_MESSAGE])
-        reply = list(SERIAL_PORT.read_until(expected=[END_OF_MESSAGE]))
+        pin = resolve_pin(pin, is_analog=False, fqbn=connection.fqbn)
+
+        # An OUTPUT pin reads back the state it was last driven to. Not
+        # logged, since the log holds only what was read from the board.
+        cached = connection.pins.read(pin)
+        if cached is not None:
+            return bool(cached)
 
-        assert not (len(reply) == 4 and reply[1] == TctlmIds.ERR.value), f"Received an error code: {reply[2]}"
-        assert len(reply) == 4, "Expected reply to be 4 bytes, but was {len(reply)}: {reply}"
-        assert reply[0] == START_OF_MESSAGE, "Expected reply[0] to be start of message {START_OF_MESSAGE}, but was {reply[0]}"
-        assert reply[1] == TctlmIds.DIGITAL_READ.value, "Expected reply[1] to be TctlmIds.DIGITAL_READ {TctlmIds.DIGITAL_READ.value}, but was {reply[1]}"
-        assert reply[3] == END_OF_MESSAGE, "Expected reply[3] to be end of message {END_OF_MESSAGE}, but was {reply[3]}"
-        assert reply[2] in (0, 1), f"Expected reply[2] to be 0 or 1, but was {reply[2]}"
+        (state,) = await connection.transport.request(TctlmIds.DIGITAL_READ, pin)
+        assert state in (0, 1), f"Expected the pin state to be 0 or 1, but was {state}"
+        log_readings(connection, {channel_name(pin, False): state})
 
-        return bool(reply[2])  # Convert 0/1 to False/True
+        return bool(state)  # Convert 0/1 to False/True
 
     except Exception as e:
         return str(e)
 
 
 @my_mcp.tool()
-async def digital_write(pin: int, state: int) -> Union[None, str]:
+@timed
+async def digital_write(pin: int, state: int, board: Optional[str] = None) -> Union[None, str]:
     """Writes a state to a digital pin.
 
     Arguments:
         pin (int): The pin number to write to (0-255).
         state (int): The state to write (0 for LOW, 1 for HIGH).
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
 
     Returns:
         None if successful, or a stringified error message if something went wrong.
     """
-    global SERIAL_PORT
     try:
-        assert 0 <= pin <= 255, f"Pin must be in range 0-255, but was {pin}"
         assert state in (0, 1), f"State must be 0 (LOW) or 1 (HIGH), but was {state}"
 
-        if SERIAL_PORT is None:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
             return SERIAL_PORT_NC_MESSAGE
 
-        SERIAL_PORT.write([START_OF_MESSAGE, TctlmIds.DIGITAL_WRITE.value, pin, state, END_OF_MESSAGE])
-        reply = list(SERIAL_PORT.read_until(expected=[END_OF_MESSAGE]))
+        pin = resolve_pin(pin, is_analog=False, fqbn=connection.fqbn)
+
+        if connection.pins.write(pin, 'digital', state):
+            return None  # The pin already has this state
 
-        assert not (len(reply) == 4 and reply[1] == TctlmIds.ERR.value), f"Received an error code: {reply[2]}"
-        assert len(reply) == 3, f"Expected reply to be 3 bytes, but was {len(reply)}: {reply}"
-        assert reply[0] == START_OF_MESSAGE, f"Expected reply[0] to be start of message {START_OF_MESSAGE}, but was {reply[0]}"
-        assert reply[1] == TctlmIds.DIGITAL_WRITE.value, f"Expected reply[1] to be TctlmIds.DIGITAL_WRITE {TctlmIds.DIGITAL_WRITE.value}, but was {reply[1]}"
-        assert reply[2] == END_OF_MESSAGE, f"Expected reply[2] to be end of message {END_OF_MESSAGE}, but was {reply[2]}"
+        with connection.pins.sending(pin):
+            await connection.transport.request(TctlmIds.DIGITAL_WRITE, pin, state)
 
         return None  # Success
 
@@ -157,7 +236,14 @@ async def digital_write(pin: int, state: int) -> Union[None, str]:
 
 
 @my_mcp.tool()
-async def pin_mode(pin: int, is_analog: bool, mode: str, fqbn: str) -> Union[None, str]:
+@timed
+async def pin_mode(
+    pin: int,
+    is_analog: bool,
+    mode: str,
+    fqbn: Optional[str] = None,
+    board: Optional[str] = None,
+) -> Union[None, str]:
     """Defines the mode of a pin. This can only be set once before the Arduino
     needs to be reset and should be set before using the pin.
 
@@ -167,41 +253,33 @@ async def pin_mode(pin: int, is_analog: bool, mode: str, fqbn: str) -> Union[Non
         false otherwise.
         mode (str): The mode to set for the pin. Available modes are:
             'INPUT', 'OUTPUT', 'INPUT_PULLUP', 'INPUT_PULLDOWN', 'OUTPUT_OPENDRAIN'.
-        fqbn: the fully qualified board name
+        fqbn: the fully qualified board name, defaults to the one the board
+        was connected with
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
 
     Returns:
         None if successful, or a stringified error message if something went wrong.
     """
-    global SERIAL_PORT
     try:
-        pin_or_err = resolve_pin(pin, is_analog=True, fqbn=fqbn)
-        assert type(pin_or_err) is int, "{pin_or_err}"
-        pin = int(pin_or_err)
-        assert 0 <= pin <= 255, f"Pin must be in range 0-255, but was {pin}"
-
-        mode_map = {
-            'INPUT': 0,
-            'OUTPUT': 1,
-            'INPUT_PULLUP': 2,
-            'INPUT_PULLDOWN': 3,
-            'OUTPUT_OPENDRAIN': 4
-        }
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
 
-        assert mode in mode_map, f"Invalid mode '{mode}'. Available modes are 'INPUT', 'OUTPUT', 'INPUT_PULLUP', 'INPUT_PULLDOWN', 'OUTPUT_OPENDRAIN'."
+        if is_analog:
+            pin = resolve_pin(pin, is_analog=True, fqbn=connection_fqbn(connection, fqbn))
+        else:
+            pin = resolve_pin(pin, is_analog=False, fqbn=fqbn or connection.fqbn)
 
-        mode_value = mode_map[mode]
+        assert mode in PIN_MODES, f"Invalid mode '{mode}'. Available modes are 'INPUT', 'OUTPUT', 'INPUT_PULLUP', 'INPUT_PULLDOWN', 'OUTPUT_OPENDRAIN'."
 
-        if SERIAL_PORT is None:
-            return SERIAL_PORT_NC_MESSAGE
+        mode_value = PIN_MODES[mode]
 
-        SERIAL_PORT.write([START_OF_MESSAGE, TctlmIds.PIN_MODE.value, pin, mode_value, END_OF_MESSAGE])
-        reply = list(SERIAL_PORT.read_until(expected=[END_OF_MESSAGE]))
+        if connection.pins.set_mode(pin, mode_value):
+            return None  # The pin already has this mode
 
-        assert not (len(reply) == 4 and reply[1] == TctlmIds.ERR.value), f"Received an error code: {reply[2]}"
-        assert len(reply) == 3, f"Expected reply to be 3 bytes, but was {len(reply)}: {reply}"
-        assert reply[0] == START_OF_MESSAGE, f"Expected reply[0] to be start of message {START_OF_MESSAGE}, but was {reply[0]}"
-        assert reply[1] == TctlmIds.PIN_MODE.value, f"Expected reply[1] to be TctlmIds.PIN_MODE {TctlmIds.PIN_MODE.value}, but was {reply[1]}"
-        assert reply[2] == END_OF_MESSAGE, f"Expected reply[2] to be end of message {END_OF_MESSAGE}, but was {reply[2]}"
+        with connection.pins.sending(pin):
+            await connection.transport.request(TctlmIds.PIN_MODE, pin, mode_value)
 
         return None  # Success
 
@@ -210,37 +288,32 @@ async def pin_mode(pin: int, is_analog: bool, mode: str, fqbn: str) -> Union[Non
 
 
 @my_mcp.tool()
-async def analog_read(pin: int, fqbn: str) -> Union[int, str]:
+@timed
+async def analog_read(pin: int, fqbn: Optional[str] = None, board: Optional[str] = None) -> Union[int, str]:
     """Reads the value of an analog pin in 10-bit resolution (0-1023).
 
     Arguments:
         pin (int): The pin number to read from (0-255).
-        fqbn (str): The fully qualified board name
+        fqbn (str): The fully qualified board name, defaults to the one the
+        board was connected with
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
 
     Returns:
         (int) The analog reading (0-1023), or a stringified error message if something went wrong.
     """
-    global SERIAL_PORT
-    try:
-        pin_or_err = resolve_pin(pin, is_analog=True, fqbn=fqbn)
-        assert type(pin_or_err) is int, "{pin_or_err}"
-        pin = int(pin_or_err)
-        assert 0 <= pin <= 255, f"Pin must be in range 0-255, but was {pin}"
+    from .datalog import channel_name
 
-        if SERIAL_PORT is None:
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
             return SERIAL_PORT_NC_MESSAGE
 
-        SERIAL_PORT.write([START_OF_MESSAGE, TctlmIds.ANALOG_READ.value, pin, END_OF_MESSAGE])
-        reply = list(SERIAL_PORT.read_until(expected=[END_OF_MESSAGE]))
-
-        assert not (len(reply) == 4 and reply[1] == TctlmIds.ERR.value), f"Received an error code: {reply[2]}"
-        assert len(reply) == 5, f"Expected reply to be 5 bytes, but was {len(reply)}: {reply}"
-        assert reply[0] == START_OF_MESSAGE, f"Expected reply[0] to be start of message {START_OF_MESSAGE}, but was {reply[0]}"
-        assert reply[1] == TctlmIds.ANALOG_READ.value, f"Expected reply[1] to be TctlmIds.ANALOG_READ {TctlmIds.ANALOG_READ.value}, but was {reply[1]}"
-        assert reply[4] == END_OF_MESSAGE, f"Expected reply[4] to be end of message {END_OF_MESSAGE}, but was {reply[4]}"
+        resolved = resolve_pin(pin, is_analog=True, fqbn=connection_fqbn(connection, fqbn))
 
-        value = (reply[2] << 8) & reply[3]
+        (value,) = await connection.transport.request(TctlmIds.ANALOG_READ, resolved)
         assert 0 <= value <= 1023, f"Analog read value must be between 0 and 1023, but was {value}"
+        log_readings(connection, {channel_name(pin, True): value})
 
         return value  # The analog reading
 
@@ -249,37 +322,46 @@ async def analog_read(pin: int, fqbn: str) -> Union[int, str]:
 
 
 @my_mcp.tool()
-async def analog_write(pin: int, value: int, fqbn: str) -> Union[None, str]:
+@timed
+async def analog_write(
+    pin: int,
+    value: int,
+    is_analog: bool = False,
+    fqbn: Optional[str] = None,
+    board: Optional[str] = None,
+) -> Union[None, str]:
     """Writes a value to a PWM-supported pin in 8-bit resolution (0-255).
 
     Arguments:
-        pin (int): The pin number to write to (0-255), this is assumed to be an
-        analogue pin (eg pin=0 implies pin 'A0' on the arduino)
+        pin (int): The pin number to write to (0-255), eg pin=9 for digital
+        pin 9. Must be a PWM pin.
         value (int): The PWM value to write (0-255).
-        fqbn (str): The fully qualified board name, used to resolve the pin
+        is_analog (bool): true if `pin` names an analogue pin (eg pin=0
+        implies pin 'A0' on the arduino), false otherwise (default: false).
+        fqbn (str): The fully qualified board name, used to resolve the pin.
+        Defaults to the one the board was connected with.
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
 
     Returns:
         None if successful, or a stringified error message if something went wrong.
     """
-    global SERIAL_PORT
     try:
-        pin_or_err = resolve_pin(pin, is_analog=True, fqbn=fqbn)
-        assert type(pin_or_err) is int, "{pin_or_err}"
-        pin = int(pin_or_err)
-        assert 0 <= pin <= 255, f"Pin must be in range 0-255, but was {pin}"
-        assert 0 <= value <= 255, f"Value must be in range 0-255, but was {value}"
-
-        if SERIAL_PORT is None:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
             return SERIAL_PORT_NC_MESSAGE
 
-        SERIAL_PORT.write([START_OF_MESSAGE, TctlmIds.ANALOG_WRITE.value, pin, value, END_OF_MESSAGE])
-        reply = list(SERIAL_PORT.read_until(expected=[END_OF_MESSAGE]))
+        if is_analog:
+            pin = resolve_pin(pin, is_analog=True, fqbn=connection_fqbn(connection, fqbn), pwm=True)
+        else:
+            pin = resolve_pin(pin, is_analog=False, fqbn=fqbn or connection.fqbn, pwm=True)
+        assert 0 <= value <= 255, f"Value must be in range 0-255, but was {value}"
+
+        if connection.pins.write(pin, 'pwm', value):
+            return None  # The pin already has this value
 
-        assert not (len(reply) == 4 and reply[1] == TctlmIds.ERR.value), f"Received an error code: {reply[2]}"
-        assert len(reply) == 3, f"Expected reply to be 3 bytes, but was {len(reply)}: {reply}"
-        assert reply[0] == START_OF_MESSAGE, f"Expected reply[0] to be start of message {START_OF_MESSAGE}, but was {reply[0]}"
-        assert reply[1] == TctlmIds.ANALOG_WRITE.value, f"Expected reply[1] to be TctlmIds.ANALOG_WRITE {TctlmIds.ANALOG_WRITE.value}, but was {reply[1]}"
-        assert reply[2] == END_OF_MESSAGE, f"Expected reply[2] to be end of message {END_OF_MESSAGE}, but was {reply[2]}"
+        with connection.pins.sending(pin):
+            await connection.transport.request(TctlmIds.ANALOG_WRITE, pin, value)
 
         return None  # Success
 
@@ -288,112 +370,1159 @@ async def analog_write(pin: int, value: int, fqbn: str) -> Union[None, str]:
 
 
 @my_mcp.tool()
-async def delay(milliseconds: int) -> Union[None, str]:
+@timed
+async def delay(milliseconds: int, board: Optional[str] = None) -> Union[None, str]:
     """Freezes program execution for the specified number of milliseconds.
 
-    Note that the serial timeout will be increased by `milliseconds//1000 + 1`
-    for the duration of this function call so that the serial port doesn't time
-    out waiting for the response.
+    The reply is expected `milliseconds` later, so this doesn't time out, and
+    nor do commands sent to the board while it's delaying. Other tools stay
+    responsive while the arduino is delaying. For precisely timed sequences of writes, use
+    `start_schedule` instead.
 
     Arguments:
         milliseconds (int): The number of milliseconds to delay (valid range: 0 to 4294967295).
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
 
     Returns:
         None if successful, or a stringified error message if something went wrong.
     """
-    global SERIAL_PORT
     try:
         assert 0 <= milliseconds <= 4294967295, f"Milliseconds must be in range 0 to 4294967295, but was {milliseconds}"
 
-        if SERIAL_PORT is None:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
             return SERIAL_PORT_NC_MESSAGE
 
-        old_timeout = SERIAL_PORT.timeout
-        if SERIAL_PORT.timeout is not None:
-            SERIAL_PORT.timeout = SERIAL_PORT.timeout + (milliseconds // 1000)
-
-        print(f"TIMEOUT: {SERIAL_PORT.timeout}")
-
         # Send delay command to Arduino
-        SERIAL_PORT.write([
-            START_OF_MESSAGE,
-            TctlmIds.DELAY.value,
-            milliseconds >> 24,
-            (milliseconds >> 16) & 0xFF,
-            (milliseconds >> 8) & 0xFF,
-            milliseconds & 0xFF,
-            END_OF_MESSAGE
-        ])
-        reply = list(SERIAL_PORT.read_until(expected=[END_OF_MESSAGE]))
-
-        assert not (len(reply) == 4 and reply[1] == TctlmIds.ERR.value), f"Received an error code: {reply[2]}"
-        assert len(reply) == 3, f"Expected reply to be 3 bytes, but was {len(reply)}: {reply}"
-        assert reply[0] == START_OF_MESSAGE, f"Expected reply[0] to be start of message {START_OF_MESSAGE}, but was {reply[0]}"
-        assert reply[1] == TctlmIds.DELAY.value, f"Expected reply[1] to be TctlmIds.DELAY {TctlmIds.DELAY.value}, but was {reply[1]}"
-        assert reply[2] == END_OF_MESSAGE, f"Expected reply[2] to be end of message {END_OF_MESSAGE}, but was {reply[2]}"
-
-        SERIAL_PORT.timeout = old_timeout
+        await connection.transport.request(TctlmIds.DELAY, milliseconds, execution_s=milliseconds / 1000)
+
         return None  # Success
 
     except Exception as e:
-        SERIAL_PORT.timeout = old_timeout
         return str(e)
 
 
 @my_mcp.tool()
-async def millis() -> Union[int, str]:
+@timed
+async def millis(board: Optional[str] = None) -> Union[int, str]:
     """Returns the number of milliseconds since the program started.
 
+    Arguments:
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
     Returns:
         (int) The number of milliseconds passed since program start,
         or a stringified error message if something went wrong.
     """
-    global SERIAL_PORT
     try:
-        if SERIAL_PORT is None:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
             return SERIAL_PORT_NC_MESSAGE
 
         # Send millis command to Arduino
-        SERIAL_PORT.write([START_OF_MESSAGE, TctlmIds.MILLIS.value, END_OF_MESSAGE])
-        reply = list(SERIAL_PORT.read_until(expected=[END_OF_MESSAGE]))
+        (millis_value,) = await connection.transport.request(TctlmIds.MILLIS)
+        connection.observe_millis(millis_value)
 
-        assert not (len(reply) == 4 and reply[1] == TctlmIds.ERR.value), f"Received an error code: {reply[2]}"
-        assert len(reply) == 7, f"Expected reply to be 7 bytes, but was {len(reply)}: {reply}"
-        assert reply[0] == START_OF_MESSAGE, f"Expected reply[0] to be start of message {START_OF_MESSAGE}, but was {reply[0]}"
-        assert reply[1] == TctlmIds.MILLIS.value, f"Expected reply[1] to be TctlmIds.MILLIS {TctlmIds.MILLIS.value}, but was {reply[1]}"
-        assert reply[6] == END_OF_MESSAGE, f"Expected reply[4] to be end of message {END_OF_MESSAGE}, but was {reply[4]}"
+        return millis_value
 
-        # Convert the 4-byte reply to an integer (milliseconds)
-        millis_value = (reply[2] << 24) | (reply[3] << 16) | (reply[4] << 8) | reply[5]
+    except Exception as e:
+        return str(e)
 
-        return millis_value
+
+@my_mcp.tool()
+@timed
+async def board_time(board_millis: int, board: Optional[str] = None) -> Union[dict, str]:
+    """Converts a reading of the board's millis(), eg from `millis` or a
+    logged reading, to host time. The server keeps each board's clock
+    synchronised with the host's, so times converted from different boards
+    can be compared.
+
+    Arguments:
+        board_millis (int): The board's millis().
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict of the host time (seconds since the epoch) and how far out it
+        may be in milliseconds, along with how the clocks compare: the
+        board's offset and drift. A stringified error message if something
+        went wrong.
+    """
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+        assert 0 <= board_millis <= 0xFFFFFFFF, f"millis() is 32 bits, but was {board_millis}"
+
+        if not connection.clock.synced:
+            await connection.clock.sync()
+        return {**connection.timestamp(board_millis), 'clock': connection.clock.describe()}
+
+    except Exception as e:
+        return str(e)
+
+
+BATCH_OPERATIONS = ('pin_mode', 'digital_write', 'analog_write', 'digital_read', 'analog_read', 'millis')
+
+
+def encode_batch_op(op: dict, fqbn: Optional[str]) -> Tuple[TctlmIds, list]:
+    """Convert one `run_batch` operation into its TctlmId and argument bytes,
+    resolving and validating the pin exactly as the single-op tools do."""
+    name = op.get('op')
+    assert name in BATCH_OPERATIONS, (
+        f"Unknown operation '{name}'. Available operations are 'pin_mode', "
+        "'digital_write', 'analog_write', 'digital_read', 'analog_read', 'millis'."
+    )
+    if name == 'millis':
+        return TctlmIds.MILLIS, []
+
+    pin = op.get('pin')
+    assert isinstance(pin, int), f"Operation {op} needs an integer 'pin'"
+    is_analog = name == 'analog_read' or op.get('is_analog', False)
+    if is_analog:
+        assert fqbn is not None, f"Operation {op} uses an analog pin, so `fqbn` is required"
+    pin = resolve_pin(pin, is_analog=is_analog, fqbn=fqbn, pwm=name == 'analog_write')
+
+    if name == 'pin_mode':
+        mode = op.get('mode')
+        assert mode in PIN_MODES, f"Invalid mode '{mode}'. Available modes are 'INPUT', 'OUTPUT', 'INPUT_PULLUP', 'INPUT_PULLDOWN', 'OUTPUT_OPENDRAIN'."
+        return TctlmIds.PIN_MODE, [pin, PIN_MODES[mode]]
+    elif name == 'digital_write':
+        state = op.get('state')
+        assert state in (0, 1), f"State must be 0 (LOW) or 1 (HIGH), but was {state}"
+        return TctlmIds.DIGITAL_WRITE, [pin, state]
+    elif name == 'analog_write':
+        value = op.get('value')
+        assert isinstance(value, int) and 0 <= value <= 255, f"Value must be in range 0-255, but was {value}"
+        return TctlmIds.ANALOG_WRITE, [pin, value]
+    elif name == 'digital_read':
+        return TctlmIds.DIGITAL_READ, [pin]
+    else:
+        return TctlmIds.ANALOG_READ, [pin]
+
+
+@my_mcp.tool()
+@timed
+async def run_batch(
+    operations: list[dict],
+    fqbn: Optional[str] = None,
+    board: Optional[str] = None,
+) -> Union[list, str]:
+    """Runs several pin operations back to back on the arduino in a single
+    round trip. Much faster than calling the individual tools one at a time,
+    and the operations run with microsecond-scale spacing between them.
+
+    Arguments:
+        operations (list[dict]): Up to 16 operations, run in order. Each is a
+        dict with an 'op' key and that operation's arguments:
+            {'op': 'pin_mode', 'pin': int, 'mode': str, 'is_analog': bool (optional)}
+            {'op': 'digital_write', 'pin': int, 'state': 0 or 1}
+            {'op': 'analog_write', 'pin': int, 'value': 0-255, 'is_analog': bool (optional)}
+            {'op': 'digital_read', 'pin': int}
+            {'op': 'analog_read', 'pin': int}
+            {'op': 'millis'}
+        Pins for analog_read are analog pins (eg pin=0 is 'A0'), other pins
+        are digital unless 'is_analog' is true.
+        fqbn (str): The fully qualified board name, used if any operation
+        uses an analog pin. Defaults to the one the board was connected with.
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A list with one result per operation: None for pin_mode/writes, a bool
+        for digital_read, an int for analog_read and millis. Or a stringified
+        error message if something went wrong.
+    """
+    from .codec import BATCH_RESULT_FORMATS, batch_reply_layout, unpack_reply
+    from .datalog import channel_name
+
+    try:
+        assert 0 < len(operations) <= MAX_BATCH_OPS, f"Expected between 1 and {MAX_BATCH_OPS} operations, but got {len(operations)}"
+
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        encoded = [encode_batch_op(op, fqbn or connection.fqbn) for op in operations]
+
+        payload = bytearray([len(encoded)])
+        for tctlm_id, args in encoded:
+            payload += bytes([tctlm_id.value, *args])
+        commands = tuple(tctlm_id for tctlm_id, _ in encoded)
+
+        connection.pins.record_batch(encoded)
+        with connection.pins.sending(*(args[0] for _, args in encoded if args)):
+            layout = batch_reply_layout(commands)
+            reply = await connection.transport.exchange(TctlmIds.BATCH.value, bytes(payload), reply_bytes=layout.size)
+            values = iter(unpack_reply(TctlmIds.BATCH, reply, layout))
+
+        results = []
+        readings = {}
+        board_millis = None
+        for op, (tctlm_id, args) in zip(operations, encoded):
+            if tctlm_id == TctlmIds.DIGITAL_READ:
+                results.append(bool(next(values)))
+                readings[channel_name(args[0], False)] = results[-1]
+            elif BATCH_RESULT_FORMATS[tctlm_id]:
+                results.append(next(values))
+                if tctlm_id == TctlmIds.MILLIS:
+                    connection.observe_millis(results[-1])
+                    board_millis = results[-1]
+                else:
+                    readings[channel_name(op['pin'], True)] = results[-1]
+            else:
+                results.append(None)
+        log_readings(connection, readings, board_millis)
+
+        return results
+
+    except Exception as e:
+        return str(e)
+
+
+def resolve_digital_pins(pins: Optional[list[int]], connection: Connection) -> list[int]:
+    """Resolve the pins a bulk digital tool was given, defaulting to every
+    digital pin of the board."""
+    from .boards import find_board
+
+    board = find_board(connection.fqbn)
+    if pins is None:
+        assert board is not None, (
+            f"Don't know the pins of board '{connection.name}', pass `pins` or "
+            "reconnect with `connect_to_arduino(..., fqbn=...)`"
+        )
+        return sorted(board.pin_ports)
+    assert pins, "Expected at least one pin"
+    return sorted({resolve_pin(pin, is_analog=False, fqbn=connection.fqbn) for pin in pins})
+
+
+@my_mcp.tool()
+@timed
+async def digital_read_pins(pins: Optional[list[int]] = None, board: Optional[str] = None) -> Union[dict, str]:
+    """Reads many digital pins at once, in a single round trip. Much faster
+    than calling `digital_read` for each pin, and the pins are read within
+    microseconds of each other.
+
+    Arguments:
+        pins (list[int]): The pins to read (default: every digital pin of the
+        board, which needs the board's FQBN).
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict with the lists of pins that are 'high' and 'low', or a
+        stringified error message if something went wrong.
+    """
+    from .codec import pack_pin_mask, unpack_pin_mask, unpack_reply
+    from .datalog import channel_name
+
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        pins = resolve_digital_pins(pins, connection)
+        first_pin, mask = pack_pin_mask(pins)
+        assert len(mask) <= MAX_PIN_MASK_BYTES, f"Pins must span at most {MAX_PIN_MASK_BYTES * 8} pin numbers"
+
+        reply = await connection.transport.exchange(
+            TctlmIds.DIGITAL_READ_PINS.value, bytes([first_pin]) + mask, reply_bytes=len(mask),
+        )
+        (levels,) = unpack_reply(TctlmIds.DIGITAL_READ_PINS, reply, struct.Struct(f'>{len(mask)}s'))
+
+        high = set(unpack_pin_mask(first_pin, levels))
+        log_readings(connection, {channel_name(pin, False): pin in high for pin in pins})
+        return {
+            'high': [pin for pin in pins if pin in high],
+            'low': [pin for pin in pins if pin not in high],
+        }
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def digital_write_pins(states: dict[int, int], board: Optional[str] = None) -> Union[None, str]:
+    """Writes many digital pins at once, in a single round trip. Much faster
+    than calling `digital_write` for each pin, and the pins change within
+    microseconds of each other.
+
+    Arguments:
+        states (dict[int, int]): Maps each pin to write to its state (0 for
+        LOW, 1 for HIGH).
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        None if successful, or a stringified error message if something went wrong.
+    """
+    from .codec import pack_pin_mask, unpack_reply
+
+    try:
+        assert states, "Expected at least one pin"
+        for pin, state in states.items():
+            assert state in (0, 1), f"State of pin {pin} must be 0 (LOW) or 1 (HIGH), but was {state}"
+
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        states = {
+            resolve_pin(pin, is_analog=False, fqbn=connection.fqbn): state
+            for pin, state in states.items()
+        }
+        # Checked before the shadow records any of the states
+        _, mask = pack_pin_mask(states)
+        assert len(mask) <= MAX_PIN_MASK_BYTES, f"Pins must span at most {MAX_PIN_MASK_BYTES * 8} pin numbers"
+        # Only send the pins that don't already have their state
+        states = {pin: state for pin, state in states.items() if not connection.pins.write(pin, 'digital', state)}
+        if not states:
+            return None
+
+        first_pin, mask = pack_pin_mask(states)
+        levels = bytearray(len(mask))
+        for pin, state in states.items():
+            if state:
+                offset = pin - first_pin
+                levels[offset // 8] |= 1 << (offset % 8)
+
+        with connection.pins.sending(*states):
+            payload = bytes([first_pin, len(mask)]) + mask + levels
+            reply = await connection.transport.exchange(TctlmIds.DIGITAL_WRITE_PINS.value, payload)
+            unpack_reply(TctlmIds.DIGITAL_WRITE_PINS, reply)
+
+        return None  # Success
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def analog_read_pins(
+    pins: Optional[list[int]] = None,
+    fqbn: Optional[str] = None,
+    board: Optional[str] = None,
+) -> Union[dict, str]:
+    """Reads many analog pins at once, in a single round trip. Much faster
+    than calling `analog_read` for each pin.
+
+    Arguments:
+        pins (list[int]): The analog pins to read, eg 0 for 'A0' (default:
+        every analog pin of the board).
+        fqbn (str): The fully qualified board name, defaults to the one the
+        board was connected with
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict mapping each analog pin to its reading (0-1023), or a
+        stringified error message if something went wrong.
+    """
+    from .boards import get_board
+    from .codec import unpack_reply
+    from .datalog import channel_name
+
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        fqbn = connection_fqbn(connection, fqbn)
+        if pins is None:
+            pins = list(range(len(get_board(fqbn).analog_pins)))
+        assert 0 < len(pins) <= MAX_ANALOG_READ_PINS, f"Expected between 1 and {MAX_ANALOG_READ_PINS} pins, but got {len(pins)}"
+        resolved = [resolve_pin(pin, is_analog=True, fqbn=fqbn) for pin in pins]
+
+        layout = struct.Struct('>' + 'H' * len(resolved))
+        reply = await connection.transport.exchange(
+            TctlmIds.ANALOG_READ_PINS.value, bytes(resolved), reply_bytes=layout.size,
+        )
+        values = unpack_reply(TctlmIds.ANALOG_READ_PINS, reply, layout)
+        log_readings(connection, {channel_name(pin, True): value for pin, value in zip(pins, values)})
+
+        return dict(zip(pins, values))
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def wait_for_pin_change(
+    pin: int,
+    edge: str = 'CHANGE',
+    timeout_s: float = 10,
+    board: Optional[str] = None,
+) -> Union[dict, None, str]:
+    """Waits until a digital pin changes, eg for a button press or a limit
+    switch. Much faster and more reliable than polling `digital_read`: the
+    arduino watches the pin with an interrupt where the pin supports one
+    (otherwise by polling it every loop) and reports the change immediately,
+    so even short pulses are caught.
+
+    The pin stays watched afterwards, use `unwatch_pin` to stop. Recent
+    events are also available from the `events://pins` resource.
+
+    Arguments:
+        pin (int): The digital pin to watch.
+        edge (str): 'RISING' (LOW to HIGH), 'FALLING' (HIGH to LOW) or
+        'CHANGE' (either) (default: 'CHANGE').
+        timeout_s (float): How long to wait, in seconds (default: 10).
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict describing the change: the pin, the edge, how many edges were
+        seen (more than 1 if pulses were merged), the board's millis() when
+        it happened, that as host time (seconds since the epoch) with how
+        far out it may be in milliseconds (once the board's clock is
+        synchronised, shortly after connecting) and how the pin is watched
+        ('interrupt' or 'polling').
+        None if the pin didn't change within `timeout_s`, or a stringified
+        error message if something went wrong.
+    """
+    try:
+        assert edge in PIN_EDGES and edge != 'NONE', f"Invalid edge '{edge}'. Available edges are 'RISING', 'FALLING', 'CHANGE'."
+        assert timeout_s > 0, f"Timeout must be positive, but was {timeout_s}"
+
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        pin = resolve_pin(pin, is_analog=False, fqbn=connection.fqbn)
+        watcher = connection.watcher
+
+        # Start listening before arming, so the first event can't be missed
+        future = watcher.wait(pin, PIN_EDGES[edge])
+        try:
+            to_arm = watcher.edge_to_arm(pin, PIN_EDGES[edge])
+            if to_arm is not None:
+                (interrupt_driven,) = await connection.transport.request(TctlmIds.WATCH_PIN, pin, to_arm)
+                watcher.armed[pin] = to_arm
+                watcher.interrupt_driven[pin] = bool(interrupt_driven)
+            try:
+                event = await asyncio.wait_for(future, timeout_s)
+            except asyncio.TimeoutError:
+                return None
+        finally:
+            watcher.cancel(pin, future)
+
+        return {
+            **connection.describe_event(event),
+            'detection': 'interrupt' if watcher.interrupt_driven.get(pin) else 'polling',
+        }
 
     except Exception as e:
         return str(e)
 
 
 @my_mcp.tool()
-async def check_arduino_cli() -> Tuple[bool, str]:
+@timed
+async def unwatch_pin(pin: int, board: Optional[str] = None) -> Union[None, str]:
+    """Stops watching a pin that `wait_for_pin_change` watched, freeing one
+    of the arduino's 4 watch slots.
+
+    Arguments:
+        pin (int): The digital pin to stop watching.
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        None if successful, or a stringified error message if something went wrong.
+    """
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        pin = resolve_pin(pin, is_analog=False, fqbn=connection.fqbn)
+        await connection.transport.request(TctlmIds.WATCH_PIN, pin, PIN_EDGES['NONE'])
+        connection.watcher.armed.pop(pin, None)
+        connection.watcher.interrupt_driven.pop(pin, None)
+
+        return None  # Success
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def start_stream(
+    pins: list[int],
+    rate_hz: float,
+    fqbn: Optional[str] = None,
+    buffer_seconds: float = 10,
+    board: Optional[str] = None,
+) -> Union[None, str]:
+    """Starts continuously sampling one or more analog pins at a fixed rate.
+    Samples are kept in a buffer on the host, use `stream_stats` to summarise
+    them and `stop_stream` to stop. Starting a new stream replaces any
+    running one.
+
+    The achievable rate is limited by the baud rate: every sample of every pin
+    costs 2 bytes on the wire, plus 4 bytes per sampling instant.
+
+    Arguments:
+        pins (list[int]): The analog pins to sample (eg pin=0 is 'A0'), at most 8.
+        rate_hz (float): How many times per second to sample the pins (0-10000).
+        fqbn (str): The fully qualified board name, used to resolve the pins.
+        Defaults to the one the board was connected with.
+        buffer_seconds (float): How many seconds of history to keep per pin.
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        None if successful, or a stringified error message if something went wrong.
+    """
+    from .codec import unpack_reply
+    from .streaming import AnalogStream
+
+    try:
+        assert 0 < len(pins) <= MAX_STREAM_PINS, f"Expected between 1 and {MAX_STREAM_PINS} pins, but got {len(pins)}"
+        assert len(set(pins)) == len(pins), f"Pins must be unique, but were {pins}"
+        assert 0 < rate_hz <= 10000, f"Rate must be in range 0-10000 Hz, but was {rate_hz}"
+        assert buffer_seconds > 0, f"Buffer must be longer than 0 seconds, but was {buffer_seconds}"
+
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        resolved = {}
+        for pin in pins:
+            resolved[pin] = resolve_pin(pin, is_analog=True, fqbn=connection_fqbn(connection, fqbn))
+
+        stream = AnalogStream(resolved, rate_hz, buffer_seconds)
+        connection.transport.subscribe(TctlmIds.STREAM_DATA.value, stream.ingest)
+        connection.stream = stream
+
+        try:
+            reply = await connection.transport.exchange(TctlmIds.STREAM_START.value, stream.start_payload())
+            unpack_reply(TctlmIds.STREAM_START, reply)
+        except Exception:
+            stream.stop()
+            raise
+
+        return None  # Success
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def stop_stream(board: Optional[str] = None) -> Union[dict, str]:
+    """Stops the running analog stream. The samples collected so far stay
+    available to `stream_stats` until the next stream is started.
+
+    Arguments:
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict describing the stream (pins, rate, frames received and dropped),
+        or a stringified error message if something went wrong.
+    """
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        await connection.transport.request(TctlmIds.STREAM_STOP)
+        connection.transport.subscribe(TctlmIds.STREAM_DATA.value, None)
+
+        if connection.stream is None or not connection.stream.running:
+            return "No stream was running"
+        connection.stream.stop()
+        return connection.stream.status()
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def stream_stats(
+    pin: Optional[int] = None,
+    last_seconds: Optional[float] = None,
+    decimate_to: int = 20,
+    board: Optional[str] = None,
+) -> Union[dict, str]:
+    """Summarises the samples collected by the current (or last) analog
+    stream, without returning every raw sample.
+
+    Arguments:
+        pin (int): The analog pin to summarise (eg pin=0 is 'A0'). Defaults to
+        every streamed pin.
+        last_seconds (float): Only summarise the most recent samples. Defaults
+        to everything still in the buffer.
+        decimate_to (int): How many points the downsampled series should have.
+        Each point is the mean of an equal share of the samples.
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict with the stream's status and, per pin, the sample count, min,
+        max, mean, RMS and a downsampled series of raw 10-bit values (0-1023).
+        Or a stringified error message if something went wrong.
+    """
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        if connection.stream is None:
+            return "No stream has been started, use `start_stream` first"
+        assert 0 < decimate_to <= 1000, f"decimate_to must be in range 1-1000, but was {decimate_to}"
+        if pin is not None:
+            assert pin in connection.stream.buffers, f"Pin {pin} is not being streamed, only {list(connection.stream.buffers)} are"
+
+        pins = list(connection.stream.buffers) if pin is None else [pin]
+        return {
+            **connection.stream.status(),
+            'stats': {p: connection.stream.stats(p, last_seconds, decimate_to) for p in pins},
+        }
+
+    except Exception as e:
+        return str(e)
+
+
+def board_log(board: Optional[str]) -> 'DataLog':
+    """The data log of a connected board, or of a board logged in an
+    earlier session."""
+    from .datalog import DataLog
+
+    connection = CONNECTIONS.find(board) if board is not None else CONNECTIONS.get()
+    if connection is not None:
+        return connection.log
+    assert board is not None, "No board is connected, so `board` is required"
+    log = DataLog(board)
+    assert log.directory.exists(), f"Nothing has been logged for board '{board}'"
+    return log
+
+
+@my_mcp.tool()
+@timed
+async def list_logs(board: Optional[str] = None) -> Union[dict, str]:
+    """Lists the readings logged for a board. Every `digital_read`,
+    `analog_read`, `run_batch` and bulk read is logged to disk, so data
+    gathered earlier (even in earlier sessions) can be queried with
+    `query_log`.
+
+    Arguments:
+        board (str): The alias or port of the board. Only needed when several
+        boards are connected, or to list the logs of a board that isn't
+        connected.
+
+    Returns:
+        A dict mapping each logged channel ('A0' for analog pin 0, 'D2' for
+        digital pin 2) to its number of records and the host times (seconds
+        since the epoch) of the first and last. Or a stringified error message
+        if something went wrong.
+    """
+    try:
+        log = board_log(board)
+        return {name: log.channel(name).describe() for name in log.channels()}
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def query_log(
+    pin: int,
+    is_analog: bool,
+    last_seconds: Optional[float] = None,
+    start_time: Optional[float] = None,
+    end_time: Optional[float] = None,
+    decimate_to: int = 20,
+    threshold: Optional[float] = None,
+    board: Optional[str] = None,
+) -> Union[dict, str]:
+    """Summarises the logged readings of one pin over a window of time,
+    without returning every raw reading. Only the readings in the window are
+    read from disk, so this stays cheap however long the log is.
+
+    Arguments:
+        pin (int): The pin, as passed to the tool that read it (eg 0 for
+        'A0').
+        is_analog (bool): Whether `pin` is an analog pin.
+        last_seconds (float): Only summarise the last this many seconds.
+        start_time (float): The start of the window, in seconds since the
+        epoch (default: the first reading).
+        end_time (float): The end of the window, in seconds since the epoch
+        (default: now).
+        decimate_to (int): How many equal slices of the window to report the
+        mean of (default: 20).
+        threshold (float): Also count the times the reading crossed this
+        value, and report when the first few crossings happened.
+        board (str): The alias or port of the board. Only needed when several
+        boards are connected, or to query the logs of a board that isn't
+        connected.
+
+    Returns:
+        A dict with the window, the count, min, max and mean of the readings,
+        the mean of each slice ('decimated', None where there were no
+        readings) and any threshold crossings. Or a stringified error message
+        if something went wrong.
+    """
+    from .datalog import channel_name, summarize_window
+
+    try:
+        assert 0 < decimate_to <= 1000, f"decimate_to must be in range 1-1000, but was {decimate_to}"
+        assert last_seconds is None or start_time is None, "Give either `last_seconds` or `start_time`, not both"
+
+        log = board_log(board)
+        name = channel_name(pin, is_analog)
+        assert name in log.channels(), f"Nothing has been logged for {name}. Logged channels are {log.channels()}"
+        channel = log.channel(name)
+
+        end = time.time() if end_time is None else end_time
+        if last_seconds is not None:
+            assert last_seconds > 0, f"last_seconds must be positive, but was {last_seconds}"
+            start = end - last_seconds
+        else:
+            start = channel.describe().get('first_time', end) if start_time is None else start_time
+        assert start < end, f"The window must start before it ends, but was {start} to {end}"
+
+        return {
+            'channel': name,
+            'start_time': round(start, 3),
+            'end_time': round(end, 3),
+            **summarize_window(channel.scan(start, end), start, end, decimate_to, threshold),
+        }
+
+    except Exception as e:
+        return str(e)
+
+
+SCHEDULE_OPERATIONS = ('pin_mode', 'digital_write', 'analog_write')
+
+
+@my_mcp.tool()
+@timed
+async def start_schedule(
+    steps: list[dict],
+    runs: int = 1,
+    period_ms: Optional[int] = None,
+    fqbn: Optional[str] = None,
+    board: Optional[str] = None,
+) -> Union[dict, str]:
+    """Runs a timeline of pin operations on the arduino itself, timed by its
+    own clock. Use this instead of `digital_write` and `delay` calls for
+    anything timing sensitive, like stepping a motor, blinking patterns or
+    servo sweeps: every step runs within a millisecond of its offset however
+    slow the host is, and the server stays free while it runs.
+
+    Use `schedule_status` to check on it, `wait_for_schedule` to wait for it
+    to finish and `stop_schedule` to stop it early. Starting a schedule
+    replaces any running one.
+
+    Arguments:
+        steps (list[dict]): Up to 32 steps, each a `run_batch` operation
+        ('pin_mode', 'digital_write' or 'analog_write') with an 'at_ms' key
+        giving its offset in milliseconds from the start of the run, eg
+        {'at_ms': 500, 'op': 'digital_write', 'pin': 13, 'state': 0}.
+        runs (int): How many times to run the timeline, or 0 to repeat it
+        until stopped (default: 1).
+        period_ms (int): Milliseconds between the starts of consecutive runs,
+        at least the last step's offset. Required unless runs is 1.
+        fqbn (str): The fully qualified board name, used if any step uses an
+        analog pin. Defaults to the one the board was connected with.
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict describing the schedule: its steps, runs, period and total
+        duration in milliseconds (None if it repeats forever). Or a
+        stringified error message if something went wrong.
+    """
+    from .codec import SCHEDULE_STEP, unpack_reply
+    from .scheduler import Schedule
+
+    try:
+        assert 0 < len(steps) <= MAX_SCHEDULE_STEPS, f"Expected between 1 and {MAX_SCHEDULE_STEPS} steps, but got {len(steps)}"
+        assert 0 <= runs <= 0xFFFF, f"Runs must be in range 0-65535, but was {runs}"
+        for step in steps:
+            assert step.get('op') in SCHEDULE_OPERATIONS, (
+                f"Step {step} has an invalid operation. Available operations "
+                "are 'pin_mode', 'digital_write', 'analog_write'."
+            )
+            at_ms = step.get('at_ms')
+            assert isinstance(at_ms, int) and 0 <= at_ms <= 0xFFFFFFFF, f"Step {step} needs an 'at_ms' offset of at least 0"
+
+        steps = sorted(steps, key=lambda step: step['at_ms'])
+        last_ms = steps[-1]['at_ms']
+        if period_ms is None:
+            assert runs == 1, "`period_ms` is required to repeat a schedule"
+            period_ms = last_ms
+        assert last_ms <= period_ms <= 0xFFFFFFFF, f"Period must be at least the last step's offset ({last_ms} ms), but was {period_ms}"
+        assert runs == 1 or period_ms > 0, "Period must be positive to repeat a schedule"
+
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        encoded = [encode_batch_op(step, fqbn or connection.fqbn) for step in steps]
+
+        # The firmware won't load steps over a running schedule
+        if connection.schedule is not None and not connection.schedule.done.done():
+            await connection.transport.request(TctlmIds.SCHEDULE_STOP)
+            connection.schedule.stop()
+
+        loads = []
+        for first in range(0, len(encoded), MAX_SCHEDULE_LOAD_STEPS):
+            payload = bytearray([first])
+            for step, (tctlm_id, args) in zip(steps[first:], encoded[first:first + MAX_SCHEDULE_LOAD_STEPS]):
+                payload += SCHEDULE_STEP.pack(step['at_ms'], tctlm_id.value, *args)
+            loads.append(connection.transport.exchange(TctlmIds.SCHEDULE_LOAD.value, bytes(payload)))
+        for reply in await asyncio.gather(*loads):
+            unpack_reply(TctlmIds.SCHEDULE_LOAD, reply)
+
+        # The board drives the scheduled pins from now on, so the host can't
+        # model them until the schedule ends
+        pins = frozenset(args[0] for _, args in encoded)
+        schedule = Schedule(len(encoded), runs, period_ms, last_ms, pins)
+        connection.pins.untrack(pins)
+        schedule.done.add_done_callback(lambda _: connection.pins.track(pins))
+        connection.schedule = schedule
+        connection.transport.subscribe(TctlmIds.SCHEDULE_DONE.value, schedule.ingest)
+
+        try:
+            await connection.transport.request(TctlmIds.SCHEDULE_START, len(encoded), runs, period_ms)
+        except Exception:
+            schedule.stop('IDLE')
+            raise
+
+        return {
+            'steps': schedule.steps,
+            'runs': runs,
+            'period_ms': period_ms,
+            'duration_ms': schedule.duration_ms(),
+        }
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def schedule_status(board: Optional[str] = None) -> Union[dict, str]:
+    """Checks on the schedule started by `start_schedule`.
+
+    Arguments:
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict with the schedule's state ('IDLE', 'RUNNING', 'DONE' or
+        'STOPPED'), the next step to run, how many runs have completed and
+        the latest any step has run in milliseconds. Or a stringified error
+        message if something went wrong.
+    """
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        state, next_step, runs_completed, max_late_ms = await connection.transport.request(TctlmIds.SCHEDULE_STATUS)
+        state = SCHEDULE_STATES.get(state, str(state))
+
+        # In case the SCHEDULE_DONE report was lost
+        if state != 'RUNNING' and connection.schedule is not None:
+            connection.schedule.stop(state)
+
+        return {
+            'state': state,
+            'next_step': next_step,
+            'runs_completed': runs_completed,
+            'max_late_ms': max_late_ms,
+        }
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def wait_for_schedule(timeout_s: float = 60, board: Optional[str] = None) -> Union[dict, None, str]:
+    """Waits for the schedule started by `start_schedule` to finish. The
+    arduino reports the end itself, so this returns as soon as it's done.
+
+    Arguments:
+        timeout_s (float): How long to wait, in seconds (default: 60).
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict describing how the schedule ended: its state ('DONE',
+        'STOPPED', or 'LOST' or 'RESET' if the board was disconnected or
+        reset), and for schedules that ran to the end the runs completed, the
+        latest any step ran in milliseconds and the board's millis() at the
+        end, also as host time like `wait_for_pin_change`'s. None if it's
+        still running after `timeout_s`, or a stringified error message if
+        something went wrong.
+    """
+    try:
+        assert timeout_s > 0, f"Timeout must be positive, but was {timeout_s}"
+
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+        if connection.schedule is None:
+            return "No schedule was started"
+
+        try:
+            # Shielded so that timing out doesn't cancel the schedule's future
+            result = await asyncio.wait_for(asyncio.shield(connection.schedule.done), timeout_s)
+        except asyncio.TimeoutError:
+            return None
+        return with_timestamp(connection, result)
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def stop_schedule(board: Optional[str] = None) -> Union[dict, str]:
+    """Stops the schedule started by `start_schedule`. Pins keep whatever
+    state the last step that ran left them in.
+
+    Arguments:
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict describing how the schedule ended, as for
+        `wait_for_schedule`, or a stringified error message if something went
+        wrong.
+    """
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        await connection.transport.request(TctlmIds.SCHEDULE_STOP)
+
+        if connection.schedule is None:
+            return "No schedule was started"
+        connection.schedule.stop()
+        return with_timestamp(connection, connection.schedule.done.result())
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def play_waveform(
+    pins: list[int],
+    rate_hz: float,
+    samples: Optional[list[list[int]]] = None,
+    repeat: int = 1,
+    shape: Optional[str] = None,
+    frequency_hz: float = 1,
+    low: int = 0,
+    high: int = 255,
+    duration_s: Optional[float] = None,
+    board: Optional[str] = None,
+) -> Union[dict, str]:
+    """Plays a PWM waveform on one or more pins at a fixed sample rate, eg to
+    fade LEDs or ramp motors smoothly. The arduino writes every sample out
+    itself at up to kHz rates, while the host keeps its buffer topped up in
+    the background. Use `playback_status` to check on it and `stop_playback`
+    to stop. Starting a waveform replaces any playing one.
+
+    Give either `samples` to play, or a `shape` to generate.
+
+    Arguments:
+        pins (list[int]): The PWM pins to drive, at most 4.
+        rate_hz (float): Samples per second (0-10000). Limited by the baud
+        rate: every sample costs about 1.2 bytes per pin on the wire.
+        samples (list[list[int]]): One list of PWM values (0-255) per pin,
+        all the same length.
+        repeat (int): How many times to play `samples`, or 0 to repeat them
+        until stopped (default: 1).
+        shape (str): 'sine', 'triangle', 'square' or 'sawtooth', played on
+        every pin.
+        frequency_hz (float): Cycles per second of `shape` (default: 1).
+        low (int): The lowest PWM value of `shape` (default: 0).
+        high (int): The highest PWM value of `shape` (default: 255).
+        duration_s (float): How long to play `shape` for, in seconds
+        (default: until stopped).
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict describing the playback, or a stringified error message if
+        something went wrong.
+    """
+    from .playback import Playback, frames_from_samples, waveform
+
+    try:
+        assert 0 < len(pins) <= MAX_PLAYBACK_PINS, f"Expected between 1 and {MAX_PLAYBACK_PINS} pins, but got {len(pins)}"
+        assert len(set(pins)) == len(pins), f"Pins must be unique, but were {pins}"
+        assert 0 < rate_hz <= 10000, f"Rate must be in range 0-10000 Hz, but was {rate_hz}"
+        assert (samples is None) != (shape is None), "Give either `samples` or `shape`"
+
+        if samples is not None:
+            assert len(samples) == len(pins), f"Expected one list of samples per pin ({len(pins)}), but got {len(samples)}"
+            assert samples[0] and all(len(s) == len(samples[0]) for s in samples), "Every pin needs the same number of samples, at least one"
+            assert all(0 <= v <= 255 for s in samples for v in s), "Samples must be in range 0-255"
+            assert repeat >= 0, f"Repeat must be at least 0, but was {repeat}"
+            frames = frames_from_samples(samples, repeat)
+        else:
+            assert 0 <= low <= high <= 255, f"Expected 0 <= low <= high <= 255, but got low={low}, high={high}"
+            assert 0 < frequency_hz <= rate_hz / 2, f"Frequency must be in range 0-{rate_hz / 2} Hz (half the rate), but was {frequency_hz}"
+            values = waveform(shape, frequency_hz, rate_hz, low, high)
+            if duration_s is not None:
+                assert duration_s > 0, f"Duration must be positive, but was {duration_s}"
+                values = itertools.islice(values, int(round(duration_s * rate_hz)))
+            frames = (bytes([value]) * len(pins) for value in values)
+
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+
+        # Each chunk costs its samples plus a 6 byte header, and every byte
+        # 10 bits on the wire
+        chunk_samples = MAX_PLAYBACK_CHUNK_BYTES // len(pins)
+        bits_per_s = rate_hz * 10 * (len(pins) + 6 / chunk_samples)
+        assert bits_per_s <= connection.transport.baud_rate, (
+            f"Playing {len(pins)} pins at {rate_hz} Hz needs about "
+            f"{int(bits_per_s)} baud, but the board is connected at "
+            f"{connection.transport.baud_rate}"
+        )
+
+        resolved = {pin: resolve_pin(pin, is_analog=False, fqbn=connection.fqbn, pwm=True) for pin in pins}
+
+        if connection.playback is not None and not connection.playback.done.done():
+            await connection.playback.stop()
+
+        # The board drives the pins until playback ends
+        playback = Playback(connection.transport, resolved, rate_hz)
+        connection.pins.untrack(resolved.values())
+        connection.playback = playback
+
+        def track(_) -> None:
+            # A playback replacing this one may already drive the pins
+            if connection.playback is playback:
+                connection.pins.track(resolved.values())
+
+        playback.done.add_done_callback(track)
+        connection.transport.subscribe(TctlmIds.PLAYBACK_CREDIT.value, playback.ingest)
+
+        try:
+            await playback.start(frames)
+        except Exception:
+            playback.finish('FAILED')
+            raise
+
+        return {
+            'pins': pins,
+            'rate_hz': rate_hz,
+            'buffer_samples': playback.capacity,
+            'duration_s': len(samples[0]) * repeat / rate_hz if samples is not None and repeat else duration_s,
+        }
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def playback_status(board: Optional[str] = None) -> Union[dict, str]:
+    """Checks on the waveform started by `play_waveform`.
+
+    Arguments:
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict with the playback's state ('PLAYING', 'DONE', 'STOPPED' or
+        'FAILED'), how many samples were sent and played, and how many times
+        the board ran out of samples (underruns). Or a stringified error
+        message if something went wrong.
+    """
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+        if connection.playback is None:
+            return "No waveform was played"
+        return connection.playback.status()
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def stop_playback(board: Optional[str] = None) -> Union[dict, str]:
+    """Stops the waveform started by `play_waveform`. The pins keep their
+    last value.
+
+    Arguments:
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns:
+        A dict describing the playback, as for `playback_status`, or a
+        stringified error message if something went wrong.
+    """
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+        if connection.playback is None:
+            return "No waveform was played"
+        return await connection.playback.stop()
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def check_arduino_cli(refresh: bool = False) -> Tuple[bool, str]:
     """Checks if the arduino-cli command-line tool is available on the system.
 
+    Arguments:
+        refresh (bool): Check again rather than answering from the cached
+        board inventory (default: False).
+
     Returns: A (bool, str) tuple. True if there is an arduino cli available.
     False otherwise. The string is either the stdout of `arduino-cli version`,
     or it is the stderr/exception that occured."""
     try:
-        # Run arduino-cli --version to check if the tool is installed
-        result = subprocess.run(['arduino-cli', 'version'], capture_output=True, text=True, check=True)
-        if result.returncode == 0:
-            return (True, result.stdout)
+        if refresh:
+            await DISCOVERY.refresh()
         else:
-            return (False, f"returncode is {result.returncode}, stderr: {result.stderr}")
+            await DISCOVERY.start()
+        return DISCOVERY.cli
     except Exception as e:
         return (False, str(e))
 
 
 @my_mcp.tool()
-async def list_arduino_boards() -> Union[list, str]:
-    """Gets and parses the list of connected Arduino boards in JSON format
-    using `arduino-cli board list --json`.
+@timed
+async def list_arduino_boards(refresh: bool = False) -> Union[list, str]:
+    """Lists the connected Arduino boards found by `arduino-cli board list`.
+
+    The list is cached and kept up to date in the background: it's refreshed
+    as soon as a serial port appears or disappears, and every 30 seconds
+    otherwise. Subscribe to the `devices://inventory` resource to be notified
+    when a board is plugged in or unplugged.
+
+    Arguments:
+        refresh (bool): Run arduino-cli now rather than answering from the
+        cache (default: False).
 
     Returns either a list of dictionaries, or a string with an error message
     the dictionaries have the format:
@@ -401,86 +1530,189 @@ async def list_arduino_boards() -> Union[list, str]:
     { "port": str, "board_name": str, "fqbn": str }
     """
     try:
-        # Run arduino-cli board list --json to get the list of boards in JSON format
-        result = subprocess.run(['arduino-cli', 'board', 'list', '--json'], capture_output=True, text=True, check=True)
-
-        if result.returncode != 0:
-            return f"Return code is {result.returncode}, stderr: {result.stderr}"
-
-        # Parse the JSON output
-        data = json.loads(result.stdout)
-
-        boards = []
-        for entry in data.get("detected_ports", []):
-            # Check if the entry has matching_boards and parse accordingly
-            if "matching_boards" in entry:
-                for board in entry["matching_boards"]:
-                    boards.append({
-                        "port": entry["port"]["address"],
-                        "board_name": board["name"],
-                        "fqbn": board["fqbn"],
-                    })
-
-        return boards
+        if refresh:
+            await DISCOVERY.refresh()
+        else:
+            await DISCOVERY.start()
+        return DISCOVERY.boards
 
     except Exception as e:
         return str(e)
 
 
 @my_mcp.tool()
-async def list_devices() -> list[str]:
+@timed
+async def list_devices(refresh: bool = False) -> list[str]:
     """List the available serial ports/COM ports. One of these might be an
     Arduino that can be connected to. Empty if no serial ports are found. See
     also `list_arduino_boards` (iff the arduino-cli is available)
 
+    Arguments:
+        refresh (bool): Enumerate the ports now rather than answering from
+        the cache, which is at most a second old (default: False).
+
     Returns: A list of (port_name, description) tuples
     """
-    ports = serial.tools.list_ports.comports()
+    if refresh:
+        await DISCOVERY.refresh()
+    else:
+        await DISCOVERY.start()
+    ports = DISCOVERY.ports
     if not ports:
-        print("No serial ports found.")
+        logger.info("No serial ports found.")
         return []
-    for i, port in enumerate(ports):
-        print(f"{i + 1}: {port.device} - {port.description}")
+    for i, (device, description) in enumerate(ports):
+        logger.debug("%d: %s - %s", i + 1, device, description)
 
-    return [(port.device, port.description) for port in ports]
+    return list(ports)
 
 
 @my_mcp.tool()
-async def disconnect_from_arduino() -> bool:
-    global SERIAL_PORT
+@timed
+async def list_connections() -> list[dict]:
+    """List the boards the server is currently connected to.
+
+    Returns: A list of dicts with the format
+    { "board": str, "port": str, "fqbn": str or None, "streaming": bool }
+    where "board" is the name to pass as the `board` argument of other tools.
+    """
+    return [connection.describe() for connection in CONNECTIONS]
+
+
+@my_mcp.tool()
+@timed
+async def pin_cache_stats(board: Optional[str] = None) -> Union[dict, str]:
+    """Show how many commands the host-side pin cache has saved. The server
+    remembers the modes and outputs it has set on each board, so pin_mode,
+    digital_write and analog_write calls that wouldn't change anything are
+    skipped, and digital_read of an OUTPUT pin is answered without asking
+    the board.
+
+    Arguments:
+        board (str): The alias or port of the board, only needed when several
+        boards are connected.
+
+    Returns: A dict with the number of cache hits (commands skipped), misses,
+    the hit rate and how many board resets have been detected, or a
+    stringified error message if something went wrong.
+    """
     try:
-        if SERIAL_PORT is not None:
-            SERIAL_PORT.close()
-            SERIAL_PORT = None
+        connection = CONNECTIONS.get(board)
+        if connection is None:
+            return SERIAL_PORT_NC_MESSAGE
+        return connection.pins.stats()
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
+async def disconnect_from_arduino(board: Optional[str] = None) -> bool:
+    """Disconnect from a board, leaving any other boards connected.
+
+    Args:
+        board: The alias or port of the board, only needed when several boards
+        are connected.
+
+    Returns: True if the board was disconnected (or nothing was connected),
+    False otherwise.
+    """
+    try:
+        connection = CONNECTIONS.get(board)
+        if connection is not None:
+            CONNECTIONS.remove(connection)
+            connection.pins.invalidate()
+            await connection.close()
     except:
         return False
     return True
 
 
+async def open_transport(
+    port: str,
+    settings: dict,
+    timeout_s: float,
+    reset_board: bool,
+    negotiate_baud: bool,
+) -> Tuple['SerialTransport', Optional[float]]:
+    """Open `port` and wait for the firmware to answer.
+
+    Returns: The transport, and how long the firmware took to answer, or None
+    if it didn't (in which case the baud rate isn't negotiated either).
+    """
+    from .transport import SerialTransport, open_serial_port
+
+    serial_port = await asyncio.to_thread(open_serial_port, port, reset_board, **settings)
+    transport = SerialTransport(serial_port, timeout_s=timeout_s, stats=METRICS.link(port))
+    try:
+        time_to_ready_s = await transport.wait_until_ready()
+        if negotiate_baud:
+            await transport.negotiate_baud_rate()
+    except TimeoutError:
+        return transport, None
+    except Exception:
+        await transport.close()
+        raise
+    return transport, time_to_ready_s
+
+
 @my_mcp.tool()
+@timed
 async def connect_to_arduino(
     port,
-    baud_rate=9600,
+    baud_rate=DEFAULT_BAUD_RATE,
     timeout_s=1,
     parity='NONE',
     stop_bits=1,
     byte_size=8,
-) -> bool:
+    fqbn: Optional[str] = None,
+    alias: Optional[str] = None,
+    negotiate_baud: bool = True,
+    reset_board: bool = True,
+) -> Union[dict, bool, str]:
     """Connect to the selected serial port, optionally specifying the
-    connection settings.
+    connection settings. Several boards can be connected at once, connecting
+    to a new port leaves the other boards connected.
+
+    The connection opens at `baud_rate` and waits for the firmware to answer,
+    probing it with ACKs rather than waiting a fixed time for it to come out
+    of reset. Then, unless `negotiate_baud` is False, it switches to the
+    fastest rate the firmware supports (up to 1000000 baud). Boards that
+    can't switch stay at `baud_rate`.
+
+    If the port fails later (eg the board is unplugged), it's reopened in the
+    background as soon as it comes back, and pin watches and the analog
+    stream are restarted.
 
     Args:
         port: The string describing the serial port
         baud_rate: baud rate e.g. transmission speed (default: 9600),
-        timeout_s: timeout in seconds before abandoning the connection (default: 1),
+        timeout_s: the most a command may take beyond the time its bytes
+        spend on the wire and the board spends executing it, before it's
+        abandoned. Commands time out sooner once the link's usual latency has
+        been learnt (default: 1),
         parity: The serial port parity to use (default: 'NONE', options: EVEN, ODD, MARK, SPACE),
         stop_bits: The number of stop bits to use (default: 1, options: 1, 1.5, 2),
         byte_size: The number of bits in a byte (default: 8),
-
-    Returns: False if a connection couldn't be made, otherwise True. The
+        fqbn: The fully qualified board name, remembered so that later tools
+        don't need it (default: None),
+        alias: A short name for the board, used as the `board` argument of
+        other tools (default: the port),
+        negotiate_baud: Whether to switch to a faster baud rate after
+        connecting (default: True),
+        reset_board: Whether to let opening the port reset the board, as it
+        does most AVR boards. Pass False to keep the sketch running and skip
+        the bootloader's delay (default: True),
+
+    Returns: False if a connection couldn't be made, a stringified error
+    message if `alias` is already used by another board, otherwise a dict
+    describing the connection, including the negotiated `baud_rate` and
+    `time_to_ready_s`, how long the firmware took to answer. The
     connection's state is maintained indefinitely.
     """
-    global SERIAL_PORT
+    import serial
+    from .transport import READY_TIMEOUT_S, SerialTransport
+
     parity  = {
         'NONE': serial.PARITY_NONE,
         'EVEN': serial.PARITY_EVEN,
@@ -496,27 +1728,92 @@ async def connect_to_arduino(
     }.get(stop_bits, serial.STOPBITS_ONE)
 
     try:
-        SERIAL_PORT = serial.Serial(
-            port=port,
-            baudrate=baud_rate,
-            bytesize=byte_size,
-            parity=parity,
-            stopbits=stop_bits,
-            timeout=timeout_s,
+        name = alias or port
+        existing = CONNECTIONS.find(name)
+        if existing is not None and existing.port != port:
+            return f"The name '{name}' is already used by the board on {existing.port}"
+
+        # Reconnecting to a port replaces its old connection
+        existing = CONNECTIONS.find(port)
+        if existing is not None:
+            CONNECTIONS.remove(existing)
+            await existing.close()
+
+        settings = {
+            'baudrate': baud_rate,
+            'bytesize': byte_size,
+            'parity': parity,
+            'stopbits': stop_bits,
+        }
+
+        async def reopen() -> Tuple[SerialTransport, Optional[float]]:
+            return await open_transport(port, settings, timeout_s, reset_board, negotiate_baud)
+
+        transport, time_to_ready_s = await reopen()
+        connection = Connection(
+            name,
+            transport,
+            fqbn=fqbn,
+            on_pin_event=on_pin_event,
+            reopen=reopen,
+            time_to_ready_s=time_to_ready_s,
         )
-        print(f"Connected to {port} with baud rate {baud_rate}.")
-        return True
+        CONNECTIONS.add(connection)
+        logger.info("Connected to %s with baud rate %d.", port, transport.baud_rate)
+        description = connection.describe()
+        if time_to_ready_s is None:
+            description['warning'] = (
+                f"The firmware didn't answer within {READY_TIMEOUT_S}s. Use "
+                "`upload_chat_with_arduino_firmware` to upload it."
+            )
+        return description
     except serial.SerialException as e:
-        print(f"Failed to connect to {port}: {e}")
+        logger.warning("Failed to connect to %s: %s", port, e)
         return False
 
+
+@my_mcp.tool()
+@timed
+async def attach_arduino_boards(baud_rate=DEFAULT_BAUD_RATE, timeout_s=1) -> Union[list, str]:
+    """Connect to every Arduino board found by `list_arduino_boards` that isn't
+    already connected, remembering each board's FQBN. Each board's port is
+    used as its `board` name.
+
+    Args:
+        baud_rate: baud rate e.g. transmission speed (default: 9600),
+        timeout_s: timeout in seconds before abandoning a command (default: 1),
+
+    Returns: A list of dicts with the format
+    { "port": str, "board_name": str, "fqbn": str, "connected": bool }
+    or a string with an error message.
+    """
+    # Boards plugged in a moment ago may not be in the cache yet
+    boards = await list_arduino_boards(refresh=True)
+    if isinstance(boards, str):
+        return boards
+
+    results = []
+    for board in boards:
+        connected = CONNECTIONS.find(board["port"]) is not None
+        if not connected:
+            connected = await connect_to_arduino(
+                board["port"],
+                baud_rate=baud_rate,
+                timeout_s=timeout_s,
+                fqbn=board["fqbn"],
+            ) is not False
+        results.append({**board, "connected": connected})
+    return results
+
 @my_mcp.tool()
+@timed
 async def upload_chat_with_arduino_firmware(fqbn: str, port: str) -> tuple:
     """Re-upload the Chat With Arduino firmware to the board.
 
     The arduino should already have the firmware, but if it doesn't or you're
     getting communication protocol errors, you can re-upload the firmware with
-    this.
+    this. The compiled firmware is cached, so only the first upload for each
+    FQBN needs to compile it.
 
     Arguments:
         fqbn (str): The Fully Qualified Board Name (FQBN) of the Arduino board.
@@ -525,24 +1822,161 @@ async def upload_chat_with_arduino_firmware(fqbn: str, port: str) -> tuple:
     Returns:
         tuple: A tuple containing the return code and either the stderr or stdout.
     """
+    from .build_cache import BUILD_CACHE
+
     try:
         # Run the compile and upload command
         script_dir = os.path.dirname(os.path.abspath(__file__))
-        result = subprocess.run(['arduino-cli', 'compile', '--fqbn', fqbn, '--port', port, '--upload', script_dir], capture_output=True, text=True)
+        returncode, stdout, stderr = await asyncio.to_thread(
+            BUILD_CACHE.compile_and_upload, script_dir, fqbn, port,
+        )
+        invalidate_pins(port)
 
         # Return the result
-        if result.returncode == 0:
-            return (result.returncode, result.stdout)
+        if returncode == 0:
+            return (returncode, stdout)
         else:
-            return (result.returncode, '---stderr---\n' + result.stderr + '\n---stdout---\n' + result.stdout)
+            return (returncode, '---stderr---\n' + stderr + '\n---stdout---\n' + stdout)
 
     except Exception as e:
         return (1, str(e))
 
 
+async def reconnect(connection: Connection) -> Union[dict, str]:
+    """Connect again to the board of a closed connection, with the same
+    name and settings. Returns the new connection's description, or why it
+    couldn't be made."""
+    if connection.reopen is None:
+        return f"Couldn't reconnect to {connection.port}, use `connect_to_arduino`"
+    try:
+        transport, time_to_ready_s = await connection.reopen()
+        reconnected = Connection(
+            connection.name,
+            transport,
+            fqbn=connection.fqbn,
+            on_pin_event=on_pin_event,
+            reopen=connection.reopen,
+            time_to_ready_s=time_to_ready_s,
+        )
+        CONNECTIONS.add(reconnected)
+        return reconnected.describe()
+    except Exception as e:
+        return f"Couldn't reconnect to {connection.port}: {e}"
+
+
 @my_mcp.tool()
+@timed
+async def flash_boards(
+    boards: Optional[list[str]] = None,
+    fqbn: Optional[str] = None,
+    max_parallel: int = 4,
+) -> Union[dict, str]:
+    """Upload the Chat With Arduino firmware to several boards at once, eg to
+    bring up a rack of them. The firmware is compiled once per distinct FQBN
+    (or taken from the build cache), then uploaded to up to `max_parallel`
+    boards at a time.
+
+    Arguments:
+        boards (list[str]): The ports (or aliases of connected boards) to
+        flash. Defaults to every board `list_arduino_boards` finds.
+        fqbn (str): The FQBN of every board. Defaults to each board's own,
+        as it was connected with or as found by `list_arduino_boards`.
+        max_parallel (int): The most uploads to run at once (default: 4).
+
+    Connected boards are disconnected while they're flashed, then connected
+    again with the same alias and settings.
+
+    Returns:
+        A dict with the result of each board, in the format
+        { "port": str, "fqbn": str, "ok": bool, "upload_s": float, "output": str,
+        "connection": dict or str }
+        (the output only on failure, the connection only for boards that were
+        connected: its description, or why it couldn't be reconnected), how
+        long each FQBN took to compile, and the total time taken. Or a
+        stringified error message.
+    """
+    from .build_cache import BUILD_CACHE
+
+    try:
+        assert max_parallel > 0, f"max_parallel must be positive, but was {max_parallel}"
+        start = time.perf_counter()
+        if boards is None:
+            # Boards plugged in a moment ago may not be in the cache yet
+            await DISCOVERY.refresh()
+        else:
+            await DISCOVERY.start()
+        found = {} if isinstance(DISCOVERY.boards, str) else {b['port']: b['fqbn'] for b in DISCOVERY.boards}
+        if boards is None:
+            if isinstance(DISCOVERY.boards, str):
+                return DISCOVERY.boards
+            boards = list(found)
+
+        targets = []
+        for board in dict.fromkeys(boards):
+            connection = CONNECTIONS.find(board)
+            port = connection.port if connection is not None else board
+            board_fqbn = fqbn or (connection.fqbn if connection is not None else None) or found.get(port)
+            assert board_fqbn is not None, f"The FQBN of '{board}' isn't known, pass it as `fqbn`"
+            targets.append((port, board_fqbn))
+        if not targets:
+            return "No boards to flash"
+
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        fqbns = list(dict.fromkeys(board_fqbn for _, board_fqbn in targets))
+        builds = dict(zip(fqbns, await asyncio.gather(*(
+            asyncio.to_thread(BUILD_CACHE.build, script_dir, board_fqbn) for board_fqbn in fqbns
+        ))))
+
+        slots = asyncio.Semaphore(max_parallel)
+
+        async def flash(port: str, board_fqbn: str) -> dict:
+            build = builds[board_fqbn]
+            result = {'port': port, 'fqbn': board_fqbn}
+            if build.directory is None:
+                return {**result, 'ok': False, 'upload_s': 0.0, 'output': f"Compiling failed:\n{build.stderr}"}
+            async with slots:
+                # The uploader needs the port to itself, so a connected board
+                # is disconnected (stopping its reconnecting and clock sync)
+                # until the upload is done
+                connection = CONNECTIONS.find(port)
+                if connection is not None:
+                    CONNECTIONS.remove(connection)
+                    await connection.close()
+                upload_start = time.perf_counter()
+                returncode, stdout, stderr = await asyncio.to_thread(
+                    BUILD_CACHE.upload, build, script_dir, board_fqbn, port,
+                )
+                result['upload_s'] = round(time.perf_counter() - upload_start, 3)
+            result['ok'] = returncode == 0
+            if returncode != 0:
+                result['output'] = '---stderr---\n' + stderr + '\n---stdout---\n' + stdout
+            if connection is not None:
+                result['connection'] = await reconnect(connection)
+            return result
+
+        try:
+            results = await asyncio.gather(*(flash(port, board_fqbn) for port, board_fqbn in targets))
+        finally:
+            for build in builds.values():
+                if build.directory is not None and not build.persistent:
+                    shutil.rmtree(build.directory, ignore_errors=True)
+
+        return {
+            'boards': results,
+            'compile_s': {board_fqbn: round(build.compile_s, 3) for board_fqbn, build in builds.items()},
+            'elapsed_s': round(time.perf_counter() - start, 3),
+        }
+
+    except Exception as e:
+        return str(e)
+
+
+@my_mcp.tool()
+@timed
 async def compile_and_upload_arduino_program(program_code: str, program_name: str, fqbn: str, port: str) -> tuple:
     """Compiles and uploads an Arduino program to a given board using arduino-cli.
+    Compiled programs are cached, so uploading the same code to the same kind
+    of board again skips compilation.
 
     Arguments:
         program_code (str): The complete Arduino program code.
@@ -553,6 +1987,8 @@ async def compile_and_upload_arduino_program(program_code: str, program_name: st
     Returns:
         tuple: A tuple containing the return code and either the stderr or stdout.
     """
+    from .build_cache import BUILD_CACHE
+
     try:
         # Check if program_name contains spaces
         if " " in program_name:
@@ -570,19 +2006,111 @@ async def compile_and_upload_arduino_program(program_code: str, program_name: st
             program_file.write(program_code)
 
         # Run the compile and upload command
-        command = ['arduino-cli', 'compile', '--fqbn', fqbn, '--port', port, '--upload', program_dir]
-        result = subprocess.run(command, capture_output=True, text=True)
+        returncode, stdout, stderr = await asyncio.to_thread(
+            BUILD_CACHE.compile_and_upload, program_dir, fqbn, port,
+        )
+        invalidate_pins(port)
 
         # Return the result
-        if result.returncode == 0:
-            return (result.returncode, result.stdout)
+        if returncode == 0:
+            return (returncode, stdout)
         else:
-            return (result.returncode, '---stderr---\n' + result.stderr + '\n---stdout---\n' + result.stdout)
+            return (returncode, '---stderr---\n' + stderr + '\n---stdout---\n' + stdout)
 
     except Exception as e:
         return (1, str(e))
 
 
+PIN_EVENTS_URI = "events://pins"
+DEVICES_URI = "devices://inventory"
+
+# The sessions subscribed to each resource URI
+RESOURCE_SUBSCRIPTIONS: dict[str, set] = {}
+
+
+@my_mcp._mcp_server.subscribe_resource()
+async def subscribe_resource(uri: AnyUrl) -> None:
+    session = my_mcp._mcp_server.request_context.session
+    RESOURCE_SUBSCRIPTIONS.setdefault(str(uri), set()).add(session)
+
+
+@my_mcp._mcp_server.unsubscribe_resource()
+async def unsubscribe_resource(uri: AnyUrl) -> None:
+    session = my_mcp._mcp_server.request_context.session
+    RESOURCE_SUBSCRIPTIONS.get(str(uri), set()).discard(session)
+
+
+async def send_resource_updated(session, uri: str) -> None:
+    try:
+        await session.send_resource_updated(AnyUrl(uri))
+    except Exception:
+        # The client has gone away
+        RESOURCE_SUBSCRIPTIONS.get(uri, set()).discard(session)
+
+
+def on_pin_event(event: 'PinEvent') -> None:
+    for session in list(RESOURCE_SUBSCRIPTIONS.get(PIN_EVENTS_URI, ())):
+        asyncio.ensure_future(send_resource_updated(session, PIN_EVENTS_URI))
+
+
+def on_ports_changed(added: list, removed: list) -> None:
+    for session in list(RESOURCE_SUBSCRIPTIONS.get(DEVICES_URI, ())):
+        asyncio.ensure_future(send_resource_updated(session, DEVICES_URI))
+
+
+DISCOVERY.on_change = on_ports_changed
+
+
+@my_mcp.resource(PIN_EVENTS_URI, mime_type="application/json")
+def pin_events() -> str:
+    """The most recent pin change events of every connected board, oldest
+    first. Subscribe to be notified as soon as a new event arrives."""
+    return json.dumps([
+        {'board': connection.name, **connection.describe_event(event)}
+        for connection in CONNECTIONS
+        for event in connection.watcher.history
+    ], indent=2)
+
+
+@my_mcp.resource(DEVICES_URI, mime_type="application/json")
+async def devices() -> str:
+    """The serial ports and Arduino boards plugged in, and how old that
+    information is. Subscribe to be notified when a port appears or
+    disappears."""
+    await DISCOVERY.start()
+    return json.dumps(DISCOVERY.describe(), indent=2)
+
+
+@my_mcp.resource("metrics://summary", mime_type="application/json")
+def metrics_summary() -> str:
+    """Latency histograms of every tool and serial command, plus bytes,
+    timeouts and errors per board."""
+    return METRICS.to_json()
+
+
+@my_mcp.resource("metrics://prometheus", mime_type="text/plain")
+def metrics_prometheus() -> str:
+    """The same metrics in the Prometheus text exposition format."""
+    return METRICS.to_prometheus()
+
+
+@my_mcp.tool()
+@timed
+async def get_metrics(prometheus: bool = False) -> Union[dict, str]:
+    """Show where time is going: latency percentiles (interpolated within
+    histogram buckets) of every tool and every serial command, and the bytes sent and received, timeouts and protocol
+    errors of each board. Also available as the `metrics://summary` and
+    `metrics://prometheus` resources.
+
+    Arguments:
+        prometheus (bool): Return the metrics in the Prometheus text format
+        instead of as a dict (default: False).
+
+    Returns: The metrics.
+    """
+    return METRICS.to_prometheus() if prometheus else METRICS.summary()
+
+
 def main():
     my_mcp.run(transport='stdio')
 
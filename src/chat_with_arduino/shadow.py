@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Set, Tuple
+
+from .protocol import PIN_MODES, TctlmIds
+
+OUTPUT = PIN_MODES['OUTPUT']
+
+
+class PinShadow:
+    """The host's model of one board's pin modes and last written outputs,
+    used to skip commands that wouldn't change anything on the board.
+
+    Only state the host set itself is modelled, so the model is thrown away
+    whenever the board may have changed behind the host's back: on
+    disconnect, on upload, and when `millis` going backwards shows the board
+    has reset. Pins are keyed by their resolved pin number.
+
+    Pins the board changes by itself (eg from a running schedule) are
+    untracked: commands to them are always sent until they're tracked again.
+
+    Writes are recorded before they're sent, so a command issued while an
+    earlier one is still in flight compares against the state the board will
+    have once the earlier one lands. If a command fails its pin is forgotten.
+    """
+
+    def __init__(self):
+        self.modes: Dict[int, int] = {}
+        # Maps each pin to ('digital', state) or ('pwm', value)
+        self.outputs: Dict[int, Tuple[str, int]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.resets_detected = 0
+        self.untracked: Set[int] = set()
+        self._last_millis: Optional[int] = None
+
+    def invalidate(self) -> None:
+        self.modes.clear()
+        self.outputs.clear()
+        self.untracked.clear()
+        self._last_millis = None
+
+    def untrack(self, pins: Iterable[int]) -> None:
+        """Stop modelling `pins` until `track` is called."""
+        for pin in pins:
+            self.forget(pin)
+            self.untracked.add(pin)
+
+    def track(self, pins: Iterable[int]) -> None:
+        """Start modelling `pins` again, from an unknown state."""
+        for pin in pins:
+            self.forget(pin)
+            self.untracked.discard(pin)
+
+    def forget(self, pin: int) -> None:
+        self.modes.pop(pin, None)
+        self.outputs.pop(pin, None)
+
+    @contextmanager
+    def sending(self, *pins: int) -> Iterator[None]:
+        """Wrap the command that changes `pins`, forgetting them if it fails
+        since the board may or may not have applied it."""
+        try:
+            yield
+        except BaseException:
+            for pin in pins:
+                self.forget(pin)
+            raise
+
+    def _count(self, hit: bool) -> bool:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return hit
+
+    def set_mode(self, pin: int, mode: int) -> bool:
+        """Record a pin_mode. Returns True if the pin already had that mode,
+        in which case the command doesn't need to be sent."""
+        if pin in self.untracked:
+            return self._count(False)
+        if self._count(self.modes.get(pin) == mode):
+            return True
+        self.modes[pin] = mode
+        # Changing mode changes the pin's output latch (eg INPUT clears it
+        # and INPUT_PULLUP sets it), so the last written value is stale
+        self.outputs.pop(pin, None)
+        return False
+
+    def write(self, pin: int, kind: str, value: int) -> bool:
+        """Record a digital ('digital') or PWM ('pwm') write. Returns True if
+        the pin already had that output, in which case the command doesn't
+        need to be sent."""
+        if pin in self.untracked:
+            return self._count(False)
+        if self._count(self.outputs.get(pin) == (kind, value)):
+            return True
+        self.outputs[pin] = (kind, value)
+        return False
+
+    def read(self, pin: int) -> Optional[int]:
+        """The state digital_read would return for `pin`, if it's an OUTPUT
+        the host last drove digitally, otherwise None."""
+        output = self.outputs.get(pin)
+        hit = self.modes.get(pin) == OUTPUT and output is not None and output[0] == 'digital'
+        return output[1] if self._count(hit) else None
+
+    def record_batch(self, operations: Iterable[Tuple[TctlmIds, Sequence[int]]]) -> None:
+        """Record the modes and outputs a batch sets. Batches always run in
+        full, so they don't count towards the hit rate."""
+        for tctlm_id, args in operations:
+            if args and args[0] in self.untracked:
+                continue
+            if tctlm_id == TctlmIds.PIN_MODE:
+                pin, mode = args
+                if self.modes.get(pin) != mode:
+                    self.modes[pin] = mode
+                    self.outputs.pop(pin, None)
+            elif tctlm_id == TctlmIds.DIGITAL_WRITE:
+                self.outputs[args[0]] = ('digital', args[1])
+            elif tctlm_id == TctlmIds.ANALOG_WRITE:
+                self.outputs[args[0]] = ('pwm', args[1])
+
+    def observe_millis(self, value: int) -> None:
+        """Feed in a `millis` reading. It only goes backwards if the board
+        reset (or after ~49 days when it wraps), which clears every pin."""
+        if self._last_millis is not None and value < self._last_millis:
+            self.resets_detected += 1
+            self.invalidate()
+        self._last_millis = value
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else None,
+            'resets_detected': self.resets_detected,
+            'pins_modelled': len(self.modes.keys() | self.outputs.keys()),
+        }
@@ -0,0 +1,679 @@
+"""A simulated Arduino running the Chat With Arduino firmware, behind a
+pseudo-terminal that `connect_to_arduino` can open like any serial port.
+
+It speaks the same protocol as chat-with-arduino.ino, so the server can be
+exercised and benchmarked without hardware. Wire time can be emulated from
+the (negotiated) baud rate, extra latency can be added per byte, and frames
+can be dropped or corrupted on purpose.
+
+Run `python -m chat_with_arduino.simulator` to start one and print its port.
+"""
+import argparse
+import collections
+import os
+import random
+import struct
+import termios
+import threading
+import time
+import tty
+from typing import Dict, Optional
+
+from .codec import FRAME_DELIMITER, REQUEST_LAYOUTS, SCHEDULE_STEP, FrameError, decode_frame, encode_frame, unpack_pin_mask
+from .protocol import (
+    BAUD_CONFIRM_TIMEOUT_S,
+    DEFAULT_BAUD_RATE,
+    MAX_ANALOG_READ_PINS,
+    MAX_BATCH_OPS,
+    MAX_PIN_MASK_BYTES,
+    MAX_PLAYBACK_CHUNK_BYTES,
+    MAX_PLAYBACK_PINS,
+    MAX_SCHEDULE_LOAD_STEPS,
+    MAX_SCHEDULE_STEPS,
+    MAX_STREAM_PINS,
+    MAX_WATCHED_PINS,
+    NEGOTIABLE_BAUD_RATES,
+    PIN_EDGES,
+    PLAYBACK_BUFFER_BYTES,
+    PLAYBACK_LAST_CHUNK,
+    PROTOCOL_VERSION,
+    SCHEDULE_STATES,
+    UNSOLICITED_SEQUENCE_ID,
+    ErrorCodes,
+    TctlmIds,
+)
+
+# Start, 8 data bits and stop: the bits each byte costs on the wire
+BITS_PER_BYTE = 10
+
+# The arguments each batched operation carries, as in the firmware
+BATCH_ARG_LENGTHS = {
+    TctlmIds.PIN_MODE.value: 2,
+    TctlmIds.DIGITAL_WRITE.value: 2,
+    TctlmIds.ANALOG_WRITE.value: 2,
+    TctlmIds.DIGITAL_READ.value: 1,
+    TctlmIds.ANALOG_READ.value: 1,
+    TctlmIds.MILLIS.value: 0,
+}
+
+SCHEDULE_STATE_IDS = {name: value for value, name in SCHEDULE_STATES.items()}
+
+# The operations a schedule step may be
+SCHEDULE_COMMANDS = (TctlmIds.PIN_MODE.value, TctlmIds.DIGITAL_WRITE.value, TctlmIds.ANALOG_WRITE.value)
+
+# Pins with an external interrupt on an Uno. Others are polled by the firmware.
+INTERRUPT_PINS = (2, 3)
+
+
+class SimulatedArduino:
+    """An Arduino running the firmware, simulated on a pseudo-terminal.
+
+    Pins start LOW with analog readings of 0. Tests drive inputs through
+    `digital_inputs` and `analog_inputs` (or `set_input`, which also fires
+    pin change events), and can inspect what the host did through `modes`
+    and `outputs`.
+    """
+
+    def __init__(
+        self,
+        emulate_baud: bool = True,
+        byte_latency_s: float = 0.0,
+        drop_rate: float = 0.0,
+        corrupt_rate: float = 0.0,
+        seed: Optional[int] = None,
+        boot_delay_s: float = 0.0,
+        clock_drift_ppm: float = 0.0,
+    ):
+        """
+        Arguments:
+            emulate_baud: Delay every frame by the time its bytes would take
+            on a real serial link at the current baud rate.
+            byte_latency_s: Extra delay per byte, in both directions.
+            drop_rate: Fraction of requests silently ignored.
+            corrupt_rate: Fraction of replies sent with a byte flipped, so
+            they fail the host's CRC check.
+            seed: Seeds the fault injection, for repeatable runs.
+            boot_delay_s: How long requests are ignored after starting or a
+            reset, like a bootloader waiting for an upload.
+            clock_drift_ppm: How fast millis() runs, in parts per million,
+            like a board's imprecise resonator.
+        """
+        self.emulate_baud = emulate_baud
+        self.byte_latency_s = byte_latency_s
+        self.drop_rate = drop_rate
+        self.boot_delay_s = boot_delay_s
+        self.clock_rate = 1 + clock_drift_ppm / 1_000_000
+        self.corrupt_rate = corrupt_rate
+        self._random = random.Random(seed)
+
+        self.baud_rate = DEFAULT_BAUD_RATE
+        # As on the firmware, a switched rate reverts unless a valid frame
+        # arrives within BAUD_CONFIRM_TIMEOUT_S
+        self.baud_reverts = 0
+        self._previous_baud_rate = DEFAULT_BAUD_RATE
+        self._baud_switched_at: Optional[float] = None
+        self.modes: Dict[int, int] = {}
+        self.outputs: Dict[int, int] = {}
+        self.digital_inputs: Dict[int, int] = {}
+        self.analog_inputs: Dict[int, int] = {}
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.frames_corrupted = 0
+        self.frames_garbled = 0
+        self._booted_at = time.monotonic()
+
+        self._stream_pins: list = []
+        self._stream_period_s = 0.0
+        self._stream_counter = 0
+        self._stream_wake = threading.Event()
+        # The edge watched on each pin
+        self._watches: Dict[int, int] = {}
+
+        self._schedule_steps: list = [None] * MAX_SCHEDULE_STEPS
+        self._schedule_length = 0
+        self._schedule_state = SCHEDULE_STATE_IDS['IDLE']
+        self._schedule_next = 0
+        self._schedule_runs = 0
+        self._schedule_runs_done = 0
+        self._schedule_period_s = 0.0
+        self._schedule_run_start = 0.0
+        self._schedule_max_late_ms = 0
+        self._schedule_wake = threading.Event()
+
+        self._playback_pins: bytes = b''
+        self._playback_period_s = 0.0
+        self._playback_buffer: collections.deque = collections.deque()
+        self._playback_capacity = 0
+        self._playback_active = False
+        self._playback_primed = False
+        self._playback_last_received = False
+        self._playback_played = 0
+        self._playback_underruns = 0
+        self._playback_freed = 0
+        self._playback_lock = threading.Lock()
+        self._playback_wake = threading.Event()
+
+        self._write_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._master: Optional[int] = None
+        self._slave: Optional[int] = None
+        self.port: Optional[str] = None
+
+    def start(self) -> str:
+        """Open the pseudo-terminal and start the firmware. Returns the port
+        to connect to."""
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        for target, name in ((self._run, 'loop'), (self._stream, 'stream'), (self._schedule, 'schedule'),
+                             (self._playback, 'playback')):
+            threading.Thread(target=target, name=f"simulator-{name}", daemon=True).start()
+        return self.port
+
+    def close(self) -> None:
+        self._closed.set()
+        self._stream_wake.set()
+        self._schedule_wake.set()
+        self._playback_wake.set()
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+
+    def reset(self) -> None:
+        """Simulate pressing the reset button."""
+        self.modes.clear()
+        self.outputs.clear()
+        self._stream_pins = []
+        self._watches.clear()
+        self._schedule_state = SCHEDULE_STATE_IDS['IDLE']
+        self._schedule_wake.set()
+        self._playback_active = False
+        self.baud_rate = DEFAULT_BAUD_RATE
+        self._baud_switched_at = None
+        self._booted_at = time.monotonic()
+
+    def millis(self) -> int:
+        return int((time.monotonic() - self._booted_at) * self.clock_rate * 1000) & 0xFFFFFFFF
+
+    def set_input(self, pin: int, level: int) -> None:
+        """Drive a digital input, pushing a PIN_EVENT if the pin is watched
+        for the edge this makes."""
+        level = 1 if level else 0
+        previous = self.digital_inputs.get(pin, 0)
+        self.digital_inputs[pin] = level
+        watched = self._watches.get(pin)
+        if watched is None or level == previous:
+            return
+        edge = PIN_EDGES['RISING'] if level else PIN_EDGES['FALLING']
+        if watched in (edge, PIN_EDGES['CHANGE']):
+            payload = struct.pack('>BBBI', pin, edge, 1, self.millis())
+            self._send(UNSOLICITED_SEQUENCE_ID, TctlmIds.PIN_EVENT, payload)
+
+    def _service_baud_rate(self) -> None:
+        switched_at = self._baud_switched_at
+        if switched_at is not None and time.monotonic() - switched_at >= BAUD_CONFIRM_TIMEOUT_S:
+            # The host never spoke at the new rate, so go back to the old one
+            self._baud_switched_at = None
+            self.baud_rate = self._previous_baud_rate
+            self.baud_reverts += 1
+
+    def _host_at_baud_rate(self) -> bool:
+        """Whether the host has its end of the pty at the simulator's baud
+        rate. A pty passes bytes through whatever the rates, so this is
+        checked to emulate a real link, where a mismatch garbles them."""
+        speed = getattr(termios, f'B{self.baud_rate}', None)
+        if speed is None:
+            return True
+        try:
+            return termios.tcgetattr(self._master)[5] == speed
+        except termios.error:
+            return True
+
+    def _wire_time(self, n_bytes: int) -> float:
+        wire = n_bytes * BITS_PER_BYTE / self.baud_rate if self.emulate_baud else 0.0
+        return wire + n_bytes * self.byte_latency_s
+
+    def _send(self, seq: int, command: TctlmIds, payload: bytes = b'') -> None:
+        data = encode_frame(seq, command.value, payload)
+        if seq != UNSOLICITED_SEQUENCE_ID and self._random.random() < self.corrupt_rate:
+            self.frames_corrupted += 1
+            data = bytearray(data)
+            data[0] ^= 0x01 if data[0] != 0x01 else 0x03
+            data = bytes(data)
+        delay_s = self._wire_time(len(data))
+        if delay_s:
+            time.sleep(delay_s)
+        with self._write_lock:
+            os.write(self._master, data)
+
+    def _run(self) -> None:
+        buffer = bytearray()
+        while not self._closed.is_set():
+            try:
+                chunk = os.read(self._master, 4096)
+            except OSError:
+                return
+            buffer.extend(chunk)
+            while True:
+                end = buffer.find(FRAME_DELIMITER)
+                if end == -1:
+                    break
+                encoded = bytes(buffer[:end])
+                del buffer[:end + 1]
+                if encoded:
+                    self._receive(encoded)
+
+    def _receive(self, encoded: bytes) -> None:
+        # The request's own bytes take time to arrive
+        delay_s = self._wire_time(len(encoded) + 1)
+        if delay_s:
+            time.sleep(delay_s)
+        try:
+            frame = decode_frame(encoded)
+        except FrameError:
+            self._send(UNSOLICITED_SEQUENCE_ID, TctlmIds.ERR, bytes([ErrorCodes.MALFORMED_FRAME.value]))
+            return
+        self._service_baud_rate()
+        if self.emulate_baud and not self._host_at_baud_rate():
+            self.frames_garbled += 1
+            return
+        self.frames_received += 1
+        if time.monotonic() - self._booted_at < self.boot_delay_s:
+            self.frames_dropped += 1
+            return
+        if self._random.random() < self.drop_rate:
+            self.frames_dropped += 1
+            return
+        # A valid frame proves the host is speaking at the current rate
+        self._baud_switched_at = None
+        self._handle(frame.seq, frame.command, bytes(frame.payload))
+
+    def _error(self, seq: int, code: ErrorCodes) -> None:
+        self._send(seq, TctlmIds.ERR, bytes([code.value]))
+
+    def _handle(self, seq: int, command: int, payload: bytes) -> None:
+        try:
+            tctlm_id = TctlmIds(command)
+        except ValueError:
+            return self._error(seq, ErrorCodes.UNKNOWN_COMMAND)
+
+        if tctlm_id == TctlmIds.BATCH:
+            return self._handle_batch(seq, payload)
+        if tctlm_id == TctlmIds.STREAM_START:
+            return self._handle_stream_start(seq, payload)
+        if tctlm_id == TctlmIds.SCHEDULE_LOAD:
+            return self._handle_schedule_load(seq, payload)
+        if tctlm_id == TctlmIds.PLAYBACK_START:
+            return self._handle_playback_start(seq, payload)
+        if tctlm_id == TctlmIds.PLAYBACK_DATA:
+            return self._handle_playback_data(seq, payload)
+        if tctlm_id in (TctlmIds.DIGITAL_READ_PINS, TctlmIds.DIGITAL_WRITE_PINS, TctlmIds.ANALOG_READ_PINS):
+            return self._handle_bulk(seq, tctlm_id, payload)
+        if tctlm_id not in REQUEST_LAYOUTS:
+            return self._error(seq, ErrorCodes.UNKNOWN_COMMAND)
+        layout = REQUEST_LAYOUTS[tctlm_id]
+        if len(payload) != layout.size:
+            return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+        args = layout.unpack(payload)
+
+        if tctlm_id == TctlmIds.ACK:
+            self._send(seq, tctlm_id, bytes([PROTOCOL_VERSION]))
+        elif tctlm_id == TctlmIds.DIGITAL_READ:
+            self._send(seq, tctlm_id, bytes([self._digital_read(*args)]))
+        elif tctlm_id == TctlmIds.DIGITAL_WRITE:
+            self.outputs[args[0]] = 1 if args[1] else 0
+            self._send(seq, tctlm_id)
+        elif tctlm_id == TctlmIds.PIN_MODE:
+            if args[1] > 4:
+                return self._error(seq, ErrorCodes.MODE_GREATER_THAN_FOUR)
+            self.modes[args[0]] = args[1]
+            self._send(seq, tctlm_id)
+        elif tctlm_id == TctlmIds.ANALOG_READ:
+            self._send(seq, tctlm_id, struct.pack('>H', self._analog_read(*args)))
+        elif tctlm_id == TctlmIds.ANALOG_WRITE:
+            self.outputs[args[0]] = args[1]
+            self._send(seq, tctlm_id)
+        elif tctlm_id == TctlmIds.DELAY:
+            time.sleep(args[0] / 1000)
+            self._send(seq, tctlm_id)
+        elif tctlm_id == TctlmIds.MILLIS:
+            self._send(seq, tctlm_id, struct.pack('>I', self.millis()))
+        elif tctlm_id == TctlmIds.STREAM_STOP:
+            self._stream_pins = []
+            self._send(seq, tctlm_id)
+        elif tctlm_id == TctlmIds.SET_BAUD:
+            if args[0] not in NEGOTIABLE_BAUD_RATES:
+                return self._error(seq, ErrorCodes.UNSUPPORTED_BAUD_RATE)
+            # Reply at the old rate, then switch
+            self._send(seq, tctlm_id)
+            self._previous_baud_rate = self.baud_rate
+            self.baud_rate = args[0]
+            self._baud_switched_at = time.monotonic()
+            timer = threading.Timer(BAUD_CONFIRM_TIMEOUT_S, self._service_baud_rate)
+            timer.daemon = True
+            timer.start()
+        elif tctlm_id == TctlmIds.WATCH_PIN:
+            pin, edge = args
+            if edge > PIN_EDGES['CHANGE']:
+                return self._error(seq, ErrorCodes.INVALID_EDGE)
+            if edge == PIN_EDGES['NONE']:
+                self._watches.pop(pin, None)
+                return self._send(seq, tctlm_id, bytes([0]))
+            if pin not in self._watches and len(self._watches) >= MAX_WATCHED_PINS:
+                return self._error(seq, ErrorCodes.TOO_MANY_WATCHED_PINS)
+            self._watches[pin] = edge
+            self._send(seq, tctlm_id, bytes([1 if pin in INTERRUPT_PINS else 0]))
+        elif tctlm_id == TctlmIds.SCHEDULE_START:
+            length, runs, period_ms = args
+            if length > MAX_SCHEDULE_STEPS:
+                return self._error(seq, ErrorCodes.SCHEDULE_TOO_LARGE)
+            self._schedule_length = length
+            self._schedule_runs = runs
+            self._schedule_period_s = period_ms / 1000
+            self._schedule_next = 0
+            self._schedule_runs_done = 0
+            self._schedule_max_late_ms = 0
+            self._schedule_run_start = time.monotonic()
+            self._schedule_state = SCHEDULE_STATE_IDS['RUNNING']
+            self._send(seq, tctlm_id)
+            self._schedule_wake.set()
+        elif tctlm_id == TctlmIds.SCHEDULE_STOP:
+            if self._schedule_state == SCHEDULE_STATE_IDS['RUNNING']:
+                self._schedule_state = SCHEDULE_STATE_IDS['STOPPED']
+                self._schedule_wake.set()
+            self._send(seq, tctlm_id)
+        elif tctlm_id == TctlmIds.PLAYBACK_STOP:
+            with self._playback_lock:
+                self._playback_active = False
+                payload = struct.pack('>IH', self._playback_played, min(self._playback_underruns, 0xFFFF))
+            self._send(seq, tctlm_id, payload)
+        elif tctlm_id == TctlmIds.SCHEDULE_STATUS:
+            payload = struct.pack(
+                '>BBHH', self._schedule_state, self._schedule_next,
+                self._schedule_runs_done, min(self._schedule_max_late_ms, 0xFFFF),
+            )
+            self._send(seq, tctlm_id, payload)
+        else:
+            self._error(seq, ErrorCodes.UNKNOWN_COMMAND)
+
+    def _digital_read(self, pin: int) -> int:
+        if self.modes.get(pin) == 1:
+            return self.outputs.get(pin, 0)
+        return self.digital_inputs.get(pin, 0)
+
+    def _analog_read(self, pin: int) -> int:
+        return self.analog_inputs.get(pin, 0)
+
+    def _handle_batch(self, seq: int, payload: bytes) -> None:
+        if not payload:
+            return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+        count = payload[0]
+        if count > MAX_BATCH_OPS:
+            return self._error(seq, ErrorCodes.BATCH_TOO_LARGE)
+
+        # Check every operation before running any, like the firmware
+        ops = []
+        offset = 1
+        for _ in range(count):
+            if offset >= len(payload):
+                return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+            command = payload[offset]
+            if command not in BATCH_ARG_LENGTHS:
+                return self._error(seq, ErrorCodes.UNKNOWN_COMMAND)
+            args = payload[offset + 1:offset + 1 + BATCH_ARG_LENGTHS[command]]
+            if command == TctlmIds.PIN_MODE.value and len(args) == 2 and args[1] > 4:
+                return self._error(seq, ErrorCodes.MODE_GREATER_THAN_FOUR)
+            ops.append((command, args))
+            offset += 1 + BATCH_ARG_LENGTHS[command]
+        if offset != len(payload):
+            return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+
+        results = bytearray()
+        for command, args in ops:
+            if command in SCHEDULE_COMMANDS:
+                self._apply(command, *args)
+            elif command == TctlmIds.DIGITAL_READ.value:
+                results.append(self._digital_read(args[0]))
+            elif command == TctlmIds.ANALOG_READ.value:
+                results += struct.pack('>H', self._analog_read(args[0]))
+            else:
+                results += struct.pack('>I', self.millis())
+        self._send(seq, TctlmIds.BATCH, bytes(results))
+
+    def _apply(self, command: int, pin: int, value: int) -> None:
+        """Run a PIN_MODE, DIGITAL_WRITE or ANALOG_WRITE."""
+        if command == TctlmIds.PIN_MODE.value:
+            self.modes[pin] = value
+        elif command == TctlmIds.DIGITAL_WRITE.value:
+            self.outputs[pin] = 1 if value else 0
+        else:
+            self.outputs[pin] = value
+
+    def _handle_schedule_load(self, seq: int, payload: bytes) -> None:
+        if self._schedule_state == SCHEDULE_STATE_IDS['RUNNING']:
+            return self._error(seq, ErrorCodes.SCHEDULE_RUNNING)
+        count, remainder = divmod(len(payload) - 1, SCHEDULE_STEP.size)
+        if len(payload) < 1 or remainder or count > MAX_SCHEDULE_LOAD_STEPS:
+            return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+        first = payload[0]
+        if first + count > MAX_SCHEDULE_STEPS:
+            return self._error(seq, ErrorCodes.SCHEDULE_TOO_LARGE)
+        steps = [SCHEDULE_STEP.unpack_from(payload, 1 + i * SCHEDULE_STEP.size) for i in range(count)]
+        for _, command, _, value in steps:
+            if command not in SCHEDULE_COMMANDS:
+                return self._error(seq, ErrorCodes.UNKNOWN_COMMAND)
+            if command == TctlmIds.PIN_MODE.value and value > 4:
+                return self._error(seq, ErrorCodes.MODE_GREATER_THAN_FOUR)
+        self._schedule_steps[first:first + count] = steps
+        self._send(seq, TctlmIds.SCHEDULE_LOAD)
+
+    def _handle_playback_start(self, seq: int, payload: bytes) -> None:
+        if len(payload) < 5:
+            return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+        period_us, count = struct.unpack_from('>IB', payload)
+        if count == 0 or count > MAX_PLAYBACK_PINS:
+            return self._error(seq, ErrorCodes.TOO_MANY_PLAYBACK_PINS)
+        if len(payload) != 5 + count:
+            return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+        with self._playback_lock:
+            self._playback_pins = payload[5:]
+            self._playback_period_s = period_us / 1_000_000
+            self._playback_buffer.clear()
+            self._playback_capacity = PLAYBACK_BUFFER_BYTES // count
+            self._playback_primed = False
+            self._playback_last_received = False
+            self._playback_played = 0
+            self._playback_underruns = 0
+            self._playback_freed = 0
+            self._playback_active = True
+        self._send(seq, TctlmIds.PLAYBACK_START, struct.pack('>H', self._playback_capacity))
+
+    def _handle_playback_data(self, seq: int, payload: bytes) -> None:
+        if not self._playback_active:
+            return self._error(seq, ErrorCodes.NOT_PLAYING)
+        width = len(self._playback_pins)
+        if len(payload) < 1 or (len(payload) - 1) % width or len(payload) - 1 > MAX_PLAYBACK_CHUNK_BYTES:
+            return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+        with self._playback_lock:
+            count = (len(payload) - 1) // width
+            if len(self._playback_buffer) + count > self._playback_capacity:
+                return self._error(seq, ErrorCodes.PLAYBACK_OVERFLOW)
+            for i in range(count):
+                self._playback_buffer.append(payload[1 + i * width:1 + (i + 1) * width])
+            if payload[0] & PLAYBACK_LAST_CHUNK:
+                self._playback_last_received = True
+            self._playback_primed = True
+        self._send(seq, TctlmIds.PLAYBACK_DATA)
+        self._playback_wake.set()
+
+    def _handle_bulk(self, seq: int, tctlm_id: TctlmIds, payload: bytes) -> None:
+        if tctlm_id == TctlmIds.ANALOG_READ_PINS:
+            if not 0 < len(payload) <= MAX_ANALOG_READ_PINS:
+                return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+            values = [self._analog_read(pin) for pin in payload]
+            return self._send(seq, tctlm_id, struct.pack(f'>{len(values)}H', *values))
+
+        if tctlm_id == TctlmIds.DIGITAL_READ_PINS:
+            mask = payload[1:]
+            if not 0 < len(mask) <= MAX_PIN_MASK_BYTES:
+                return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+            levels = bytearray(len(mask))
+            for pin in unpack_pin_mask(payload[0], mask):
+                if self._digital_read(pin):
+                    offset = pin - payload[0]
+                    levels[offset // 8] |= 1 << (offset % 8)
+            return self._send(seq, tctlm_id, bytes(levels))
+
+        n = payload[1] if len(payload) >= 2 else 0
+        if not 0 < n <= MAX_PIN_MASK_BYTES or len(payload) != 2 + 2 * n:
+            return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+        first_pin, mask, levels = payload[0], payload[2:2 + n], payload[2 + n:]
+        high = set(unpack_pin_mask(first_pin, levels))
+        for pin in unpack_pin_mask(first_pin, mask):
+            self.outputs[pin] = 1 if pin in high else 0
+        self._send(seq, tctlm_id)
+
+    def _handle_stream_start(self, seq: int, payload: bytes) -> None:
+        if len(payload) < 5:
+            return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+        period_us, count = struct.unpack_from('>IB', payload)
+        if count == 0 or count > MAX_STREAM_PINS:
+            return self._error(seq, ErrorCodes.TOO_MANY_STREAM_PINS)
+        if len(payload) != 5 + count:
+            return self._error(seq, ErrorCodes.LENGTH_INCORRECT)
+        self._stream_period_s = period_us / 1_000_000
+        self._stream_counter = 0
+        self._stream_pins = list(payload[5:])
+        self._send(seq, TctlmIds.STREAM_START)
+        self._stream_wake.set()
+
+    def _stream(self) -> None:
+        next_sample = time.monotonic()
+        while not self._closed.is_set():
+            pins = self._stream_pins
+            if not pins:
+                self._stream_wake.wait()
+                self._stream_wake.clear()
+                next_sample = time.monotonic()
+                continue
+            payload = bytes([self._stream_counter]) + b''.join(
+                struct.pack('>H', self._analog_read(pin)) for pin in pins
+            )
+            self._stream_counter = (self._stream_counter + 1) & 0xFF
+            try:
+                self._send(UNSOLICITED_SEQUENCE_ID, TctlmIds.STREAM_DATA, payload)
+            except OSError:
+                return
+            next_sample += self._stream_period_s
+            time.sleep(max(0.0, next_sample - time.monotonic()))
+
+    def _schedule(self) -> None:
+        running = SCHEDULE_STATE_IDS['RUNNING']
+        while not self._closed.is_set():
+            if self._schedule_state != running:
+                self._schedule_wake.wait()
+                self._schedule_wake.clear()
+                continue
+
+            if self._schedule_next >= self._schedule_length:
+                self._schedule_runs_done += 1
+                if self._schedule_runs and self._schedule_runs_done >= self._schedule_runs:
+                    self._schedule_state = SCHEDULE_STATE_IDS['DONE']
+                    payload = struct.pack(
+                        '>HHI', self._schedule_runs_done,
+                        min(self._schedule_max_late_ms, 0xFFFF), self.millis(),
+                    )
+                    try:
+                        self._send(UNSOLICITED_SEQUENCE_ID, TctlmIds.SCHEDULE_DONE, payload)
+                    except OSError:
+                        return
+                else:
+                    self._schedule_run_start += self._schedule_period_s
+                    self._schedule_next = 0
+                continue
+
+            offset_ms, command, pin, value = self._schedule_steps[self._schedule_next]
+            due = self._schedule_run_start + offset_ms / 1000
+            if due > time.monotonic():
+                # Woken early if the schedule is stopped or restarted
+                if self._schedule_wake.wait(due - time.monotonic()):
+                    self._schedule_wake.clear()
+                continue
+            self._apply(command, pin, value)
+            late_ms = int((time.monotonic() - due) * 1000)
+            self._schedule_max_late_ms = max(self._schedule_max_late_ms, late_ms)
+            self._schedule_next += 1
+
+    def _playback(self) -> None:
+        next_sample = time.monotonic()
+        while not self._closed.is_set():
+            if not (self._playback_active and self._playback_primed):
+                self._playback_wake.wait()
+                self._playback_wake.clear()
+                next_sample = time.monotonic()
+                continue
+
+            finished = False
+            with self._playback_lock:
+                if self._playback_buffer:
+                    for pin, value in zip(self._playback_pins, self._playback_buffer.popleft()):
+                        self.outputs[pin] = value
+                    self._playback_played += 1
+                    self._playback_freed += 1
+                elif self._playback_last_received:
+                    self._playback_active = False
+                    finished = True
+                else:
+                    self._playback_underruns += 1
+                chunk_samples = MAX_PLAYBACK_CHUNK_BYTES // len(self._playback_pins)
+                if finished or self._playback_freed >= chunk_samples or (not self._playback_buffer and self._playback_freed):
+                    payload = struct.pack(
+                        '>HIHB', self._playback_freed, self._playback_played,
+                        min(self._playback_underruns, 0xFFFF), finished,
+                    )
+                    self._playback_freed = 0
+                else:
+                    payload = None
+            if payload is not None:
+                try:
+                    self._send(UNSOLICITED_SEQUENCE_ID, TctlmIds.PLAYBACK_CREDIT, payload)
+                except OSError:
+                    return
+            next_sample += self._playback_period_s
+            time.sleep(max(0.0, next_sample - time.monotonic()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--no-baud-emulation', action='store_true', help="Don't emulate wire time")
+    parser.add_argument('--byte-latency-us', type=float, default=0.0, help="Extra latency per byte")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Fraction of requests to ignore")
+    parser.add_argument('--corrupt-rate', type=float, default=0.0, help="Fraction of replies to corrupt")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--boot-delay-ms', type=float, default=0.0, help="How long requests are ignored after a reset")
+    parser.add_argument('--clock-drift-ppm', type=float, default=0.0, help="How fast the board's clock runs")
+    args = parser.parse_args()
+
+    simulator = SimulatedArduino(
+        emulate_baud=not args.no_baud_emulation,
+        byte_latency_s=args.byte_latency_us / 1_000_000,
+        drop_rate=args.drop_rate,
+        corrupt_rate=args.corrupt_rate,
+        seed=args.seed,
+        boot_delay_s=args.boot_delay_ms / 1000,
+        clock_drift_ppm=args.clock_drift_ppm,
+    )
+    print(f"Simulated arduino listening on {simulator.start()}, press Ctrl-C to stop", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import math
+import struct
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional
+
+from .codec import Frame
+
+# Upper bound on the samples kept per pin, so a long buffer at a high rate
+# can't exhaust the host's memory.
+MAX_BUFFER_SAMPLES = 1_000_000
+
+
+class RingBuffer:
+    """A fixed-capacity ring of 16-bit samples, preallocated up front so that
+    appending a sample never allocates.
+
+    Appends come from the transport's reader thread while snapshots are taken
+    from the event loop, so both are guarded by a lock.
+    """
+
+    def __init__(self, capacity: int):
+        assert capacity > 0, f"Capacity must be positive, but was {capacity}"
+        self._data = array('H', bytes(2 * capacity))
+        self._capacity = capacity
+        self._head = 0  # Index the next sample will be written to
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, value: int) -> None:
+        with self._lock:
+            self._data[self._head] = value
+            self._head = (self._head + 1) % self._capacity
+            self._count = min(self._count + 1, self._capacity)
+
+    def snapshot(self, last_n: Optional[int] = None) -> array:
+        """Copy out the most recent `last_n` samples (or all of them), ordered
+        oldest to newest."""
+        with self._lock:
+            n = self._count if last_n is None else min(last_n, self._count)
+            start = (self._head - n) % self._capacity
+            if start + n <= self._capacity:
+                return self._data[start:start + n]
+            return self._data[start:] + self._data[:self._head]
+
+
+def summarize(samples: array, decimate_to: int) -> dict:
+    """Reduce a run of samples to summary statistics plus a short series of
+    bucket means, small enough to hand to an LLM."""
+    count = len(samples)
+    if count == 0:
+        return {'count': 0}
+
+    total = 0
+    total_sq = 0
+    for value in samples:
+        total += value
+        total_sq += value * value
+
+    decimated = []
+    buckets = max(1, min(decimate_to, count))
+    for i in range(buckets):
+        bucket = samples[i * count // buckets:(i + 1) * count // buckets]
+        decimated.append(round(sum(bucket) / len(bucket), 1))
+
+    return {
+        'count': count,
+        'min': min(samples),
+        'max': max(samples),
+        'mean': total / count,
+        'rms': math.sqrt(total_sq / count),
+        'decimated': decimated,
+    }
+
+
+class AnalogStream:
+    """Host-side state of a running analog stream: one ring buffer per pin,
+    filled from the STREAM_DATA frames the firmware pushes.
+
+    Each STREAM_DATA payload holds an 8-bit frame counter followed by one
+    big-endian 16-bit sample per pin.
+    """
+
+    def __init__(self, pins: Dict[int, int], rate_hz: float, buffer_seconds: float):
+        """
+        Arguments:
+            pins: Maps each pin as the user named it (eg 0 for 'A0') to the
+            resolved pin number sent to the firmware, in sampling order.
+            rate_hz: The sample rate requested from the firmware.
+            buffer_seconds: How much history to keep per pin.
+        """
+        self.pins = pins
+        self.rate_hz = rate_hz
+        capacity = max(1, min(MAX_BUFFER_SAMPLES, int(rate_hz * buffer_seconds)))
+        self.buffers: Dict[int, RingBuffer] = {pin: RingBuffer(capacity) for pin in pins}
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.malformed_frames = 0
+        self.started_at = time.monotonic()
+        # Cleared when the stream is stopped, while its samples stay around
+        # for stream_stats
+        self.running = True
+        self.stopped_at: Optional[float] = None
+        self._last_counter: Optional[int] = None
+        self._order: List[RingBuffer] = list(self.buffers.values())
+        self._layout = struct.Struct('>B' + 'H' * len(pins))
+
+    def start_payload(self) -> bytes:
+        """The STREAM_START payload that starts this stream on the firmware."""
+        period_us = int(round(1_000_000 / self.rate_hz))
+        return struct.pack('>IB', period_us, len(self.pins)) + bytes(self.pins.values())
+
+    def stop(self) -> None:
+        if self.running:
+            self.running = False
+            self.stopped_at = time.monotonic()
+
+    def ingest(self, frame: Frame) -> None:
+        """Unpack a STREAM_DATA frame into the ring buffers. Called from the
+        transport's reader thread."""
+        if len(frame.payload) != self._layout.size:
+            self.malformed_frames += 1
+            return
+
+        counter, *samples = self._layout.unpack_from(frame.payload)
+        if self._last_counter is not None:
+            self.frames_dropped += (counter - self._last_counter - 1) % 256
+        self._last_counter = counter
+        self.frames_received += 1
+
+        for buffer, value in zip(self._order, samples):
+            buffer.append(value)
+
+    def stats(self, pin: int, last_seconds: Optional[float], decimate_to: int) -> dict:
+        last_n = None if last_seconds is None else max(1, int(self.rate_hz * last_seconds))
+        return summarize(self.buffers[pin].snapshot(last_n), decimate_to)
+
+    def status(self) -> dict:
+        return {
+            'pins': list(self.pins),
+            'rate_hz': self.rate_hz,
+            'running': self.running,
+            'running_s': round((self.stopped_at or time.monotonic()) - self.started_at, 3),
+            'frames_received': self.frames_received,
+            'frames_dropped': self.frames_dropped,
+            'malformed_frames': self.malformed_frames,
+        }
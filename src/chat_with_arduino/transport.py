@@ -0,0 +1,521 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import serial
+
+from .codec import (
+    FRAME_DELIMITER,
+    FRAME_OVERHEAD,
+    REPLY_LAYOUTS,
+    Frame,
+    FrameError,
+    ProtocolError,
+    decode_frame,
+    encode_frame,
+    pack_request,
+    unpack_reply,
+)
+from .metrics import LinkStats
+from .protocol import (
+    BAUD_CONFIRM_TIMEOUT_S,
+    MAX_SEQUENCE_ID,
+    NEGOTIABLE_BAUD_RATES,
+    UNSOLICITED_SEQUENCE_ID,
+    TctlmIds,
+)
+
+logger = logging.getLogger(__name__)
+
+COMMAND_NAMES = {tctlm_id.value: tctlm_id.name for tctlm_id in TctlmIds}
+COMMAND_IDS = {tctlm_id.value: tctlm_id for tctlm_id in TctlmIds}
+
+# How often the reader thread wakes up to check whether it should stop.
+READ_POLL_INTERVAL_S = 0.05
+
+# A start bit, 8 data bits and a stop bit.
+BITS_PER_BYTE = 10
+
+# A partial frame that hasn't grown for this long is the remains of a frame
+# that lost bytes (its delimiter, say). It's thrown away rather than left to
+# corrupt the next frame. The firmware writes each frame in one go, so a gap
+# this long never occurs within a frame.
+STALE_PARTIAL_FRAME_S = 0.05
+
+# Assumed for replies whose length isn't known up front.
+DEFAULT_REPLY_PAYLOAD_BYTES = 64
+
+# The slack a command gets on top of the time its bytes spend on the wire and
+# the board spends executing it is learnt from the replies, see
+# LatencyEnvelope. It's never less than this, which covers the host's own
+# scheduling hiccups.
+MIN_ENVELOPE_S = 0.1
+
+
+class LatencyEnvelope:
+    """Learns how much longer than the wire and execution time replies take
+    (USB latency, the firmware's loop, the host's scheduling), the way TCP
+    learns its retransmission timeout: a smoothed mean plus four times the
+    smoothed deviation, doubled after every timeout until the next reply.
+
+    Until the first reply, and at most ever, commands get `ceiling_s`.
+    """
+
+    def __init__(self, ceiling_s: float):
+        self.ceiling_s = ceiling_s
+        self.mean_s: Optional[float] = None
+        self.deviation_s = 0.0
+        self.backoff = 1
+
+    def slack_s(self) -> float:
+        if self.mean_s is None:
+            return self.ceiling_s
+        slack_s = max(MIN_ENVELOPE_S, self.mean_s + 4 * self.deviation_s) * self.backoff
+        return min(slack_s, self.ceiling_s)
+
+    def observe(self, overhead_s: float) -> None:
+        """Feed in how much longer than expected a reply took."""
+        overhead_s = max(0.0, overhead_s)
+        if self.mean_s is None:
+            self.mean_s = overhead_s
+            self.deviation_s = overhead_s / 2
+        else:
+            self.deviation_s += (abs(self.mean_s - overhead_s) - self.deviation_s) / 4
+            self.mean_s += (overhead_s - self.mean_s) / 8
+        self.backoff = 1
+
+    def timed_out(self) -> None:
+        self.backoff *= 2
+
+    def describe(self) -> dict:
+        return {
+            'slack_ms': round(self.slack_s() * 1000, 1),
+            'mean_overhead_ms': None if self.mean_s is None else round(self.mean_s * 1000, 2),
+            'deviation_ms': round(self.deviation_s * 1000, 2),
+        }
+
+
+# The smallest AVR boards have a 64 byte serial RX buffer. Six of the usual
+# (at most 10 byte) request frames fit comfortably, so the firmware doesn't
+# drop pipelined commands even while it's busy with a slow one.
+DEFAULT_MAX_IN_FLIGHT = 6
+
+# The readiness probe's first ACK waits this long for a reply, each retry
+# twice as long as the last up to READY_PROBE_MAX_TIMEOUT_S. A board that's
+# already running answers the first, one still in its bootloader after a
+# reset a few retries later.
+READY_PROBE_TIMEOUT_S = 0.05
+READY_PROBE_MAX_TIMEOUT_S = 0.2
+
+# How long a board may take to answer the probe. Covers the slowest
+# bootloaders, which wait a couple of seconds for an upload after a reset.
+READY_TIMEOUT_S = 3.0
+
+# When confirming a new baud rate fails, how many times each rate is probed
+# to find which one the firmware ended up at.
+BAUD_PROBE_ATTEMPTS = 3
+
+
+def open_serial_port(port: str, reset_board: bool = True, **settings) -> serial.Serial:
+    """Open `port` with the given serial.Serial settings.
+
+    Opening a port asserts DTR, which resets most AVR boards. Unless
+    `reset_board`, DTR and RTS are held low while it opens so the board keeps
+    running. (Linux raises DTR briefly while opening a port regardless, unless
+    `stty -hupcl` was set on it.)
+    """
+    serial_port = serial.Serial(**settings)
+    serial_port.port = port
+    if not reset_board:
+        serial_port.dtr = False
+        serial_port.rts = False
+    serial_port.open()
+    return serial_port
+
+
+class SerialTransport:
+    """Owns a serial port and pipelines commands over it without ever blocking
+    the MCP event loop.
+
+    Every request frame carries a sequence ID which the firmware echoes in its
+    reply. Writes happen on a dedicated writer thread and a reader thread
+    continuously parses incoming frames, handing each one to the future that
+    is waiting on its sequence ID. Up to `max_in_flight` commands can be
+    outstanding at once, so back-to-back tool calls no longer each pay a full
+    serial round trip before the next command goes out.
+    """
+
+    def __init__(
+        self,
+        serial_port: serial.Serial,
+        timeout_s: Optional[float] = 1.0,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        stats: Optional[LinkStats] = None,
+        on_lost: Optional[Callable[[Exception], None]] = None,
+    ):
+        self.serial_port = serial_port
+        # The most any command waits beyond its expected time, or None to
+        # wait forever
+        self.timeout_s = timeout_s
+        self.envelope = LatencyEnvelope(timeout_s) if timeout_s is not None else None
+        # When the board is expected to have worked through every command
+        # sent so far, on the perf_counter clock
+        self._drain_at = 0.0
+        self.stats = stats or LinkStats()
+        self.serial_port.timeout = READ_POLL_INTERVAL_S
+
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._pending_lock = threading.Lock()
+        self._sequence_ids = itertools.cycle(range(MAX_SEQUENCE_ID + 1))
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._subscribers: Dict[int, Callable[[Frame], None]] = {}
+        self._closed = threading.Event()
+        # Called on the reader thread if the port fails, eg the board was
+        # unplugged
+        self.on_lost = on_lost
+        self._lost: Optional[Exception] = None
+
+        self._writer = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix=f"serial-writer-{serial_port.port}",
+        )
+        self._reader = threading.Thread(
+            target=self._read_forever,
+            name=f"serial-reader-{serial_port.port}",
+            daemon=True,
+        )
+        self._reader.start()
+
+    @property
+    def port(self) -> str:
+        return self.serial_port.port
+
+    @property
+    def baud_rate(self) -> int:
+        return self.serial_port.baudrate
+
+    def _read_forever(self) -> None:
+        """Split the incoming byte stream into frames and resolve the future
+        waiting on each frame's sequence ID. Runs on the reader thread."""
+        buffer = bytearray()
+        received_at = 0.0
+        try:
+            while not self._closed.is_set():
+                chunk = self.serial_port.read(self.serial_port.in_waiting or 1)
+                if not chunk:
+                    continue
+                self.stats.bytes_received += len(chunk)
+                now = time.perf_counter()
+                if buffer and now - received_at > STALE_PARTIAL_FRAME_S:
+                    self.stats.frames_rejected += 1
+                    buffer.clear()
+                received_at = now
+                buffer.extend(chunk)
+                start = 0
+                while True:
+                    end = buffer.find(FRAME_DELIMITER, start)
+                    if end == -1:
+                        break
+                    if end > start:
+                        try:
+                            frame = decode_frame(buffer[start:end])
+                        except FrameError:
+                            # Line noise or a partial frame, the next
+                            # delimiter resynchronises the stream
+                            self.stats.frames_rejected += 1
+                        else:
+                            self._dispatch(frame)
+                    start = end + 1
+                del buffer[:start]
+        except Exception as e:
+            if not self._closed.is_set():
+                self._lost = ConnectionError(f"Lost connection to {self.port}: {e}")
+                self._closed.set()
+                self._fail_pending(self._lost)
+                if self.on_lost is not None:
+                    self.on_lost(self._lost)
+
+    @property
+    def lost(self) -> bool:
+        """Whether the port failed, rather than being closed."""
+        return self._lost is not None
+
+    def subscribe(self, command: int, callback: Optional[Callable[[Frame], None]]) -> None:
+        """Register `callback` to receive every unsolicited frame with the
+        given command ID, or unregister it by passing None.
+
+        The callback runs on the reader thread. It must be quick and
+        thread-safe, since no other frames are read while it runs.
+        """
+        if callback is None:
+            self._subscribers.pop(command, None)
+        else:
+            self._subscribers[command] = callback
+
+    def subscriptions(self) -> Dict[int, Callable[[Frame], None]]:
+        """The callbacks registered with `subscribe`, by command ID."""
+        return dict(self._subscribers)
+
+    def _dispatch(self, frame: Frame) -> None:
+        if frame.seq == UNSOLICITED_SEQUENCE_ID:
+            callback = self._subscribers.get(frame.command)
+            if callback is not None:
+                try:
+                    callback(frame)
+                except Exception:
+                    # A broken subscriber mustn't take the whole link down
+                    logger.exception("Subscriber for command %d failed", frame.command)
+            return
+        with self._pending_lock:
+            future = self._pending.pop(frame.seq, None)
+        if future is None:
+            # The reply to a command that has already timed out
+            return
+        future.get_loop().call_soon_threadsafe(_set_result, future, frame)
+
+    def _fail_pending(self, exc: Exception) -> None:
+        with self._pending_lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            future.get_loop().call_soon_threadsafe(_set_exception, future, exc)
+
+    async def exchange(
+        self,
+        command: int,
+        payload: bytes = b'',
+        timeout_s: Optional[float] = None,
+        reply_bytes: Optional[int] = None,
+        execution_s: float = 0.0,
+    ) -> Frame:
+        """Send a command to the arduino and wait for its reply.
+
+        Unless `timeout_s` is given, the command times out once it's taken
+        longer than the commands ahead of it, its own bytes on the wire at
+        the current baud rate and `execution_s`, plus the slack the
+        transport's LatencyEnvelope has learnt. After a timeout both ends
+        are resynchronised, so the next command isn't lost too.
+
+        Arguments:
+            command: The TctlmId of the command to send.
+            payload: The bytes following the command ID in the request frame.
+            timeout_s: Optional timeout overriding the computed one for just
+            this command.
+            reply_bytes: The length of the reply's payload, if it isn't fixed
+            by codec.REPLY_LAYOUTS.
+            execution_s: How long the firmware takes to carry the command out,
+            eg the length of a DELAY.
+
+        Returns: The decoded reply frame.
+        """
+        if self._closed.is_set():
+            raise self._lost or ConnectionError(f"Connection to {self.port} is closed")
+
+        loop = asyncio.get_running_loop()
+        async with self._in_flight:
+            future = loop.create_future()
+            with self._pending_lock:
+                seq = next(self._sequence_ids)
+                self._pending[seq] = future
+            try:
+                frame = encode_frame(seq, command, payload)
+                start = time.perf_counter()
+                queued_s = max(0.0, self._drain_at - start)
+                expected_s = queued_s + self.wire_time_s(len(frame)) + execution_s + self.wire_time_s(
+                    self.reply_frame_bytes(command, reply_bytes)
+                )
+                self._drain_at = start + expected_s
+                if timeout_s is None and self.envelope is not None:
+                    timeout_s = expected_s + self.envelope.slack_s()
+                await loop.run_in_executor(self._writer, self.serial_port.write, frame)
+                self.stats.bytes_sent += len(frame)
+                reply = await asyncio.wait_for(future, timeout_s)
+                latency_s = time.perf_counter() - start
+                self.stats.command(COMMAND_NAMES.get(command, str(command))).observe(latency_s)
+                if self.envelope is not None:
+                    self.envelope.observe(latency_s - expected_s)
+                if reply.command == TctlmIds.ERR.value:
+                    self.stats.protocol_errors += 1
+                return reply
+            except asyncio.TimeoutError:
+                self.stats.timeouts += 1
+                if self.envelope is not None:
+                    self.envelope.timed_out()
+                await self._resynchronise()
+                raise TimeoutError(f"No reply to command {command} within {timeout_s:.3f}s") from None
+            finally:
+                with self._pending_lock:
+                    self._pending.pop(seq, None)
+                # If this was cancelled as the connection closed, the error
+                # it's failed with is either already set, or set later by a
+                # callback, and no one would ever look at it
+                if not future.done():
+                    future.cancel()
+                elif not future.cancelled():
+                    future.exception()
+
+    def wire_time_s(self, n_bytes: int) -> float:
+        """How long `n_bytes` take to send at the current baud rate."""
+        return n_bytes * BITS_PER_BYTE / self.baud_rate
+
+    @staticmethod
+    def reply_frame_bytes(command: int, payload_bytes: Optional[int] = None) -> int:
+        """The length on the wire of the reply to `command`, with a payload
+        of `payload_bytes` (by default the length in codec.REPLY_LAYOUTS)."""
+        if payload_bytes is None:
+            layout = REPLY_LAYOUTS.get(COMMAND_IDS.get(command))
+            payload_bytes = layout.size if layout is not None else DEFAULT_REPLY_PAYLOAD_BYTES
+        raw = FRAME_OVERHEAD + payload_bytes
+        # COBS adds a byte per 254, then the delimiter
+        return raw + raw // 254 + 2
+
+    async def _resynchronise(self) -> None:
+        """Send a lone delimiter, which ends any partial frame the firmware
+        is holding (eg a request that lost its own delimiter) without
+        starting a new one. Partial replies are dropped by the reader, see
+        STALE_PARTIAL_FRAME_S."""
+        self._drain_at = 0.0
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self._writer, self.serial_port.write, bytes([FRAME_DELIMITER]),
+            )
+            self.stats.bytes_sent += 1
+        except Exception as e:
+            logger.info("Couldn't resynchronise %s: %s", self.port, e)
+
+    async def request(
+        self,
+        command: TctlmIds,
+        *args: int,
+        timeout_s: Optional[float] = None,
+        execution_s: float = 0.0,
+    ) -> tuple:
+        """Send a fixed-layout command and unpack its reply, using the layouts
+        in codec.REQUEST_LAYOUTS and codec.REPLY_LAYOUTS. See `exchange` for
+        the timeout arguments.
+
+        Raises ProtocolError if the arduino replies with an error or an
+        unexpected frame.
+        """
+        reply = await self.exchange(
+            command.value, pack_request(command, *args), timeout_s=timeout_s, execution_s=execution_s,
+        )
+        return unpack_reply(command, reply)
+
+    async def wait_until_ready(self, timeout_s: float = READY_TIMEOUT_S) -> float:
+        """Probe the firmware with ACKs until one is answered, rather than
+        waiting a fixed time for the board to come out of reset. Each probe
+        waits twice as long as the last, see READY_PROBE_TIMEOUT_S.
+
+        Returns: The seconds until the firmware answered.
+        Raises TimeoutError if it didn't within `timeout_s`.
+        """
+        start = time.perf_counter()
+        probe_timeout_s = READY_PROBE_TIMEOUT_S
+        while True:
+            remaining = timeout_s - (time.perf_counter() - start)
+            if remaining <= 0:
+                raise TimeoutError(f"The firmware on {self.port} didn't answer within {timeout_s}s")
+            try:
+                await self.request(TctlmIds.ACK, timeout_s=min(probe_timeout_s, remaining))
+                return time.perf_counter() - start
+            except (TimeoutError, ProtocolError):
+                # Still in the bootloader, whose output may also garble a reply
+                probe_timeout_s = min(2 * probe_timeout_s, READY_PROBE_MAX_TIMEOUT_S)
+
+    def _set_baud_rate(self, baud_rate: int) -> None:
+        # Runs on the writer thread, so the rate never changes part way
+        # through writing a frame
+        self.serial_port.flush()
+        self.serial_port.baudrate = baud_rate
+        # Anything received around the switch is line noise
+        self.serial_port.reset_input_buffer()
+
+    async def negotiate_baud_rate(self, baud_rates: Iterable[int] = NEGOTIABLE_BAUD_RATES) -> int:
+        """Switch the link to the fastest of `baud_rates` that both ends
+        support. Rates no faster than the current one are skipped.
+
+        For each rate the firmware is asked to switch with SET_BAUD, then the
+        host switches and checks the link with an ACK. If the ACK fails the
+        host goes back to the old rate, and so does the firmware once it has
+        gone BAUD_CONFIRM_TIMEOUT_S without a valid frame. Unless the ACK got
+        through and only its reply was lost, in which case the firmware stays
+        at the new rate, so the host checks which rate it answers at.
+
+        Returns: The baud rate the link runs at afterwards.
+        """
+        loop = asyncio.get_running_loop()
+        current = self.baud_rate
+        for baud_rate in baud_rates:
+            if baud_rate <= current:
+                continue
+            try:
+                await self.request(TctlmIds.SET_BAUD, baud_rate)
+            except ProtocolError:
+                # The firmware doesn't support this rate (or predates SET_BAUD)
+                continue
+            except TimeoutError:
+                # The board isn't answering. Give it time to revert in case
+                # only the reply was lost, then stay at the current rate.
+                await asyncio.sleep(BAUD_CONFIRM_TIMEOUT_S)
+                return current
+
+            try:
+                await loop.run_in_executor(self._writer, self._set_baud_rate, baud_rate)
+                await self.request(TctlmIds.ACK, timeout_s=BAUD_CONFIRM_TIMEOUT_S / 2)
+                return baud_rate
+            except (ProtocolError, TimeoutError, ValueError, serial.SerialException) as e:
+                logger.info("Couldn't switch %s to %d baud: %s", self.port, baud_rate, e)
+                await loop.run_in_executor(self._writer, self._set_baud_rate, current)
+                await asyncio.sleep(BAUD_CONFIRM_TIMEOUT_S)
+            # If only the ACK's reply was lost, the firmware got the ACK and
+            # stays at the new rate
+            rate = await self._find_baud_rate((current, baud_rate))
+            if rate == baud_rate:
+                return baud_rate
+        return current
+
+    async def _find_baud_rate(self, baud_rates: Tuple[int, int]) -> Optional[int]:
+        """Which of `baud_rates` the firmware answers at, trying each in turn
+        up to BAUD_PROBE_ATTEMPTS times. If none, the host is left at the
+        first and None is returned."""
+        for _ in range(BAUD_PROBE_ATTEMPTS):
+            for baud_rate in baud_rates:
+                if await self._answers_at(baud_rate):
+                    return baud_rate
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._writer, self._set_baud_rate, baud_rates[0])
+        return None
+
+    async def _answers_at(self, baud_rate: int) -> bool:
+        """Switch the host to `baud_rate` and check the firmware answers."""
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._writer, self._set_baud_rate, baud_rate)
+            await self.request(TctlmIds.ACK, timeout_s=BAUD_CONFIRM_TIMEOUT_S / 2)
+            return True
+        except (ProtocolError, TimeoutError, ValueError, serial.SerialException):
+            return False
+
+    async def close(self) -> None:
+        """Stop the reader, fail any outstanding commands and close the port."""
+        self._closed.set()
+        self._fail_pending(ConnectionError(f"Connection to {self.port} was closed"))
+        await asyncio.to_thread(self._reader.join)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._writer, self.serial_port.close)
+        self._writer.shutdown(wait=False)
+
+
+def _set_result(future: asyncio.Future, result) -> None:
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exc: Exception) -> None:
+    if not future.done():
+        future.set_exception(exc)
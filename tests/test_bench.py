@@ -0,0 +1,36 @@
+"""Runs every tool against the simulator and checks none has got slower than
+the committed baseline, measured in ACK round trips so that it holds on any
+machine. Refresh the baseline after an intended change with
+
+    python -m chat_with_arduino.bench --save-baseline tests/bench_baseline.json --relative
+"""
+import asyncio
+import json
+import os
+
+from chat_with_arduino import bench, server
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'bench_baseline.json')
+
+# Generous, since CI machines are noisy: a tool fails the suite if it takes
+# 2.5 times as many ACK round trips as the baseline, plus bench.ACK_SLACK
+TOLERANCE = 1.5
+
+
+def test_every_tool_is_benchmarked():
+    tools = {tool.name for tool in asyncio.run(server.my_mcp.list_tools())}
+    benchmarked = set(bench.cases(None)) | {'connect_to_arduino', 'disconnect_from_arduino'}
+    assert tools - benchmarked - bench.UNBENCHMARKED == set()
+
+
+def test_no_regressions_against_baseline():
+    results = asyncio.run(bench.run(iterations=30, negotiate_baud=True, byte_latency_s=0))
+    with open(BASELINE) as f:
+        baseline = json.load(f)
+    assert bench.regressions(results, baseline, TOLERANCE) == []
+
+
+def test_regressions_allow_slack_on_relative_metrics():
+    baseline = {'ack': {'p50_acks': 1.0}, 'board_time': {'p50_acks': 0.02}}
+    assert bench.regressions({'ack': {'p50_acks': 1.7}, 'board_time': {'p50_acks': 0.5}}, baseline, 0.25) == []
+    assert len(bench.regressions({'ack': {'p50_acks': 1.8}, 'board_time': {'p50_acks': 0.5}}, baseline, 0.25)) == 1
@@ -0,0 +1,39 @@
+"""Checks that the server starts about as fast as the MCP SDK it's built on
+allows, by leaving the rest of the package to be imported by the tools."""
+import json
+import subprocess
+import sys
+
+from chat_with_arduino import bench
+
+# Modules that the server mustn't import until a tool needs them
+DEFERRED = {
+    'serial',
+    'chat_with_arduino.boards',
+    'chat_with_arduino.build_cache',
+    'chat_with_arduino.clocksync',
+    'chat_with_arduino.codec',
+    'chat_with_arduino.datalog',
+    'chat_with_arduino.events',
+    'chat_with_arduino.playback',
+    'chat_with_arduino.scheduler',
+    'chat_with_arduino.shadow',
+    'chat_with_arduino.streaming',
+    'chat_with_arduino.transport',
+}
+
+
+def test_startup_defers_imports():
+    result = subprocess.run(
+        [sys.executable, '-c', 'import chat_with_arduino.server, json, sys; print(json.dumps(list(sys.modules)))'],
+        capture_output=True,
+        check=True,
+        env=bench.server_env(),
+    )
+    assert DEFERRED & set(json.loads(result.stdout)) == set()
+
+
+def test_handshake_takes_little_longer_than_importing_mcp():
+    startup = bench.run_startup(5)
+    # Generous, since launching processes on CI machines is noisy
+    assert startup['startup_handshake']['p50_ms'] < 1.5 * startup['startup_mcp_import']['p50_ms'] + 100